@@ -1,28 +1,48 @@
 import os
 import sys
 import json
+import hashlib
+import re
 import sqlite3
 import pandas as pd
 import shutil
 import traceback
 import secrets
 import atexit
+import base64
+import queue
 from functools import wraps
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
+from collections import deque
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    flash, session, send_file, send_from_directory, make_response, Response
+    flash, session, send_file, send_from_directory, make_response,
+    g, has_app_context, has_request_context, jsonify, stream_template, stream_with_context
 )
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv, set_key
 from werkzeug.security import check_password_hash, generate_password_hash
 from jinja2 import TemplateNotFound
+from markupsafe import escape
 import zipfile
+import zlib
 
 # ==========================================================
 # APERTURA IMMEDIATA DELLA PAGINA DI LOADING
 # ==========================================================
 import threading, time, webbrowser
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+# I processi del pool PDF (spawn, anche su Windows e nell'eseguibile) rieseguono
+# questo modulo all'avvio: niente pagina di loading né scritture alla chiusura.
+PROCESSO_FIGLIO = (
+    multiprocessing.current_process().name != "MainProcess"
+    or "--multiprocessing-fork" in sys.argv
+)
+
+
 def apri_loading_immediato():
     time.sleep(0.2)
     path_loading = os.path.abspath('loading.html')
@@ -33,7 +53,10 @@ def apri_loading_immediato():
         pass
     print('🔵 Loading aperto subito:', url)
 
-threading.Thread(target=apri_loading_immediato, daemon=True).start()
+
+if not PROCESSO_FIGLIO:
+    threading.Thread(target=apri_loading_immediato, daemon=True).start()
+
 
 # ==========================================================
 # 📁 Percorso base del programma (py o .exe su chiavetta/PC)
@@ -61,70 +84,643 @@ LOCAL_DB = os.path.join(LOCAL_DATA_DIR, "compendio_norme.db")
 LOCAL_EXCEL = os.path.join(LOCAL_DATA_DIR, "Elenconorme.xlsx")
 LOCAL_PDF = os.path.join(LOCAL_DATA_DIR, "pdf")
 os.makedirs(LOCAL_PDF, exist_ok=True)
+AUDIT_ARCHIVIO_DIR = os.path.join(LOCAL_DATA_DIR, "audit_archivio")  # archivi mensili dell'audit
+EXPORT_CACHE_DIR = os.path.join(LOCAL_DATA_DIR, "export_cache")  # export già generati
+
+# ----------------------------------------------------------
+# Stato della rete in cache
+# ----------------------------------------------------------
+# Con la share irraggiungibile un os.path.exists può bloccarsi per secondi
+# (timeout SMB): lo esegue solo un thread sonda in background, le pagine
+# leggono l'ultimo esito. Da offline la sonda rallenta (backoff esponenziale).
+RETE_TTL = 15           # secondi tra due sonde quando la rete risponde
+RETE_BACKOFF_MAX = 300  # attesa massima tra due sonde da offline
+_stato_rete_lock = threading.Lock()
+_latenze_rete = deque(maxlen=50)  # ms delle ultime sonde
+STATO_RETE = {"online": False, "verificato": None, "sonde": 0, "errori_consecutivi": 0}
+_sonda_avviata = threading.Event()
+
+
+def verifica_rete():
+    """Controlla ora la cartella di rete (può bloccare) e aggiorna la cache."""
+    inizio = time.perf_counter()
+    try:
+        ok = os.path.exists(NETWORK_DATA_DIR)
+    except OSError:
+        ok = False
+    latenza = (time.perf_counter() - inizio) * 1000
+    with _stato_rete_lock:
+        _latenze_rete.append(latenza)
+        STATO_RETE["online"] = ok
+        STATO_RETE["verificato"] = time.time()
+        STATO_RETE["sonde"] += 1
+        STATO_RETE["errori_consecutivi"] = 0 if ok else STATO_RETE["errori_consecutivi"] + 1
+    return ok
+
+
+def _worker_sonda_rete():
+    while True:
+        verifica_rete()
+        errori = STATO_RETE["errori_consecutivi"]
+        attesa = min(RETE_TTL * 2 ** errori, RETE_BACKOFF_MAX) if errori else RETE_TTL
+        time.sleep(attesa)
+
+
+def avvia_sonda_rete():
+    if not _sonda_avviata.is_set():
+        _sonda_avviata.set()
+        threading.Thread(target=_worker_sonda_rete, name="sonda-rete", daemon=True).start()
+
 
 def is_online():
-    """Ritorna True se la cartella di rete è raggiungibile."""
+    """Ritorna True se la cartella di rete è raggiungibile (ultimo esito della sonda)."""
+    avvia_sonda_rete()
+    with _stato_rete_lock:
+        return STATO_RETE["online"]
+
+
+def stato_rete():
+    """Stato della rete con statistiche di latenza delle ultime sonde."""
+    with _stato_rete_lock:
+        stato = dict(STATO_RETE)
+        ultima = _latenze_rete[-1] if _latenze_rete else None
+        latenze = sorted(_latenze_rete)
+    stato["latenza_ms"] = None
+    if latenze:
+        stato["latenza_ms"] = {
+            "ultima": round(ultima, 1),
+            "media": round(sum(latenze) / len(latenze), 1),
+            "p95": round(latenze[min(len(latenze) - 1, int(len(latenze) * 0.95))], 1),
+            "max": round(latenze[-1], 1),
+        }
+    return stato
+
+
+# ----------------------------------------------------------
+# Sincronizzazione incrementale con manifest
+# ----------------------------------------------------------
+# Ogni lato tiene un manifest JSON {percorso_relativo: {size, mtime, sha256}}:
+# - in rete descrive i file pubblicati dall'ultimo sync_to_network();
+# - in locale descrive lo stato all'ultima sincronizzazione riuscita
+#   (serve a capire cosa è cambiato da quale lato e cosa è stato eliminato).
+# Solo i file nuovi o modificati vengono copiati.
+SYNC_MANIFEST = "sync_manifest.json"
+SYNC_FILE_DATI = ["compendio_norme.db", "Elenconorme.xlsx"]
+
+# sottocartelle sincronizzate: prefisso nel manifest → estensione dei file
+SYNC_SOTTOCARTELLE = {"pdf/": ".pdf", "audit/": ".db", "pdf_archivio/": ".pdf"}
+# sottocartelle in cui un file eliminato da un lato si elimina anche dall'altro
+SYNC_ELIMINABILI = ("pdf/", "pdf_archivio/")
+
+
+def _cartelle_sync(lato):
+    """{prefisso: cartella} per il lato "locale" o "rete" ("" = cartella dati)."""
+    if lato == "rete":
+        return {
+            "": NETWORK_DATA_DIR,
+            "pdf/": os.path.join(NETWORK_DATA_DIR, "pdf"),
+            "audit/": os.path.join(NETWORK_DATA_DIR, "audit_archivio"),
+            "pdf_archivio/": os.path.join(NETWORK_DATA_DIR, "pdf_archivio"),
+        }
+    return {"": LOCAL_DATA_DIR, "pdf/": PDF_FOLDER, "audit/": AUDIT_ARCHIVIO_DIR,
+            "pdf_archivio/": PDF_ARCHIVIO_DIR}
+
+
+def _percorso_sync(lato, rel):
+    cartelle = _cartelle_sync(lato)
+    for prefisso in SYNC_SOTTOCARTELLE:
+        if rel.startswith(prefisso):
+            return os.path.join(cartelle[prefisso], rel[len(prefisso):])
+    return os.path.join(cartelle[""], rel)
+
+
+def _scansiona_sync(lato):
+    """{rel: (size, mtime)} dei file sincronizzati presenti sul lato indicato."""
+    cartelle = _cartelle_sync(lato)
+    trovati = {}
+    for fname in SYNC_FILE_DATI:
+        try:
+            st = os.stat(os.path.join(cartelle[""], fname))
+            trovati[fname] = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            pass
+    for prefisso, estensione in SYNC_SOTTOCARTELLE.items():
+        if not os.path.isdir(cartelle[prefisso]):
+            continue
+        with os.scandir(cartelle[prefisso]) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.lower().endswith(estensione):
+                    st = entry.stat()
+                    trovati[prefisso + entry.name] = (st.st_size, st.st_mtime_ns)
+    return trovati
+
+
+def _crea_cartelle_sync(lato):
+    for prefisso in SYNC_SOTTOCARTELLE:
+        os.makedirs(_cartelle_sync(lato)[prefisso], exist_ok=True)
+
+
+def _carica_manifest(path):
     try:
-        return os.path.exists(NETWORK_DATA_DIR)
-    except:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("file", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _salva_manifest(path, voci, firma=None):
+    dati = {"versione": 1, "file": voci}
+    if firma is not None:
+        dati["firma"] = firma
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(dati, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for blocco in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(blocco)
+    return h.hexdigest()
+
+
+def _stessi_metadati(stat, voce, chiave_mtime="mtime"):
+    return voce is not None and stat[0] == voce.get("size") and stat[1] == voce.get(chiave_mtime)
+
+
+def _hash_noto(stat, voce, chiave_mtime="mtime"):
+    """Hash dal manifest se size/mtime non sono cambiati, altrimenti None."""
+    if _stessi_metadati(stat, voce, chiave_mtime):
+        return voce.get("sha256")
+    return None
+
+
+def _hash_dal_nome(rel):
+    """sha256 dei PDF in archivio, che è il loro nome (None per gli altri file):
+    un PDF dell'archivio presente da entrambi i lati è lo stesso, senza
+    confrontare date o rileggerlo."""
+    if rel.startswith("pdf_archivio/"):
+        return rel[len("pdf_archivio/"):-len(".pdf")]
+    return None
+
+
+def _hash_locale(rel, stat, ultimo):
+    # DB ed Excel cambiano spesso con la stessa dimensione e, su FAT, con mtime
+    # a risoluzione di 2 s: per loro l'hash si ricalcola sempre.
+    if rel in SYNC_FILE_DATI:
+        return hash_file(_percorso_sync("locale", rel))
+    if _hash_dal_nome(rel):
+        return _hash_dal_nome(rel)
+    return _hash_noto(stat, ultimo.get(rel)) or hash_file(_percorso_sync("locale", rel))
+
+
+def _pdf_archivio_usati():
+    """sha256 citati da pdf_files nel DB locale: un PDF dell'archivio che
+    serve ancora non si elimina in rete e, se manca in locale, si riscarica."""
+    with uso_db():
+        return {r[0] for r in get_db().execute("SELECT sha256 FROM pdf_files")}
+
+
+def _cambiato_in_rete(rel, stat_rete, manifest_rete, ultimo):
+    """True se il file di rete è diverso da quello dell'ultima sincronizzazione."""
+    voce = ultimo.get(rel)
+    if voce is None:
+        return True
+    h = _hash_dal_nome(rel) or _hash_noto(stat_rete, manifest_rete.get(rel))
+    if h is not None:
+        return h != voce.get("sha256")
+    return not _stessi_metadati(stat_rete, voce, "mtime_rete")
+
+
+# ----------------------------------------------------------
+# Trasferimenti paralleli
+# ----------------------------------------------------------
+# Su SMB la copia di tanti PDF piccoli è dominata dalla latenza, non dalla
+# banda: più copie in parallelo, ognuna su file temporaneo + rename atomico
+# (un file interrotto non prende mai il posto di quello buono).
+TRASFERIMENTI_PARALLELI = int(os.getenv("COMPENDIO_TRASFERIMENTI", "8"))
+TRASFERIMENTI_TENTATIVI = 3
+
+
+def copia_atomica(sorgente, dst, tentativi=TRASFERIMENTI_TENTATIVI):
+    """Copia `sorgente` (percorso o funzione che apre uno stream) in `dst`.
+    Ritenta con attesa crescente sugli errori di I/O."""
+    tmp = f"{dst}.{threading.get_ident()}.part"
+    for tentativo in range(1, tentativi + 1):
+        try:
+            if callable(sorgente):
+                with sorgente() as fin, open(tmp, "wb") as fout:
+                    shutil.copyfileobj(fin, fout, 1024 * 1024)
+            else:
+                shutil.copy2(sorgente, tmp)
+            os.replace(tmp, dst)
+            return
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            if tentativo == tentativi:
+                raise
+            time.sleep(0.5 * 2 ** (tentativo - 1))
+
+
+def trasferisci(lavori, completato=None, paralleli=None):
+    """Esegue i lavori [(chiave, sorgente, dst), ...] con un pool limitato.
+    `completato(chiave)` è chiamato nel thread chiamante per ogni copia riuscita.
+    Ritorna la lista [(chiave, errore), ...] delle copie fallite."""
+    falliti = []
+    if not lavori:
+        return falliti
+    paralleli = max(1, min(paralleli or TRASFERIMENTI_PARALLELI, len(lavori)))
+    with ThreadPoolExecutor(max_workers=paralleli, thread_name_prefix="trasferimento") as pool:
+        futuri = {pool.submit(copia_atomica, src, dst): chiave for chiave, src, dst in lavori}
+        for futuro in as_completed(futuri):
+            chiave = futuri[futuro]
+            try:
+                futuro.result()
+            except Exception as e:
+                print("❌ Copia non riuscita:", chiave, e)
+                falliti.append((chiave, e))
+                continue
+            if completato:
+                completato(chiave)
+    return falliti
+
+
+def _nuovo_riepilogo():
+    return {"copiati": 0, "eliminati": 0, "saltati": 0, "falliti": 0, "byte": 0}
+
+
+def _stampa_riepilogo(direzione, riepilogo):
+    print(f"✔ Sync {direzione}: {riepilogo['copiati']} copiati, "
+          f"{riepilogo['eliminati']} eliminati, {riepilogo['saltati']} invariati, "
+          f"{riepilogo['falliti']} non riusciti, "
+          f"{riepilogo['byte'] / (1024 * 1024):.1f} MB trasferiti.")
+
+
+def _sostituisci_db_locale(nuovo_file):
+    """Mette `nuovo_file` al posto del DB locale quando nessuno lo sta usando."""
+    with db_esclusivo():
+        chiudi_connessioni()
+        # il vecchio WAL non deve essere applicato al nuovo file
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(DB_FILE + suffix):
+                os.remove(DB_FILE + suffix)
+        os.replace(nuovo_file, DB_FILE)
+    invalida_cache_dati()
+    with uso_db():
+        crea_database()  # il DB di rete può avere uno schema meno recente
+        rinnova_identita_db(get_db())
+
+
+def _copia_db(conn, dst):
+    """Copia coerente del DB di `conn` in `dst` (API di backup SQLite)."""
+    out = sqlite3.connect(dst)
+    try:
+        conn.backup(out)
+    finally:
+        out.close()
+    return dst
+
+
+def _snapshot_db():
+    """Copia coerente del DB locale (API di backup SQLite), senza fermare le scritture."""
+    with uso_db():
+        return _copia_db(get_db(), DB_FILE + ".snapshot")
+
+
+def firma_dati():
+    """Identifica lo stato dei dati: generazione di `norme` + ultimo id di audit."""
+    conn = get_db(readonly=True)
+    audit_max = conn.execute("SELECT IFNULL(MAX(id), 0) FROM audit").fetchone()[0]
+    return f"{generazione_dati(conn)}:{audit_max}"
+
+
+def _firma_sincronizzata():
+    try:
+        with open(os.path.join(LOCAL_DATA_DIR, SYNC_MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f).get("firma")
+    except (OSError, ValueError):
+        return None
+
+
+def modifiche_da_inviare():
+    """True se in locale ci sono dati o PDF non ancora inviati in rete.
+    Mai True prima della prima sincronizzazione: un DB locale appena creato
+    non deve sovrascrivere quello di rete."""
+    firma = _firma_sincronizzata()
+    if firma is None:
         return False
+    ultimo = _carica_manifest(os.path.join(LOCAL_DATA_DIR, SYNC_MANIFEST))
+    locale = _scansiona_sync("locale")
+    for rel, stat in locale.items():
+        if rel not in SYNC_FILE_DATI and not _stessi_metadati(stat, ultimo.get(rel)):
+            return True
+    if any(rel.startswith(SYNC_ELIMINABILI) and rel not in locale for rel in ultimo):
+        return True
+    with uso_db():
+        return firma_dati() != firma
+
+
+# ----------------------------------------------------------
+# Stato di avanzamento (letto da /sync/stato e dalla pagina di avvio)
+# ----------------------------------------------------------
+_stato_sync_lock = threading.Lock()
+STATO_SYNC = {
+    "in_corso": False, "direzione": None,
+    "file_totali": 0, "file_fatti": 0, "byte_totali": 0, "byte_fatti": 0,
+    "inizio": None, "fine": None, "esito": None, "errore": None, "riepilogo": None,
+}
+
+
+def _progresso_inizio(direzione, piano):
+    """piano = [(rel, byte), ...] dei file da trasferire."""
+    with _stato_sync_lock:
+        STATO_SYNC.update({
+            "in_corso": True, "direzione": direzione,
+            "file_totali": len(piano), "file_fatti": 0,
+            "byte_totali": sum(n for _, n in piano), "byte_fatti": 0,
+            "inizio": time.time(), "fine": None, "errore": None,
+        })
+
+
+def _progresso_avanza(n_byte):
+    with _stato_sync_lock:
+        STATO_SYNC["file_fatti"] += 1
+        STATO_SYNC["byte_fatti"] += n_byte
+
+
+def _progresso_fine(esito, riepilogo=None, errore=None):
+    with _stato_sync_lock:
+        STATO_SYNC.update({
+            "in_corso": False, "fine": time.time(), "esito": esito,
+            "riepilogo": riepilogo, "errore": errore,
+        })
+
+
+def stato_sync():
+    """Copia dello stato di sincronizzazione con stima del tempo residuo."""
+    with _stato_sync_lock:
+        stato = dict(STATO_SYNC)
+    stato["eta_secondi"] = None
+    if stato["in_corso"] and stato["byte_fatti"] and stato["inizio"]:
+        trascorso = time.time() - stato["inizio"]
+        residuo = stato["byte_totali"] - stato["byte_fatti"]
+        stato["eta_secondi"] = round(trascorso * residuo / stato["byte_fatti"], 1)
+    return stato
+
+
+ULTIMO_SYNC = {}  # direzione → riepilogo dell'ultima sincronizzazione
+_sync_mutex = threading.Lock()  # una sincronizzazione alla volta
+
 
 def sync_from_network():
-    """Copia da rete → locale SOLO se online."""
-    if not is_online():
+    """Copia da rete → locale SOLO se online, e solo i file cambiati in rete."""
+    if not verifica_rete():
         print("⚠ Offline: uso database locale.")
         return False
 
-    try:
-        for fname in ["compendio_norme.db", "Elenconorme.xlsx"]:
-            src = os.path.join(NETWORK_DATA_DIR, fname)
-            dst = os.path.join(LOCAL_DATA_DIR, fname)
-            if os.path.exists(src):
-                shutil.copy2(src, dst)
-                print("✔ Copiato da rete → locale:", fname)
-
-        # Copia PDF
-        net_pdf = os.path.join(NETWORK_DATA_DIR, "pdf")
-        if os.path.exists(net_pdf):
-            for f in os.listdir(net_pdf):
-                if f.lower().endswith(".pdf"):
-                    shutil.copy2(os.path.join(net_pdf, f),
-                                 os.path.join(PDF_FOLDER, f))
+    with _sync_mutex:
+        try:
+            manifest_locale = os.path.join(LOCAL_DATA_DIR, SYNC_MANIFEST)
+            ultimo = _carica_manifest(manifest_locale)
+            manifest_rete = _carica_manifest(os.path.join(NETWORK_DATA_DIR, SYNC_MANIFEST))
+            rete = _scansiona_sync("rete")
+            locale = _scansiona_sync("locale")
+            riepilogo = _nuovo_riepilogo()
+            _crea_cartelle_sync("locale")
+
+            nuovo, piano = {}, []
+            usati = _pdf_archivio_usati()
+            for rel, stat_rete in rete.items():
+                h_rete = _hash_dal_nome(rel) or _hash_noto(stat_rete, manifest_rete.get(rel))
+                mancante = rel not in locale and _hash_dal_nome(rel) in usati
+                if not mancante and not _cambiato_in_rete(rel, stat_rete, manifest_rete, ultimo):
+                    # invariato in rete: la copia locale (anche se modificata o
+                    # eliminata, in attesa di sync_to_network) resta com'è
+                    riepilogo["saltati"] += 1
+                    nuovo[rel] = ultimo[rel]
+                elif rel in locale and h_rete is not None and h_rete == _hash_locale(rel, locale[rel], ultimo):
+                    riepilogo["saltati"] += 1
+                    nuovo[rel] = {
+                        "size": locale[rel][0], "mtime": locale[rel][1],
+                        "mtime_rete": stat_rete[1], "sha256": h_rete,
+                    }
+                else:
+                    if rel in locale and rel in ultimo and not _stessi_metadati(locale[rel], ultimo[rel]):
+                        print("⚠ Modificato sia in locale sia in rete, prevale la rete:", rel)
+                    piano.append((rel, stat_rete, h_rete))
+
+            _progresso_inizio("rete → locale", [(rel, st[0]) for rel, st, _ in piano])
+            info = {rel: (stat_rete, h_rete) for rel, stat_rete, h_rete in piano}
+
+            def copiato(rel):
+                stat_rete, h_rete = info[rel]
+                dst = _percorso_sync("locale", rel)
+                if rel == "compendio_norme.db":
+                    # scaricato a parte, sostituito quando il DB è libero
+                    h_rete = h_rete or hash_file(DB_FILE + ".sync")
+                    _sostituisci_db_locale(DB_FILE + ".sync")
+                riepilogo["copiati"] += 1
+                riepilogo["byte"] += stat_rete[0]
+                _progresso_avanza(stat_rete[0])
+                print("✔ Copiato da rete → locale:", rel)
+                st = os.stat(dst)
+                nuovo[rel] = {
+                    "size": st.st_size, "mtime": st.st_mtime_ns, "mtime_rete": stat_rete[1],
+                    "sha256": h_rete or hash_file(dst),
+                }
+
+            lavori = [
+                (rel, _percorso_sync("rete", rel),
+                 DB_FILE + ".sync" if rel == "compendio_norme.db" else _percorso_sync("locale", rel))
+                for rel, _, _ in piano
+            ]
+            # i file non riusciti restano fuori dal manifest: si ritentano al prossimo ciclo
+            riepilogo["falliti"] = len(trasferisci(lavori, copiato))
+
+            # PDF eliminati in rete dopo l'ultima sincronizzazione
+            for rel in set(ultimo) - set(rete):
+                if not rel.startswith(SYNC_ELIMINABILI) or rel not in locale:
+                    continue
+                if _stessi_metadati(locale[rel], ultimo[rel]):
+                    os.remove(_percorso_sync("locale", rel))
+                    riepilogo["eliminati"] += 1
+                    print("✔ Eliminato in locale (rimosso in rete):", rel)
+
+            # i file solo locali (non ancora inviati) restano fuori dal manifest
+            with uso_db():
+                riconcilia_pdf(get_db())  # PDF copiati o eliminati, DB forse sostituito
+                firma = firma_dati()
+            _salva_manifest(manifest_locale, nuovo, firma=firma)
+            ULTIMO_SYNC["rete → locale"] = riepilogo
+            _progresso_fine("parziale" if riepilogo["falliti"] else "ok", riepilogo)
+            _stampa_riepilogo("rete → locale", riepilogo)
+            print("✔ Sincronizzazione rete → locale completata.")
+            return True
+        except Exception as e:
+            _progresso_fine("errore", errore=str(e))
+            print("❌ Errore sync rete → locale:", e)
+            return False
 
-        print("✔ Sincronizzazione rete → locale completata.")
-        return True
-    except Exception as e:
-        print("❌ Errore sync rete → locale:", e)
-        return False
 
 def sync_to_network():
-    """Copia locale → rete SOLO se online e hai il lock."""
-    if not is_online():
+    """Copia locale → rete SOLO se online e hai il lock, e solo i file cambiati."""
+    if not verifica_rete():
         return False
     if not HAS_WRITE_LOCK:
         return False
 
-    try:
-        for fname in ["compendio_norme.db", "Elenconorme.xlsx"]:
-            src = os.path.join(LOCAL_DATA_DIR, fname)
-            dst = os.path.join(NETWORK_DATA_DIR, fname)
-            if os.path.exists(src):
-                shutil.copy2(src, dst)
-                print("✔ Copiato locale → rete:", fname)
-
-        # PDF
-        net_pdf = os.path.join(NETWORK_DATA_DIR, "pdf")
-        os.makedirs(net_pdf, exist_ok=True)
-        for f in os.listdir(PDF_FOLDER):
-            if f.lower().endswith(".pdf"):
-                shutil.copy2(os.path.join(PDF_FOLDER, f),
-                             os.path.join(net_pdf, f))
-
-        print("✔ Sincronizzazione locale → rete completata.")
-        return True
-    except Exception as e:
-        print("❌ Errore sync locale → rete:", e)
+    with _sync_mutex:
+        try:
+            # chi invia il DB ne archivia anche l'audit vecchio (al più una volta al giorno)
+            if archiviazione_dovuta():
+                archivia_audit()
+            svuota_specchio_excel()  # l'Excel inviato corrisponde al DB
+
+            _crea_cartelle_sync("rete")
+            manifest_locale = os.path.join(LOCAL_DATA_DIR, SYNC_MANIFEST)
+            manifest_rete_path = os.path.join(NETWORK_DATA_DIR, SYNC_MANIFEST)
+            ultimo = _carica_manifest(manifest_locale)
+            manifest_rete = _carica_manifest(manifest_rete_path)
+            rete = _scansiona_sync("rete")
+            locale = _scansiona_sync("locale")
+            riepilogo = _nuovo_riepilogo()
+
+            # il DB si invia da una copia coerente, non dal file in uso
+            svuota_audit()
+            with uso_db():
+                firma = firma_dati()
+            sorgenti = {rel: _percorso_sync("locale", rel) for rel in locale}
+            if "compendio_norme.db" in locale:
+                sorgenti["compendio_norme.db"] = _snapshot_db()
+
+            nuovo_locale, nuovo_rete, piano = {}, {}, []
+            for rel, stat_locale in locale.items():
+                if rel == "compendio_norme.db":
+                    h_locale = hash_file(sorgenti[rel])
+                else:
+                    h_locale = _hash_locale(rel, stat_locale, ultimo)
+                h_rete = None
+                if rel in rete:
+                    h_rete = _hash_dal_nome(rel) or _hash_noto(rete[rel], manifest_rete.get(rel))
+                    if h_rete is None and not _cambiato_in_rete(rel, rete[rel], manifest_rete, ultimo):
+                        h_rete = ultimo[rel].get("sha256")
+                if h_rete is not None and h_rete == h_locale:
+                    riepilogo["saltati"] += 1
+                    st_rete = rete[rel]
+                    nuovo_rete[rel] = {"size": st_rete[0], "mtime": st_rete[1], "sha256": h_locale}
+                    nuovo_locale[rel] = {
+                        "size": stat_locale[0], "mtime": stat_locale[1],
+                        "mtime_rete": st_rete[1], "sha256": h_locale,
+                    }
+                else:
+                    piano.append((rel, stat_locale, h_locale))
+
+            dimensioni = {rel: os.path.getsize(sorgenti[rel]) for rel, _, _ in piano}
+            _progresso_inizio("locale → rete", list(dimensioni.items()))
+            info = {rel: (stat_locale, h_locale) for rel, stat_locale, h_locale in piano}
+
+            def copiato(rel):
+                stat_locale, h_locale = info[rel]
+                dst = _percorso_sync("rete", rel)
+                riepilogo["copiati"] += 1
+                riepilogo["byte"] += dimensioni[rel]
+                _progresso_avanza(dimensioni[rel])
+                print("✔ Copiato locale → rete:", rel)
+                st_rete = os.stat(dst)
+                nuovo_rete[rel] = {"size": st_rete.st_size, "mtime": st_rete.st_mtime_ns, "sha256": h_locale}
+                nuovo_locale[rel] = {
+                    "size": stat_locale[0], "mtime": stat_locale[1],
+                    "mtime_rete": st_rete.st_mtime_ns, "sha256": h_locale,
+                }
+
+            lavori = [(rel, sorgenti[rel], _percorso_sync("rete", rel)) for rel, _, _ in piano]
+            falliti = trasferisci(lavori, copiato)
+            riepilogo["falliti"] = len(falliti)
+            if any(rel == "compendio_norme.db" for rel, _ in falliti):
+                firma = ""  # DB non inviato: resta fra le modifiche in sospeso
+            if sorgenti.get("compendio_norme.db", "").endswith(".snapshot"):
+                os.remove(sorgenti["compendio_norme.db"])
+
+            # PDF eliminati in locale dopo l'ultima sincronizzazione
+            usati = _pdf_archivio_usati()
+            for rel in set(ultimo) - set(locale):
+                if not rel.startswith(SYNC_ELIMINABILI) or rel not in rete:
+                    continue
+                if _hash_dal_nome(rel) not in usati and not _cambiato_in_rete(rel, rete[rel], manifest_rete, ultimo):
+                    os.remove(_percorso_sync("rete", rel))
+                    riepilogo["eliminati"] += 1
+                    print("✔ Eliminato in rete (rimosso in locale):", rel)
+                else:
+                    nuovo_rete[rel] = manifest_rete.get(rel) or {}
+
+            # file presenti solo in rete (es. caricati da altri): restano nel manifest
+            for rel in set(rete) - set(locale) - set(ultimo):
+                if rel in manifest_rete:
+                    nuovo_rete[rel] = manifest_rete[rel]
+
+            _salva_manifest(manifest_rete_path, nuovo_rete)
+            _salva_manifest(manifest_locale, nuovo_locale, firma=firma)
+            ULTIMO_SYNC["locale → rete"] = riepilogo
+            _progresso_fine("parziale" if riepilogo["falliti"] else "ok", riepilogo)
+            _stampa_riepilogo("locale → rete", riepilogo)
+            print("✔ Sincronizzazione locale → rete completata.")
+            return True
+        except Exception as e:
+            _progresso_fine("errore", errore=str(e))
+            print("❌ Errore sync locale → rete:", e)
+            return False
+
+
+# ----------------------------------------------------------
+# Sincronizzazione in background
+# ----------------------------------------------------------
+SYNC_INTERVALLO = 300  # secondi tra due cicli automatici
+_sync_stop = threading.Event()
+_sync_richiesta = threading.Event()
+
+
+def ciclo_sync():
+    """Un ciclo: invia le modifiche locali (con il lock di rete) oppure
+    aggiorna la copia locale da rete."""
+    if not verifica_rete():
         return False
+    if HAS_WRITE_LOCK or modifiche_da_inviare():
+        # titolare "sync": il rilascio non toglie il lock all'utente né viceversa
+        if not acquire_lock("sync"):
+            print("⚠ Modifiche locali in attesa: lock di rete occupato, invio rinviato.")
+            return False
+        try:
+            return sync_to_network()
+        finally:
+            release_lock("sync")
+    return sync_from_network()
+
+
+def _worker_sync():
+    while not _sync_stop.is_set():
+        try:
+            ciclo_sync()
+        except Exception:
+            traceback.print_exc()
+        _sync_richiesta.wait(SYNC_INTERVALLO)
+        _sync_richiesta.clear()
+
+
+def avvia_sync_in_background():
+    threading.Thread(target=_worker_sync, name="sync-rete", daemon=True).start()
+
+
+def richiedi_sync():
+    """Anticipa il prossimo ciclo del worker."""
+    _sync_richiesta.set()
+
+
+def ferma_sync():
+    _sync_stop.set()
+    _sync_richiesta.set()
 
 # ============================================================
 #  LOCK PER SINGOLO ATTO (record-lock)
@@ -202,10 +798,27 @@ def save_conflicts(conflicts):
     with open(CONFLICTS_FILE, "w", encoding="utf-8") as f:
         json.dump(conflicts, f, indent=2, ensure_ascii=False)
 
+
+def chiave_conflitto(riga):
+    """Chiave di un conflitto: i valori di CHIAVE_NORME uniti da "::"."""
+    return "::".join(str(riga[col] if riga[col] is not None else "") for col in CHIAVE_NORME)
+
+
+def valori_chiave_conflitto(conf):
+    """Valori di CHIAVE_NORME di un conflitto. Le chiavi salvate dalle versioni
+    precedenti (anno::numero::tipologia::fonte) non hanno l'argomento: lo
+    prende dalla riga locale, quella presente nel DB."""
+    parti = conf["key"].split("::")
+    if len(parti) == len(CHIAVE_NORME):
+        return tuple(parti)
+    anno, numero, tipologia, fonte = parti
+    return anno, numero, tipologia, fonte, conf["local"].get("argomento") or ""
+
+
 def add_conflict(key, local_row, network_row):
     """
     Aggiunge un nuovo conflitto nel file:
-    key = "anno::numero::tipologia::fonte"
+    key = chiave_conflitto(riga), es. "anno::numero::tipologia::fonte::argomento"
     """
     conflicts = load_conflicts()
     conflicts.append({
@@ -254,58 +867,291 @@ DATA_DIR = NETWORK_DATA_DIR
 # - la cartella di rete viene usata solo per la sincronizzazione
 DB_FILE = LOCAL_DB
 EXCEL_FILE = LOCAL_EXCEL
-PDF_FOLDER = os.path.join(BASE_DIR, "static", "pdf")
+PDF_FOLDER = os.path.join(BASE_DIR, "static", "pdf")  # cartella d'ingresso (vedi ARCHIVIO DEI PDF)
+PDF_ARCHIVIO_DIR = os.path.join(LOCAL_DATA_DIR, "pdf_archivio")  # PDF per contenuto: <sha256>.pdf
 BACKUP_DIR = os.path.join(LOCAL_DATA_DIR, "backup")
 
 # il log può restare locale a ogni PC
 LOG_FILE = os.path.join(BASE_DIR, "app.log")
 
 os.makedirs(PDF_FOLDER, exist_ok=True)
+os.makedirs(PDF_ARCHIVIO_DIR, exist_ok=True)
 os.makedirs(BACKUP_DIR, exist_ok=True)
 
 ALLOWED_EXTENSIONS = {"pdf"}
 
+# ==========================================================
+# 🗄️ CONNESSIONI SQLITE (riutilizzate, WAL + pragma)
+# ==========================================================
+# Ogni richiesta prende al massimo una connessione di scrittura e una di
+# sola lettura dal pool; a fine richiesta (teardown) tornano nel pool.
+# Fuori da una richiesta (avvio, thread in background) la connessione è
+# legata al thread corrente; i thread in background lavorano dentro
+# `with uso_db():` così la sostituzione del file (sync) li attende.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",     # ~16 MB di cache pagine
+    "PRAGMA mmap_size = 134217728",   # 128 MB mappati in memoria
+    "PRAGMA temp_store = MEMORY",
+)
+DB_POOL_MAX = 8
+
+
+class _PooledConnection(sqlite3.Connection):
+    """Connessione con i metadati necessari al pool."""
+    readonly = False
+    generazione = 0
+
+
+_db_pool_lock = threading.Lock()
+_db_pool = {False: [], True: []}
+_db_generazione = 0
+_db_thread = threading.local()
+_db_thread_conns = set()  # connessioni legate ai thread, da chiudere al cambio file
+
+# "Cancello" del file DB: le richieste e i thread in background entrano in
+# modo condiviso; db_esclusivo() attende che escano tutti e blocca i nuovi.
+_db_gate = threading.Condition()
+_db_utilizzi = 0
+_db_bloccato = False
+
+
+def _entra_db():
+    global _db_utilizzi
+    with _db_gate:
+        while _db_bloccato:
+            _db_gate.wait()
+        _db_utilizzi += 1
+
+
+def _esci_db():
+    global _db_utilizzi
+    with _db_gate:
+        _db_utilizzi -= 1
+        _db_gate.notify_all()
+
+
+@contextmanager
+def uso_db():
+    """Uso condiviso del DB per i thread in background."""
+    if has_app_context():
+        # in una richiesta il cancello è già preso da get_db fino al teardown:
+        # rientrarvi potrebbe attendere un db_esclusivo() che attende la richiesta
+        get_db()
+        yield
+        return
+    _entra_db()
+    try:
+        yield
+    finally:
+        _esci_db()
+
+
+@contextmanager
+def db_esclusivo():
+    """Accesso esclusivo al file del DB (nessuna richiesta in corso)."""
+    global _db_bloccato
+    with _db_gate:
+        while _db_bloccato:
+            _db_gate.wait()
+        _db_bloccato = True
+        while _db_utilizzi:
+            _db_gate.wait()
+    try:
+        yield
+    finally:
+        with _db_gate:
+            _db_bloccato = False
+            _db_gate.notify_all()
+
+
+def _apri_connessione(readonly=False):
+    conn = sqlite3.connect(DB_FILE, timeout=10, check_same_thread=False,
+                           factory=_PooledConnection)
+    conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    conn.create_function("audit_comprimi", 1, comprimi_dettagli, deterministic=True)
+    conn.readonly = readonly
+    conn.generazione = _db_generazione
+    return conn
+
+
+def _preleva_connessione(readonly):
+    with _db_pool_lock:
+        pool = _db_pool[readonly]
+        while pool:
+            conn = pool.pop()
+            if conn.generazione == _db_generazione:
+                return conn
+            conn.close()
+    return _apri_connessione(readonly)
+
+
+def _restituisci_connessione(conn):
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        conn.close()
+        return
+    with _db_pool_lock:
+        pool = _db_pool[conn.readonly]
+        if conn.generazione == _db_generazione and len(pool) < DB_POOL_MAX:
+            pool.append(conn)
+            return
+    conn.close()
+
+
+def get_db(readonly=False):
+    """Restituisce la connessione SQLite della richiesta (o del thread).
+    readonly=True → connessione con PRAGMA query_only, per le route GET."""
+    key = "db_ro" if readonly else "db_rw"
+    if has_app_context():
+        conn = g.get(key)
+        if conn is None:
+            if not g.get("db_gate"):
+                _entra_db()
+                g.db_gate = True
+            conn = _preleva_connessione(readonly)
+            setattr(g, key, conn)
+        return conn
+    conn = getattr(_db_thread, key, None)
+    if conn is None or conn.generazione != _db_generazione:
+        if conn is not None:
+            conn.close()
+        conn = _apri_connessione(readonly)
+        setattr(_db_thread, key, conn)
+        with _db_pool_lock:
+            _db_thread_conns.add(conn)
+    return conn
+
+
+def chiudi_connessioni():
+    """Chiude le connessioni inattive e invalida quelle in uso.
+    Da chiamare (dentro db_esclusivo) prima di sostituire il file del database."""
+    global _db_generazione
+    with _db_pool_lock:
+        _db_generazione += 1
+        idle = _db_pool[False] + _db_pool[True] + list(_db_thread_conns)
+        _db_pool[False].clear()
+        _db_pool[True].clear()
+        _db_thread_conns.clear()
+    for conn in idle:
+        conn.close()
+
+
+@app.teardown_appcontext
+def rilascia_connessioni(exc):
+    for key in ("db_rw", "db_ro"):
+        conn = g.pop(key, None)
+        if conn is not None:
+            _restituisci_connessione(conn)
+    if g.pop("db_gate", False):
+        _esci_db()
+
+
 # ==========================================================
 # 🔒 GESTIONE LOCK DI RETE (un solo "scrivente" alla volta)
 # ==========================================================
 LOCK_FILE = os.path.join(DATA_DIR, "compendio.lock")
 HAS_WRITE_LOCK = False  # questa istanza può scrivere?
+# Il lock è condiviso tra l'utente (dall'apertura del form al salvataggio) e
+# il thread di sincronizzazione: ognuno lo prende e lo rilascia a nome suo e
+# il file si elimina solo quando nessun titolare lo tiene più e nessuna
+# richiesta di scrittura è in corso.
+_lock_rete = threading.Lock()
+_titolari_lock = set()      # "utente", "sync"
+_scritture_in_corso = 0     # richieste di require_write_lock in esecuzione
+_lock_file_nostro = False   # LOCK_FILE creato da questa istanza (non offline)
+
+
+def acquire_lock(titolare="utente"):
+    """Prova a creare il file di lock sulla cartella dati di rete; se questa
+    istanza lo ha già, aggiunge `titolare` a chi lo tiene."""
+    global HAS_WRITE_LOCK, _lock_file_nostro
+    with _lock_rete:
+        if HAS_WRITE_LOCK:
+            _titolari_lock.add(titolare)
+            return True
+        if os.path.exists(LOCK_FILE):
+            return False
+        try:
+            info = (
+                f"PC={os.environ.get('COMPUTERNAME', 'Sconosciuto')}; "
+                f"USER={os.environ.get('USERNAME', 'Sconosciuto')}; "
+                f"TS={datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            )
+            with open(LOCK_FILE, "w", encoding="utf-8") as f:
+                f.write(info)
+            HAS_WRITE_LOCK = _lock_file_nostro = True
+            _titolari_lock.add(titolare)
+            print(f"🔒 Lock acquisito: {info}")
+            return True
+        except Exception as e:
+            print(f"⚠️ Impossibile creare il lock: {e}")
+            return False
 
-def acquire_lock():
-    """Prova a creare il file di lock sulla cartella dati di rete."""
+
+def acquire_lock_offline(titolare="utente"):
+    """Offline: scrittura sulla copia locale, senza file di lock di rete."""
     global HAS_WRITE_LOCK
-    if os.path.exists(LOCK_FILE):
-        HAS_WRITE_LOCK = False
-        return False
-    try:
-        info = (
-            f"PC={os.environ.get('COMPUTERNAME', 'Sconosciuto')}; "
-            f"USER={os.environ.get('USERNAME', 'Sconosciuto')}; "
-            f"TS={datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        )
-        with open(LOCK_FILE, "w", encoding="utf-8") as f:
-            f.write(info)
+    with _lock_rete:
         HAS_WRITE_LOCK = True
-        print(f"🔒 Lock acquisito: {info}")
-        return True
-    except Exception as e:
-        print(f"⚠️ Impossibile creare il lock: {e}")
-        HAS_WRITE_LOCK = False
-        return False
+        _titolari_lock.add(titolare)
 
-def release_lock():
-    """Rimuove il lock se questa istanza lo ha acquisito."""
-    global HAS_WRITE_LOCK
-    if HAS_WRITE_LOCK and os.path.exists(LOCK_FILE):
+
+def _rilascia_se_libero():
+    # da chiamare con _lock_rete preso
+    global HAS_WRITE_LOCK, _lock_file_nostro
+    if _titolari_lock or _scritture_in_corso:
+        return
+    if _lock_file_nostro and os.path.exists(LOCK_FILE):
         try:
             os.remove(LOCK_FILE)
             print("🔓 Lock rilasciato.")
         except Exception as e:
             print(f"⚠️ Impossibile rimuovere il lock: {e}")
-    HAS_WRITE_LOCK = False
+    HAS_WRITE_LOCK = _lock_file_nostro = False
+
+
+def release_lock(titolare="utente"):
+    """Rilascia il lock a nome di `titolare`; il file di lock viene rimosso
+    solo se nessun altro lo tiene."""
+    with _lock_rete:
+        _titolari_lock.discard(titolare)
+        _rilascia_se_libero()
+
+
+@contextmanager
+def scrittura_in_corso():
+    """Durante una richiesta di scrittura il file di lock non si rimuove."""
+    global _scritture_in_corso
+    with _lock_rete:
+        _scritture_in_corso += 1
+    try:
+        yield
+    finally:
+        with _lock_rete:
+            _scritture_in_corso -= 1
+            _rilascia_se_libero()
+
+
+def rilascia_tutti_i_lock():
+    """Alla chiusura del processo: il lock viene rimosso comunque."""
+    global _scritture_in_corso
+    with _lock_rete:
+        _titolari_lock.clear()
+        _scritture_in_corso = 0
+        _rilascia_se_libero()
+
 
 # rilascio automatico del lock alla chiusura del processo
-atexit.register(release_lock)
+atexit.register(rilascia_tutti_i_lock)
+
 
 # ==========================================================
 # 🛰️ sonda di avvio (per loading/launcher)
@@ -320,18 +1166,63 @@ def boot_ready_js():
         if not os.path.exists(DB_FILE):
             ok = False
         else:
-            con = sqlite3.connect(DB_FILE)
-            con.execute("SELECT 1")
-            con.close()
+            get_db(readonly=True).execute("SELECT 1")
     except Exception:
         ok = False
 
-    js = f"window.__COMPENDIO_READY__ = {str(ok).lower()};"
+    # la sincronizzazione gira in background: la copia locale è già servibile
+    js = (
+        f"window.__COMPENDIO_READY__ = {str(ok).lower()};"
+        f"window.__COMPENDIO_SYNC__ = {json.dumps(stato_sync())};"
+    )
     resp = make_response(js, 200)
     resp.mimetype = "application/javascript"
     resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     return resp
 
+
+# ==========================================================
+# 🔄 STATO SINCRONIZZAZIONE (polling JSON o Server-Sent Events)
+# ==========================================================
+@app.get("/sync/stato")
+def sync_stato():
+    resp = jsonify(stato_sync())
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.get("/sync/eventi")
+def sync_eventi():
+    def genera():
+        while True:
+            stato = stato_sync()
+            yield f"data: {json.dumps(stato)}\n\n"
+            if not stato["in_corso"]:
+                break
+            time.sleep(0.5)
+
+    resp = app.response_class(genera(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.get("/rete/stato")
+def rete_stato():
+    resp = jsonify(stato_rete())
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.post("/sync/avvia")
+def sync_avvia():
+    if not session.get("admin"):
+        flash("⚠️ Accesso non autorizzato.", "warning")
+        return redirect(url_for("admin_login"))
+    richiedi_sync()
+    flash("🔄 Sincronizzazione avviata in background.", "info")
+    return redirect(request.referrer or url_for("admin_dashboard"))
+
+
 # ==========================================================
 # 🔧 .env e password amministratore
 # ==========================================================
@@ -422,6 +1313,7 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def backup_excel():
+    svuota_specchio_excel()
     if not os.path.exists(EXCEL_FILE):
         return
     timestamp = datetime.now().strftime("%Y%m%d_%H%M")
@@ -430,13 +1322,26 @@ def backup_excel():
     shutil.copy2(EXCEL_FILE, backup_path)
     print(f"✅ Backup Excel: {backup_path}")
 
-def backup_pdf():
-    if not os.path.exists(PDF_FOLDER):
-        return
+
+def backup_pdf(conn):
+    """Backup incrementale dell'archivio PDF: in BACKUP_DIR/pdf_archivio si
+    copiano solo i contenuti che non ci sono già (basta il nome, che è lo
+    sha256) e Compendio_backup_<data>.json registra nome → sha256."""
+    dest = os.path.join(BACKUP_DIR, "pdf_archivio")
+    os.makedirs(dest, exist_ok=True)
+    presenti = set(os.listdir(dest))
+    copiati = 0
+    for nome in os.listdir(PDF_ARCHIVIO_DIR):
+        if _NOME_BLOB.fullmatch(nome) and nome not in presenti:
+            copia_atomica(os.path.join(PDF_ARCHIVIO_DIR, nome), os.path.join(dest, nome))
+            copiati += 1
     timestamp = datetime.now().strftime("%Y%m%d_%H%M")
-    dest = os.path.join(BACKUP_DIR, f"Compendio_backup_{timestamp}")
-    shutil.copytree(PDF_FOLDER, dest)
-    print(f"✅ Backup PDF in {dest}")
+    indice = os.path.join(BACKUP_DIR, f"Compendio_backup_{timestamp}.json")
+    nomi = {nome: sha256 for nome, sha256 in conn.execute("SELECT nome, sha256 FROM pdf_files ORDER BY nome")}
+    with open(indice, "w", encoding="utf-8") as f:
+        json.dump(nomi, f, ensure_ascii=False, indent=1)
+    print(f"✅ Backup PDF: {copiati} contenuti nuovi in {dest}, indice {indice}")
+
 
 def client_meta():
     # IP (anche dietro proxy)
@@ -445,64 +1350,1294 @@ def client_meta():
     ua = request.headers.get("User-Agent", "")
     return ip, ua
 
+
+# ----------------------------------------------------------
+# Audit: coda in memoria + scrittore in background a lotti
+# ----------------------------------------------------------
+# La richiesta accoda l'evento e prosegue; un thread lo scrive insieme agli
+# altri arrivati nel frattempo, in una sola transazione (un solo fsync).
+AUDIT_CODA_MAX = 5000     # oltre, log_event attende (backpressure)
+AUDIT_LOTTO_MAX = 200     # eventi per transazione
+AUDIT_INTERVALLO = 0.25   # secondi massimi di attesa per completare un lotto
+AUDIT_ATTESA_CODA = 5     # secondi di attesa con coda piena, poi scrittura diretta
+AUDIT_TENTATIVI = 3       # scritture del lotto prima di passare evento per evento
+AUDIT_ATTESA_RIPROVA = 0.5  # secondi tra un tentativo e il successivo (crescente)
+_coda_audit = queue.Queue(maxsize=AUDIT_CODA_MAX)
+_scrittore_audit_avviato = threading.Event()
+
+
+def _scrivi_audit(lotto):
+    with uso_db():
+        conn = get_db()
+        conn.executemany("""
+            INSERT INTO audit (action, norma_id, actor, ip, user_agent, details, ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, lotto)
+        conn.commit()
+
+
+def _scrivi_lotto_audit(lotto):
+    """Scrive il lotto riprovando (es. DB bloccato da un import); se continua
+    a fallire scrive gli eventi uno per uno, così un evento non valido o un
+    errore persistente non fanno perdere tutto il lotto. Ritorna gli eventi
+    non scritti."""
+    for tentativo in range(AUDIT_TENTATIVI):
+        try:
+            _scrivi_audit(lotto)
+            return []
+        except Exception as e:
+            print(f"⚠️ Audit: lotto di {len(lotto)} eventi non scritto "
+                  f"(tentativo {tentativo + 1}/{AUDIT_TENTATIVI}): {e}")
+            time.sleep(AUDIT_ATTESA_RIPROVA * (tentativo + 1))
+    persi = []
+    for evento in lotto:
+        try:
+            _scrivi_audit([evento])
+        except Exception:
+            persi.append(evento)
+    if persi:
+        print(f"❌ Audit: {len(persi)} eventi non scritti:")
+        for evento in persi:
+            print("   ", evento)
+    return persi
+
+
+def _worker_audit():
+    while True:
+        lotto = [_coda_audit.get()]
+        scadenza = time.monotonic() + AUDIT_INTERVALLO
+        while len(lotto) < AUDIT_LOTTO_MAX:
+            resto = scadenza - time.monotonic()
+            if resto <= 0:
+                break
+            try:
+                lotto.append(_coda_audit.get(timeout=resto))
+            except queue.Empty:
+                break
+        try:
+            _scrivi_lotto_audit(lotto)
+        except Exception:
+            traceback.print_exc()
+        for _ in lotto:
+            _coda_audit.task_done()
+
+
+def _avvia_scrittore_audit():
+    if not _scrittore_audit_avviato.is_set():
+        _scrittore_audit_avviato.set()
+        threading.Thread(target=_worker_audit, name="audit", daemon=True).start()
+
+
+def svuota_audit(timeout=10):
+    """Attende che gli eventi in coda siano scritti (anche alla chiusura)."""
+    fine = time.monotonic() + timeout
+    while _coda_audit.unfinished_tasks and time.monotonic() < fine:
+        time.sleep(0.02)
+
+
+atexit.register(svuota_audit)
+
+# ----------------------------------------------------------
+# Archiviazione audit: file mensili
+# ----------------------------------------------------------
+# Gli eventi più vecchi di AUDIT_CONSERVAZIONE_GIORNI passano da `audit` a
+# audit_archivio/audit_AAAA-MM.db, così il DB da sincronizzare non cresce con
+# la storia. Gli archivi sono normali DB SQLite, non file compressi: è
+# compressa (zlib) solo la colonna dei dettagli, riga per riga, così restano
+# interrogabili con ATTACH + vista audit_leggibile (funzione audit_dettagli).
+# Lo spazio liberato nel DB si restituisce con PRAGMA incremental_vacuum
+# (auto_vacuum = INCREMENTAL dalla migrazione 11), non con un VACUUM che
+# riscriverebbe tutto il file bloccando le scritture.
+AUDIT_CONSERVAZIONE_GIORNI = int(os.getenv("COMPENDIO_AUDIT_GIORNI", "365"))
+AUDIT_ARCHIVIO_OGNI = 24 * 3600  # secondi tra due archiviazioni automatiche
+_ultima_archiviazione = 0.0
+
+
+def comprimi_dettagli(testo):
+    return zlib.compress(testo.encode("utf-8"), 9) if testo else None
+
+
+def decomprimi_dettagli(blob):
+    return zlib.decompress(blob).decode("utf-8") if blob else ""
+
+
+def percorso_archivio_audit(mese):
+    """Archivio del mese 'AAAA-MM'."""
+    return os.path.join(AUDIT_ARCHIVIO_DIR, f"audit_{mese}.db")
+
+
+def _crea_schema_archivio(conn, schema):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.audit (
+            id INTEGER PRIMARY KEY,
+            ts TEXT,
+            action TEXT NOT NULL,
+            norma_id INTEGER,
+            actor TEXT,
+            ip TEXT,
+            user_agent TEXT,
+            details_z BLOB
+        )
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_audit_norma ON audit(norma_id, id)")
+    conn.execute(f"""
+        CREATE VIEW IF NOT EXISTS {schema}.audit_leggibile AS
+        SELECT id, ts, action, norma_id, actor, ip, user_agent,
+               audit_dettagli(details_z) AS details
+        FROM audit
+    """)
+
+
+def archivia_audit(giorni=None):
+    """Sposta negli archivi mensili gli eventi più vecchi di `giorni`.
+    Ritorna il numero di eventi spostati."""
+    global _ultima_archiviazione
+    giorni = AUDIT_CONSERVAZIONE_GIORNI if giorni is None else giorni
+    limite = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - giorni * 86400))
+    svuota_audit()
+    os.makedirs(AUDIT_ARCHIVIO_DIR, exist_ok=True)
+    spostati = 0
+    with uso_db():
+        conn = get_db()
+        mesi = [r[0] for r in conn.execute(
+            "SELECT DISTINCT substr(ts, 1, 7) FROM audit WHERE ts < ?", (limite,))]
+        for mese in mesi:
+            conn.execute("ATTACH DATABASE ? AS archivio", (percorso_archivio_audit(mese),))
+            try:
+                _crea_schema_archivio(conn, "archivio")
+                # INSERT OR IGNORE: se un'archiviazione si è interrotta dopo la
+                # copia, la successiva completa solo la cancellazione
+                filtro = "WHERE ts < ? AND substr(ts, 1, 7) = ?"
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO archivio.audit
+                    SELECT id, ts, action, norma_id, actor, ip, user_agent, audit_comprimi(details)
+                    FROM main.audit {filtro}
+                """, (limite, mese))
+                spostati += conn.execute(f"DELETE FROM main.audit {filtro}", (limite, mese)).rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute("DETACH DATABASE archivio")
+        if spostati:
+            # solo le pagine libere: il file da copiare si riduce. executescript
+            # perché execute() farebbe un solo passo (una pagina) del PRAGMA
+            conn.executescript("PRAGMA incremental_vacuum;")
+            print(f"🗄️ Audit: {spostati} eventi archiviati in {len(mesi)} file mensili.")
+    _ultima_archiviazione = time.time()
+    return spostati
+
+
+def archiviazione_dovuta():
+    return time.time() - _ultima_archiviazione >= AUDIT_ARCHIVIO_OGNI
+
+
+def eventi_archiviati(norma_id):
+    """Eventi archiviati di un atto (dal più recente), letti da tutti gli archivi."""
+    eventi = []
+    if not os.path.isdir(AUDIT_ARCHIVIO_DIR):
+        return eventi
+    for fname in sorted(os.listdir(AUDIT_ARCHIVIO_DIR), reverse=True):
+        if not (fname.startswith("audit_") and fname.endswith(".db")):
+            continue
+        path = os.path.join(AUDIT_ARCHIVIO_DIR, fname)
+        arch = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            arch.row_factory = sqlite3.Row
+            arch.create_function("audit_dettagli", 1, decomprimi_dettagli, deterministic=True)
+            eventi.extend(arch.execute(
+                "SELECT * FROM audit_leggibile WHERE norma_id=? ORDER BY id DESC", (norma_id,)))
+        except sqlite3.Error:
+            traceback.print_exc()
+        finally:
+            arch.close()
+    return eventi
+
+
 def log_event(action, norma_id=None, details=None):
-    """Scrive un evento in tabella audit."""
+    """Accoda un evento per la tabella audit (scritto in background)."""
     try:
         ip, ua = client_meta()
         actor = "admin" if session.get("admin") else "anon"
         details_txt = json.dumps(details, ensure_ascii=False) if isinstance(details, (dict, list)) else (details or "")
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO audit (action, norma_id, actor, ip, user_agent, details, ts)
-            VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """, (action, norma_id, actor, ip, ua, details_txt))
-        conn.commit()
+        # stesso formato (UTC) di CURRENT_TIMESTAMP, fissato al momento dell'evento
+        ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        evento = (action, norma_id, actor, ip, ua, details_txt, ts)
+        _avvia_scrittore_audit()
+        try:
+            _coda_audit.put(evento, timeout=AUDIT_ATTESA_CODA)
+        except queue.Full:
+            print("⚠️ Coda audit piena: scrittura diretta.")
+            _scrivi_audit([evento])
+    except Exception:
+        traceback.print_exc()
+
+
+# ==========================================================
+# 🧵 LAVORI IN BACKGROUND (coda persistente su SQLite)
+# ==========================================================
+# Export, backup e import non girano più nella richiesta: la route accoda un
+# lavoro in lavori.db (locale, fuori dalla sincronizzazione) e rimanda a
+# /lavori; i thread della coda lo eseguono registrando avanzamento, esito e
+# file risultato da scaricare. Lo stato resta nel DB: sopravvive al
+# ricaricamento della pagina, e al riavvio i lavori in coda ripartono.
+LAVORI_DB = os.path.join(LOCAL_DATA_DIR, "lavori.db")
+LAVORI_DIR = os.path.join(LOCAL_DATA_DIR, "lavori")  # file caricati e risultati
+LAVORI_THREAD = int(os.getenv("COMPENDIO_LAVORI_THREAD", "2"))
+LAVORI_CONSERVA_GIORNI = 7
+LAVORI_INTERVALLO = 0.5  # secondi minimi tra due scritture dell'avanzamento
+
+TIPI_LAVORO = {}  # tipo → (funzione, scrive_db)
+_coda_lavori = queue.Queue()
+_lavori_avviati = threading.Event()
+_lavori_schema = threading.Event()
+_lavori_scrittura = threading.Lock()  # un solo lavoro alla volta scrive nel DB
+
+
+def tipo_lavoro(nome, scrive_db=False):
+    """Registra l'esecutore dei lavori `nome`: funzione(parametri, avanzamento)
+    che ritorna None o {"file", "nome", "mimetype", "messaggio"}."""
+    def registra(funzione):
+        TIPI_LAVORO[nome] = (funzione, scrive_db)
+        return funzione
+    return registra
+
+
+@contextmanager
+def db_lavori():
+    conn = sqlite3.connect(LAVORI_DB, timeout=10)
+    conn.row_factory = sqlite3.Row
+    try:
+        if not _lavori_schema.is_set():
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS lavori (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tipo TEXT NOT NULL,
+                    descrizione TEXT,
+                    parametri TEXT,
+                    stato TEXT NOT NULL DEFAULT 'in_coda',  -- in_coda, in_corso, completato, errore
+                    fatti INTEGER NOT NULL DEFAULT 0,
+                    totale INTEGER NOT NULL DEFAULT 0,
+                    messaggio TEXT,
+                    file TEXT,
+                    nome_file TEXT,
+                    mimetype TEXT,
+                    creato REAL,
+                    iniziato REAL,
+                    finito REAL
+                )
+            """)
+            _lavori_schema.set()
+        with conn:
+            yield conn
+    finally:
         conn.close()
+
+
+def file_lavoro(nome):
+    """Percorso nuovo in LAVORI_DIR per un file caricato o un risultato."""
+    os.makedirs(LAVORI_DIR, exist_ok=True)
+    return os.path.join(LAVORI_DIR, f"{secrets.token_hex(6)}_{secure_filename(nome)}")
+
+
+def accoda_lavoro(tipo, parametri=None, descrizione=""):
+    """Inserisce il lavoro in coda e ne ritorna l'id (ricordato in sessione,
+    così chi l'ha avviato lo vede in /lavori anche senza essere admin)."""
+    with db_lavori() as conn:
+        lavoro_id = conn.execute(
+            "INSERT INTO lavori (tipo, descrizione, parametri, creato) VALUES (?, ?, ?, ?)",
+            (tipo, descrizione, json.dumps(parametri or {}, ensure_ascii=False), time.time()),
+        ).lastrowid
+    if has_request_context():
+        session["lavori"] = (session.get("lavori") or [])[-49:] + [lavoro_id]
+    avvia_lavori()
+    _coda_lavori.put(lavoro_id)
+    print(f"⏳ Lavoro {lavoro_id} accodato: {descrizione or tipo}")
+    return lavoro_id
+
+
+def _esegui_lavoro(lavoro_id):
+    with db_lavori() as conn:
+        # presa in carico atomica: lo stesso id può trovarsi due volte in coda
+        presi = conn.execute(
+            "UPDATE lavori SET stato = 'in_corso', iniziato = ? WHERE id = ? AND stato = 'in_coda'",
+            (time.time(), lavoro_id),
+        ).rowcount
+        if not presi:
+            return
+        lavoro = conn.execute("SELECT * FROM lavori WHERE id = ?", (lavoro_id,)).fetchone()
+
+    ultimo = [0.0]
+
+    def avanzamento(fatti, totale=None, messaggio=None):
+        # al più una scrittura ogni LAVORI_INTERVALLO, salvo messaggi e fine
+        adesso = time.monotonic()
+        if messaggio is None and fatti != totale and adesso - ultimo[0] < LAVORI_INTERVALLO:
+            return
+        ultimo[0] = adesso
+        with db_lavori() as conn:
+            conn.execute("""
+                UPDATE lavori SET fatti = ?, totale = COALESCE(?, totale),
+                                  messaggio = COALESCE(?, messaggio)
+                WHERE id = ?
+            """, (fatti, totale, messaggio, lavoro_id))
+
+    try:
+        funzione, scrive_db = TIPI_LAVORO[lavoro["tipo"]]
+        with _lavori_scrittura if scrive_db else nullcontext():
+            esito = funzione(json.loads(lavoro["parametri"] or "{}"), avanzamento) or {}
+        with db_lavori() as conn:
+            conn.execute("""
+                UPDATE lavori SET stato = 'completato', finito = ?, messaggio = ?,
+                                  file = ?, nome_file = ?, mimetype = ?
+                WHERE id = ?
+            """, (time.time(), esito.get("messaggio") or "✅ Completato.", esito.get("file"),
+                  esito.get("nome"), esito.get("mimetype"), lavoro_id))
+        print(f"✅ Lavoro {lavoro_id} completato.")
+    except Exception as e:
+        traceback.print_exc()
+        with db_lavori() as conn:
+            conn.execute(
+                "UPDATE lavori SET stato = 'errore', finito = ?, messaggio = ? WHERE id = ?",
+                (time.time(), f"❌ {e}", lavoro_id),
+            )
+
+
+def pota_lavori():
+    """Elimina i lavori finiti da più di LAVORI_CONSERVA_GIORNI e i loro file
+    (solo quelli in LAVORI_DIR: i backup restano in BACKUP_DIR)."""
+    limite = time.time() - LAVORI_CONSERVA_GIORNI * 86400
+    try:
+        with db_lavori() as conn:
+            vecchi = conn.execute("SELECT id, file FROM lavori WHERE finito < ?", (limite,)).fetchall()
+            conn.execute("DELETE FROM lavori WHERE finito < ?", (limite,))
+        for lavoro in vecchi:
+            if lavoro["file"] and os.path.dirname(lavoro["file"]) == LAVORI_DIR and os.path.exists(lavoro["file"]):
+                os.remove(lavoro["file"])
+    except Exception:
+        traceback.print_exc()
+
+
+def _worker_lavori():
+    while True:
+        lavoro_id = _coda_lavori.get()
+        try:
+            _esegui_lavoro(lavoro_id)
+            pota_lavori()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            _coda_lavori.task_done()
+
+
+def avvia_lavori():
+    """Avvia (una volta sola) i thread della coda e riprende i lavori rimasti
+    in coda; quelli interrotti a metà da una chiusura sono segnati in errore."""
+    if _lavori_avviati.is_set():
+        return
+    _lavori_avviati.set()
+    os.makedirs(LAVORI_DIR, exist_ok=True)
+    with db_lavori() as conn:
+        conn.execute("""
+            UPDATE lavori SET stato = 'errore', finito = ?,
+                              messaggio = '❌ Interrotto dalla chiusura del programma.'
+            WHERE stato = 'in_corso'
+        """, (time.time(),))
+        for riga in conn.execute("SELECT id FROM lavori WHERE stato = 'in_coda' ORDER BY id"):
+            _coda_lavori.put(riga["id"])
+    pota_lavori()
+    for i in range(max(1, LAVORI_THREAD)):
+        threading.Thread(target=_worker_lavori, name=f"lavori-{i}", daemon=True).start()
+
+
+def crea_database():
+    conn = get_db()
+    c = conn.cursor()
+    # Tabella norme
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS norme (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            anno TEXT,
+            numero TEXT,
+            tipologia TEXT,
+            categoria TEXT,
+            argomento TEXT,
+            oggetto TEXT,
+            fonte TEXT,
+            filepdf TEXT,
+            descrizione TEXT,
+            stato TEXT,
+            note TEXT
+        )
+    ''')
+    # Tabella audit
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS audit (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT DEFAULT CURRENT_TIMESTAMP,
+            action TEXT NOT NULL,
+            norma_id INTEGER,
+            actor TEXT,
+            ip TEXT,
+            user_agent TEXT,
+            details TEXT
+        )
+    ''')
+    conn.commit()
+    crea_indice_fts(conn)
+    crea_generazione_dati(conn)
+    migra_schema(conn)
+
+
+# ==========================================================
+# 🧱 MIGRAZIONI DI SCHEMA (PRAGMA user_version)
+# ==========================================================
+# Ogni migrazione porta lo schema alla versione indicata; quelle già
+# applicate (user_version >= versione) vengono saltate.
+# Gli indici di `norme` alternano il nome a ogni ricaricamento completo
+# (idx_x ↔ idx_x__r, vedi _nome_indice_ombra): le migrazioni li cercano,
+# creano ed eliminano con entrambi i nomi.
+def nomi_indice(nome):
+    """(nome canonico, nome alternato) di un indice di `norme`."""
+    base = nome[:-len("__r")] if nome.endswith("__r") else nome
+    return base, base + "__r"
+
+
+def _crea_indice(c, sql):
+    # CREATE INDEX IF NOT EXISTS <nome> ...: saltato se esiste con l'uno o l'altro nome
+    nome = re.search(r"INDEX IF NOT EXISTS (\w+)", sql).group(1)
+    if not c.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name IN (?, ?)",
+                     nomi_indice(nome)).fetchone():
+        c.execute(sql)
+
+
+def _elimina_indice(c, nome):
+    for variante in nomi_indice(nome):
+        c.execute(f"DROP INDEX IF EXISTS {variante}")
+
+
+def _migrazione_1_indici(c):
+    _crea_indice(c, "CREATE INDEX IF NOT EXISTS idx_norme_anno_numero ON norme(anno DESC, numero)")
+    _crea_indice(c, "CREATE INDEX IF NOT EXISTS idx_norme_chiave ON norme(anno, numero, tipologia, fonte)")
+    _crea_indice(c, "CREATE INDEX IF NOT EXISTS idx_norme_fonte ON norme(fonte)")
+    _crea_indice(c, "CREATE INDEX IF NOT EXISTS idx_norme_tipologia ON norme(tipologia)")
+    _crea_indice(c, "CREATE INDEX IF NOT EXISTS idx_norme_argomento ON norme(argomento)")
+    _crea_indice(c, "CREATE INDEX IF NOT EXISTS idx_norme_filepdf ON norme(filepdf)")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_audit_norma ON audit(norma_id, id)
+        WHERE norma_id IS NOT NULL
+    """)
+
+
+def _colonne(c, tabella):
+    return {row[1] for row in c.execute(f"PRAGMA table_xinfo({tabella})")}
+
+
+def _migrazione_2_chiavi_numeriche(c):
+    # Colonne generate (VIRTUAL): sempre coerenti con anno/numero, qualunque
+    # sia il programma che scrive sul DB. Vedi chiave_numero() per la logica.
+    esistenti = _colonne(c, "norme")
+    if "anno_n" not in esistenti:
+        c.execute("""
+            ALTER TABLE norme ADD COLUMN anno_n INTEGER
+            GENERATED ALWAYS AS (IFNULL(CAST(TRIM(anno) AS INTEGER), 0)) VIRTUAL
+        """)
+    if "numero_n" not in esistenti:
+        c.execute(f"""
+            ALTER TABLE norme ADD COLUMN numero_n INTEGER
+            GENERATED ALWAYS AS (CASE WHEN TRIM(numero) GLOB '[0-9]*'
+                                      THEN CAST(TRIM(numero) AS INTEGER)
+                                      ELSE {NUMERO_SENZA_VALORE} END) VIRTUAL
+        """)
+    if "numero_suffisso" not in esistenti:
+        c.execute("""
+            ALTER TABLE norme ADD COLUMN numero_suffisso TEXT
+            GENERATED ALWAYS AS (IFNULL(LTRIM(TRIM(numero), '0123456789'), '')) VIRTUAL
+        """)
+    _crea_indice(c, """
+        CREATE INDEX IF NOT EXISTS idx_norme_ordine
+        ON norme(anno_n DESC, numero_n, numero_suffisso)
+    """)
+
+
+def _migrazione_3_indici_audit(c):
+    # filtri della consultazione audit, tutti con paginazione per id
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_action ON audit(action, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_actor ON audit(actor, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_ip ON audit(ip, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_ts ON audit(ts)")
+
+
+def _migrazione_4_chiave_unica(c):
+    # CHIAVE_NORME diventa UNIQUE per gli upsert dell'import Excel. Dei
+    # doppioni esistenti resta in `norme` la riga con id minore; le altre
+    # passano, con il loro id, nella tabella norme_doppioni (nulla viene
+    # cancellato) e l'admin le riconcilia da /admin/conflitti. Le chiavi con
+    # valori NULL non violano l'indice UNIQUE e restano come sono.
+    colonne = ", ".join(COLONNE_NORME)
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS norme_doppioni (
+            id INTEGER PRIMARY KEY,  -- id originale in norme
+            tenuta_id INTEGER NOT NULL,
+            {", ".join(f"{col} TEXT" for col in COLONNE_NORME)},
+            ts TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    chiave = ", ".join(CHIAVE_NORME)
+    stessa_chiave = " AND ".join(f"d.{col} = t.{col}" for col in CHIAVE_NORME)
+    spostati = c.execute(f"""
+        INSERT INTO norme_doppioni (id, tenuta_id, {colonne})
+        SELECT d.id, t.id, {", ".join(f"d.{col}" for col in COLONNE_NORME)}
+        FROM norme AS d
+        JOIN (SELECT MIN(id) AS id, {chiave} FROM norme
+              WHERE {" AND ".join(f"{col} IS NOT NULL" for col in CHIAVE_NORME)}
+              GROUP BY {chiave} HAVING COUNT(*) > 1) AS t
+          ON {stessa_chiave} AND d.id > t.id
+    """).rowcount
+    if spostati:
+        c.execute("DELETE FROM norme WHERE id IN (SELECT id FROM norme_doppioni)")
+        print(f"⚠️ {spostati} atti duplicati spostati in norme_doppioni: vedi /admin/conflitti.")
+    _crea_indice(c, f"CREATE UNIQUE INDEX IF NOT EXISTS uq_norme_chiave ON norme({chiave})")
+    _elimina_indice(c, "idx_norme_chiave")  # coperto da uq_norme_chiave
+
+
+def sql_trigger_hash():
+    # hash del contenuto per riga (vedi hash_righe), scritto dall'import Excel;
+    # qualunque altra modifica dei campi lo azzera e verrà ricalcolato.
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS norme_hash_au AFTER UPDATE OF {", ".join(COLONNE_NORME)} ON norme
+        WHEN new.hash_riga IS old.hash_riga BEGIN
+            UPDATE norme SET hash_riga = NULL WHERE id = new.id;
+        END
+    """
+
+
+def _migrazione_5_hash_righe(c):
+    if "hash_riga" not in _colonne(c, "norme"):
+        c.execute("ALTER TABLE norme ADD COLUMN hash_riga INTEGER")
+    c.execute(sql_trigger_hash())
+    # il trigger FTS ignora gli aggiornamenti del solo hash
+    if c.execute("SELECT 1 FROM sqlite_master WHERE name = 'norme_fts'").fetchone():
+        c.execute("DROP TRIGGER IF EXISTS norme_fts_au")
+        crea_indice_fts(c.connection)
+
+
+def _migrazione_6_indice_pdf(c):
+    # riempita dalla prima riconciliazione con la cartella (riconcilia_pdf)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS pdf_files (
+            nome TEXT PRIMARY KEY,
+            dimensione INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,  -- st_mtime_ns
+            sha256 TEXT NOT NULL,
+            norma_id INTEGER
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pdf_files_orfani ON pdf_files(nome) WHERE norma_id IS NULL")
+    for sql in sql_trigger_pdf():
+        c.execute(sql)
+
+
+def _migrazione_7_archivio_pdf(c):
+    # contenuti presenti in PDF_ARCHIVIO_DIR, riempita da riconcilia_pdf (che
+    # vi sposta anche i PDF salvati per nome dalle versioni precedenti)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS pdf_blob (
+            sha256 TEXT PRIMARY KEY,
+            dimensione INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pdf_files_sha256 ON pdf_files(sha256)")
+
+
+def _migrazione_8_generazione_senza_trigger(c):
+    # il contatore lo incrementano le scritture (incrementa_generazione),
+    # una volta per transazione invece che un trigger per ogni riga
+    for nome in ("ai", "ad", "au"):
+        c.execute(f"DROP TRIGGER IF EXISTS norme_gen_{nome}")
+
+
+def _migrazione_9_indice_filepdf(c):
+    # l'indice parziale (WHERE TRIM(filepdf) <> '') serviva solo alle query
+    # che ripetevano lo stesso predicato: quello semplice serve a tutte
+    _elimina_indice(c, "idx_norme_filepdf")
+    c.execute("CREATE INDEX idx_norme_filepdf ON norme(filepdf)")
+
+
+def _migrazione_10_hash_blake2b(c):
+    # hash_riga ora è BLAKE2b (hash_riga()), non più l'hash di pandas che può
+    # cambiare tra versioni: si azzera e lo ricalcola aggiorna_hash_mancanti
+    # (il trigger norme_hash_au non scatta, hash_riga non è tra le sue colonne)
+    c.execute("UPDATE norme SET hash_riga = NULL WHERE hash_riga IS NOT NULL")
+
+
+def _migrazione_11_auto_vacuum(c):
+    # auto_vacuum si può cambiare su un DB esistente solo con un VACUUM: fatto
+    # qui una volta (avvio o DB appena scaricato), poi archivia_audit usa
+    # PRAGMA incremental_vacuum. Nessuna transazione aperta: VACUUM non vi gira.
+    c.connection.commit()
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.execute("VACUUM")
+
+
+MIGRAZIONI = [
+    (1, _migrazione_1_indici),
+    (2, _migrazione_2_chiavi_numeriche),
+    (3, _migrazione_3_indici_audit),
+    (4, _migrazione_4_chiave_unica),
+    (5, _migrazione_5_hash_righe),
+    (6, _migrazione_6_indice_pdf),
+    (7, _migrazione_7_archivio_pdf),
+    (8, _migrazione_8_generazione_senza_trigger),
+    (9, _migrazione_9_indice_filepdf),
+    (10, _migrazione_10_hash_blake2b),
+    (11, _migrazione_11_auto_vacuum),
+]
+SCHEMA_VERSIONE = MIGRAZIONI[-1][0]
+
+
+def backup_prima_migrazione(conn, versione):
+    """Copia del DB in BACKUP_DIR prima di migrarlo (solo se contiene atti):
+    le migrazioni possono spostare righe, es. i doppioni della migrazione 4."""
+    if not conn.execute("SELECT 1 FROM norme LIMIT 1").fetchone():
+        return None
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    dst = _copia_db(conn, os.path.join(BACKUP_DIR, f"compendio_norme_schema{versione}_{timestamp}.db"))
+    print(f"💾 Backup prima della migrazione dello schema: {dst}")
+    return dst
+
+
+def migra_schema(conn):
+    """Applica le migrazioni mancanti e aggiorna le statistiche (ANALYZE)."""
+    versione = conn.execute("PRAGMA user_version").fetchone()[0]
+    if versione >= SCHEMA_VERSIONE:
+        return versione
+    conn.commit()
+    try:
+        backup_prima_migrazione(conn, versione)
     except Exception:
+        # senza copia di sicurezza non si tocca lo schema
         traceback.print_exc()
+        return versione
+    c = conn.cursor()
+    for numero, migrazione in MIGRAZIONI:
+        if numero <= versione:
+            continue
+        try:
+            migrazione(c)
+            c.execute(f"PRAGMA user_version = {numero}")
+            conn.commit()
+            print(f"✅ Migrazione schema {numero} applicata.")
+        except Exception:
+            conn.rollback()
+            traceback.print_exc()
+            return versione
+        versione = numero
+    c.execute("ANALYZE")
+    conn.commit()
+    return versione
+
+
+# Query principali che devono restare servite da un indice (controllate
+# con EXPLAIN QUERY PLAN da verifica_integrita).
+QUERY_INDICIZZATE = {
+    "anno+numero": ("SELECT id FROM norme WHERE anno=? AND numero=?", ("", "")),
+    "anno+numero+tipologia+fonte": (
+        "SELECT id FROM norme WHERE anno=? AND numero=? AND tipologia=? AND fonte=?", ("", "", "", "")),
+    "fonte": ("SELECT id FROM norme WHERE fonte=?", ("",)),
+    "tipologia": ("SELECT id FROM norme WHERE tipologia=?", ("",)),
+    "filepdf": ("SELECT id FROM norme WHERE filepdf=?", ("",)),
+    "filepdf citato": ("SELECT MIN(id) FROM norme WHERE filepdf=? AND TRIM(filepdf) <> ''", ("",)),
+    "indice PDF per nome": ("SELECT 1 FROM pdf_files WHERE nome=?", ("",)),
+    "PDF orfani": ("SELECT nome FROM pdf_files WHERE norma_id IS NULL", ()),
+    "PDF per contenuto": ("SELECT 1 FROM pdf_files WHERE sha256=?", ("",)),
+    "audit per atto": ("SELECT * FROM audit WHERE norma_id=? ORDER BY id DESC", (0,)),
+    "audit per azione": ("SELECT * FROM audit WHERE action=? AND id < ? ORDER BY id DESC", ("", 0)),
+    "audit per utente": ("SELECT * FROM audit WHERE actor=? ORDER BY id DESC", ("",)),
+    "audit per IP": ("SELECT * FROM audit WHERE ip=? ORDER BY id DESC", ("",)),
+    "audit per data": ("SELECT * FROM audit WHERE ts >= ? AND ts < ?", ("", "")),
+    "intervallo anni": ("SELECT id FROM norme WHERE anno_n BETWEEN ? AND ?", (2000, 2020)),
+    "anno+numero esatti": (
+        "SELECT id FROM norme WHERE anno_n=? AND numero_n=? AND numero_suffisso=?", (2020, 1, "")),
+}
+
+
+def passo_indicizzato(passo, indici_parziali):
+    """True se un passo SCAN/SEARCH del piano usa un indice: una SEARCH
+    (USING INDEX / PRIMARY KEY), oppure la scansione di un indice parziale,
+    che legge solo le righe che ne soddisfano il WHERE. "SCAN norme USING
+    COVERING INDEX …" è una scansione completa e non conta."""
+    if passo.startswith("SEARCH ") and " USING " in passo:
+        return True
+    m = re.match(r"SCAN \w+ USING (?:COVERING )?INDEX (\w+)", passo)
+    return bool(m) and m.group(1) in indici_parziali
+
+
+def query_senza_indice(conn):
+    """Nomi (con piano) delle QUERY_INDICIZZATE che scandiscono una tabella."""
+    parziali = {nome for nome, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'")
+                if sql and " WHERE " in " ".join(sql.upper().split())}
+    lente = []
+    for nome, (sql, params) in QUERY_INDICIZZATE.items():
+        passi = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)
+                 if r[3].startswith(("SCAN ", "SEARCH "))]
+        if not all(passo_indicizzato(passo, parziali) for passo in passi):
+            lente.append(f"{nome} ({' | '.join(passi)})")
+    return lente
+
+
+# ==========================================================
+# 📑 ARCHIVIO DEI PDF PER CONTENUTO (tabelle pdf_files e pdf_blob)
+# ==========================================================
+# Ogni PDF è salvato una sola volta in PDF_ARCHIVIO_DIR come <sha256>.pdf.
+# pdf_files associa ai nomi logici (i valori di norme.filepdf) lo sha256 del
+# contenuto e l'atto che li cita (norma_id, tenuto allineato dai trigger su
+# norme); pdf_blob elenca i contenuti presenti in archivio. Lo stesso
+# documento caricato con due nomi occupa un solo file, un upload non può
+# sovrascrivere il PDF di un altro atto (nome_pdf_caricato) e sync e backup
+# saltano un PDF già presente dall'altra parte dal solo nome.
+# PDF_FOLDER resta la cartella d'ingresso: i PDF che vi si trovano (salvati
+# per nome dalle versioni precedenti, estratti da uno ZIP, copiati a mano)
+# li sposta in archivio riconcilia_pdf().
+PDF_RICONCILIA_INTERVALLO = 60  # secondi: poi si ricontrolla anche a cartelle invariate
+_pdf_riconcilia_lock = threading.Lock()
+_pdf_riconciliato = {"cartelle": None, "quando": 0.0, "generazione_db": None}
+_NOME_BLOB = re.compile(r"[0-9a-f]{64}\.pdf")
+
+
+def _sql_collega_pdf(nome):
+    # atto (id minore) che cita il file (idx_norme_filepdf)
+    return f"""
+        UPDATE pdf_files SET norma_id = (
+            SELECT MIN(id) FROM norme WHERE filepdf = {nome} AND TRIM(filepdf) <> ''
+        ) WHERE nome = {nome};
+    """
+
+
+def sql_trigger_pdf():
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS norme_pdf_ai AFTER INSERT ON norme
+            WHEN TRIM(new.filepdf) <> '' BEGIN {_sql_collega_pdf("new.filepdf")} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS norme_pdf_ad AFTER DELETE ON norme
+            WHEN TRIM(old.filepdf) <> '' BEGIN {_sql_collega_pdf("old.filepdf")} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS norme_pdf_au AFTER UPDATE OF filepdf ON norme
+            WHEN new.filepdf IS NOT old.filepdf BEGIN
+                {_sql_collega_pdf("old.filepdf")} {_sql_collega_pdf("new.filepdf")}
+            END""",
+    ]
+
+
+def collega_pdf(conn):
+    """Ricalcola norma_id di tutto l'indice (dopo la ricostruzione di norme)."""
+    conn.execute("""
+        UPDATE pdf_files SET norma_id = (
+            SELECT MIN(id) FROM norme WHERE filepdf = pdf_files.nome AND TRIM(filepdf) <> ''
+        )
+    """)
+
+
+def _scrivi_indice_pdf(conn, voci):
+    """voci = [(nome, dimensione, mtime_ns, sha256), ...]; senza commit."""
+    conn.executemany("""
+        INSERT INTO pdf_files (nome, dimensione, mtime, sha256, norma_id)
+        VALUES (?1, ?2, ?3, ?4, (SELECT MIN(id) FROM norme WHERE filepdf = ?1 AND TRIM(filepdf) <> ''))
+        ON CONFLICT(nome) DO UPDATE SET
+            dimensione = excluded.dimensione, mtime = excluded.mtime,
+            sha256 = excluded.sha256, norma_id = excluded.norma_id
+    """, voci)
+
+
+def percorso_blob(sha256):
+    return os.path.join(PDF_ARCHIVIO_DIR, f"{sha256}.pdf")
+
+
+def _metti_in_archivio(percorso, sha256):
+    """Copia `percorso` in archivio se quel contenuto non c'è già (il sorgente resta)."""
+    blob = percorso_blob(sha256)
+    if os.path.exists(blob):
+        return
+    try:
+        os.link(percorso, blob)  # stesso disco: nessuna copia
+    except OSError:
+        copia_atomica(percorso, blob)
+
+
+def archivia_upload(file):
+    """Salva in archivio il PDF caricato (FileStorage) calcolandone lo sha256
+    durante la scrittura. Ritorna (sha256, dimensione)."""
+    tmp = os.path.join(PDF_ARCHIVIO_DIR, f"upload.{secrets.token_hex(8)}.part")
+    h, dimensione = hashlib.sha256(), 0
+    try:
+        with open(tmp, "wb") as out:
+            for blocco in iter(lambda: file.stream.read(1024 * 1024), b""):
+                h.update(blocco)
+                out.write(blocco)
+                dimensione += len(blocco)
+        sha256 = h.hexdigest()
+        if not os.path.exists(percorso_blob(sha256)):
+            os.replace(tmp, percorso_blob(sha256))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)  # contenuto già in archivio
+    return sha256, dimensione
+
+
+def nome_pdf_caricato(conn, file, sha256, norma_id=None):
+    """Nome logico per il PDF caricato: quello del file se è libero, se ha già
+    lo stesso contenuto o se lo cita solo l'atto norma_id (sostituzione del
+    suo PDF); altrimenti nome_2.pdf, nome_3.pdf, … senza toccare gli altri atti."""
+    indice_pdf_aggiornato(conn)  # un PDF omonimo ancora in PDF_FOLDER conta
+    base = secure_filename(file.filename.rsplit(".", 1)[0])
+    nome, n = f"{base}.pdf", 1
+    while True:
+        riga = conn.execute("SELECT sha256 FROM pdf_files WHERE nome = ?", (nome,)).fetchone()
+        if riga is not None and riga["sha256"] == sha256:
+            return nome
+        citato = [r["id"] for r in conn.execute(
+            "SELECT id FROM norme WHERE filepdf = ? AND TRIM(filepdf) <> ''", (nome,))]
+        if riga is None and not citato:
+            return nome
+        if norma_id is not None and citato and set(citato) == {norma_id}:
+            return nome
+        n += 1
+        nome = f"{base}_{n}.pdf"
+
+
+def registra_pdf(conn, nome, sha256, dimensione):
+    """Associa `nome` al contenuto già in archivio (senza commit). Ritorna lo
+    sha256 che il nome aveva prima, se diverso, da passare a pota_archivio_pdf
+    dopo il commit."""
+    riga = conn.execute("SELECT sha256 FROM pdf_files WHERE nome = ?", (nome,)).fetchone()
+    _scrivi_indice_pdf(conn, [(nome, dimensione, time.time_ns(), sha256)])
+    conn.execute("INSERT OR REPLACE INTO pdf_blob (sha256, dimensione) VALUES (?, ?)", (sha256, dimensione))
+    if riga is not None and riga[0] != sha256:
+        return riga[0]
+    return None
+
+
+def elimina_pdf(conn, nome):
+    """Toglie il nome logico se nessun atto lo cita più (senza commit).
+    Ritorna lo sha256 da potare, o None."""
+    if conn.execute("SELECT 1 FROM norme WHERE filepdf = ? AND TRIM(filepdf) <> ''", (nome,)).fetchone():
+        return None
+    riga = conn.execute("SELECT sha256 FROM pdf_files WHERE nome = ?", (nome,)).fetchone()
+    conn.execute("DELETE FROM pdf_files WHERE nome = ?", (nome,))
+    in_ingresso = os.path.join(PDF_FOLDER, nome)
+    if os.path.isfile(in_ingresso):
+        os.remove(in_ingresso)
+    return riga[0] if riga else None
+
+
+def pota_archivio_pdf(conn, candidati):
+    """Elimina dall'archivio i contenuti fra `candidati` che nessun nome usa
+    più (dopo il commit che li ha sganciati)."""
+    potati = 0
+    for sha256 in {s for s in candidati if s}:
+        if conn.execute("SELECT 1 FROM pdf_files WHERE sha256 = ?", (sha256,)).fetchone():
+            continue
+        conn.execute("DELETE FROM pdf_blob WHERE sha256 = ?", (sha256,))
+        conn.commit()
+        try:
+            os.remove(percorso_blob(sha256))
+            potati += 1
+        except FileNotFoundError:
+            pass
+    return potati
+
+
+def percorso_pdf(conn, nome):
+    """File da servire per il nome logico: il contenuto in archivio o, se non
+    è ancora stato archiviato, il file omonimo in PDF_FOLDER. None se manca."""
+    riga = conn.execute("SELECT sha256 FROM pdf_files WHERE nome = ?", (nome,)).fetchone()
+    if riga is not None and os.path.exists(percorso_blob(riga[0])):
+        return percorso_blob(riga[0])
+    in_ingresso = os.path.join(PDF_FOLDER, nome)
+    if os.path.isfile(in_ingresso):
+        return in_ingresso
+    return None
+
+
+def _scandisci_pdf(cartella, filtro=None):
+    """{nome: (dimensione, mtime_ns)} dei PDF nella cartella."""
+    trovati = {}
+    try:
+        with os.scandir(cartella) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.lower().endswith(".pdf") and (filtro is None or filtro(entry.name)):
+                    st = entry.stat()
+                    trovati[entry.name] = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        pass
+    return trovati
+
+
+def _mtime_cartelle_pdf():
+    mtime = []
+    for cartella in (PDF_FOLDER, PDF_ARCHIVIO_DIR):
+        try:
+            mtime.append(os.stat(cartella).st_mtime_ns)
+        except OSError:
+            mtime.append(None)
+    return tuple(mtime)
+
+
+def riconcilia_pdf(conn):
+    """Sposta in archivio i PDF di PDF_FOLDER (hash solo se dimensione/mtime
+    non corrispondono all'indice) e riallinea pdf_blob ai file presenti in
+    archivio, riconosciuti dal nome. Ritorna (archiviati, contenuti rimossi)."""
+    with _pdf_riconcilia_lock:
+        noti = {r[0]: tuple(r[1:]) for r in conn.execute("SELECT nome, dimensione, mtime, sha256 FROM pdf_files")}
+
+        # hash e copie in archivio fuori dalla transazione di scrittura
+        archiviati, sostituiti = [], []
+        for nome, (dimensione, mtime) in _scandisci_pdf(PDF_FOLDER).items():
+            percorso = os.path.join(PDF_FOLDER, nome)
+            nota = noti.get(nome)
+            try:
+                sha256 = nota[2] if nota and nota[:2] == (dimensione, mtime) else hash_file(percorso)
+                _metti_in_archivio(percorso, sha256)
+            except OSError:
+                traceback.print_exc()
+                continue  # si ritenta alla prossima riconciliazione
+            archiviati.append((nome, dimensione, mtime, sha256))
+            if nota and nota[2] != sha256:
+                sostituiti.append(nota[2])
+
+        archivio = _scandisci_pdf(PDF_ARCHIVIO_DIR, _NOME_BLOB.fullmatch)
+        in_tabella = {r[0] for r in conn.execute("SELECT sha256 FROM pdf_blob")}
+        nuovi = [(nome[:-4], dimensione) for nome, (dimensione, _) in archivio.items()
+                 if nome[:-4] not in in_tabella]
+        presenti = {nome[:-4] for nome in archivio}
+        rimossi = [(sha256,) for sha256 in in_tabella if sha256 not in presenti]
+
+        _scrivi_indice_pdf(conn, archiviati)
+        conn.executemany("INSERT OR REPLACE INTO pdf_blob (sha256, dimensione) VALUES (?, ?)", nuovi)
+        conn.executemany("DELETE FROM pdf_blob WHERE sha256 = ?", rimossi)
+        conn.commit()
+        # solo ora, con i nomi registrati, si svuota la cartella d'ingresso
+        for nome, *_ in archiviati:
+            try:
+                os.remove(os.path.join(PDF_FOLDER, nome))
+            except OSError:
+                pass
+        pota_archivio_pdf(conn, sostituiti)
+        _pdf_riconciliato.update(cartelle=_mtime_cartelle_pdf(), quando=time.monotonic(),
+                                 generazione_db=_db_generazione)
+        if archiviati or nuovi or rimossi:
+            print(f"📑 Archivio PDF riallineato: {len(archiviati)} archiviati da {PDF_FOLDER}, "
+                  f"{len(nuovi)} contenuti nuovi, {len(rimossi)} rimossi.")
+        return len(archiviati), len(rimossi)
+
+
+def indice_pdf_aggiornato(conn):
+    """Riconcilia solo se una delle due cartelle è cambiata (mtime), il file
+    del DB è stato sostituito o è passato PDF_RICONCILIA_INTERVALLO (un PDF
+    sovrascritto sul posto non cambia l'mtime della cartella)."""
+    if (_mtime_cartelle_pdf() == _pdf_riconciliato["cartelle"]
+            and _pdf_riconciliato["generazione_db"] == _db_generazione
+            and time.monotonic() - _pdf_riconciliato["quando"] < PDF_RICONCILIA_INTERVALLO):
+        return
+    riconcilia_pdf(conn)
+
+
+def avvia_riconciliazione_pdf():
+    """Prima riconciliazione all'avvio, in background (archivia i PDF in ingresso)."""
+    def esegui():
+        try:
+            with uso_db():
+                riconcilia_pdf(get_db())
+        except Exception:
+            traceback.print_exc()
+    threading.Thread(target=esegui, name="indice-pdf", daemon=True).start()
+
+
+def analisi_pdf(conn):
+    """(atti senza PDF, PDF mancanti in archivio, PDF orfani) per la diagnostica,
+    da pdf_files e pdf_blob (da riallineare prima con indice_pdf_aggiornato)."""
+    atti_senza_pdf = conn.execute(
+        "SELECT id, anno, numero, filepdf FROM norme WHERE filepdf IS NULL OR TRIM(filepdf) = ''"
+    ).fetchall()
+    pdf_mancanti = conn.execute("""
+        SELECT n.id, n.anno, n.numero, n.filepdf FROM norme n
+        WHERE TRIM(n.filepdf) <> ''
+          AND NOT EXISTS (SELECT 1 FROM pdf_files p JOIN pdf_blob b ON b.sha256 = p.sha256
+                          WHERE p.nome = n.filepdf)
+    """).fetchall()
+    pdf_orfani = [r[0] for r in conn.execute("SELECT nome FROM pdf_files WHERE norma_id IS NULL ORDER BY nome")]
+    return atti_senza_pdf, pdf_mancanti, pdf_orfani
+
+
+# ==========================================================
+# 🔢 CHIAVI NUMERICHE DI ANNO / NUMERO
+# ==========================================================
+# anno e numero sono TEXT: per ordinare e filtrare si usano le colonne
+# generate anno_n, numero_n e numero_suffisso (migrazione 2).
+NUMERO_SENZA_VALORE = 2147483647  # numeri non numerici ("s.n.") in coda
+ORDINE_NORME = " ORDER BY anno_n DESC, numero_n ASC, numero_suffisso ASC, id ASC"
+
+
+def chiave_numero(numero):
+    """'123/bis' → (123, '/bis'); '123' → (123, ''); 's.n.' → (NUMERO_SENZA_VALORE, 's.n.').
+    Stessa logica delle colonne numero_n / numero_suffisso."""
+    testo = str(numero or "").strip()
+    m = re.match(r"[0-9]+", testo)
+    if not m:
+        return NUMERO_SENZA_VALORE, testo
+    return int(m.group()), testo[m.end():]
+
+
+def clausole_anno_numero(args):
+    """Filtri su anno (esatto o intervallo anno_da/anno_a) e numero, sulle chiavi numeriche."""
+    where, params = "", []
+    anno = str(args.get("anno") or "").strip()
+    if anno.isdigit():
+        where += " AND anno_n = ?"
+        params.append(int(anno))
+    elif anno:
+        # valore non numerico: ricerca testuale come in passato
+        where += " AND anno LIKE ?"
+        params.append(f"%{anno}%")
+    anno_da = str(args.get("anno_da") or "").strip()
+    if anno_da.isdigit():
+        where += " AND anno_n >= ?"
+        params.append(int(anno_da))
+    anno_a = str(args.get("anno_a") or "").strip()
+    if anno_a.isdigit():
+        # anno_n = 0 significa anno mancante: escluso dagli intervalli
+        where += " AND anno_n BETWEEN 1 AND ?"
+        params.append(int(anno_a))
+    numero = str(args.get("numero") or "").strip()
+    if numero:
+        numero_n, suffisso = chiave_numero(numero)
+        where += " AND numero_n = ? AND numero_suffisso = ?"
+        params.extend([numero_n, suffisso])
+    return where, params
+
+
+# ==========================================================
+# 🔎 INDICE FULL-TEXT (FTS5) PER LA RICERCA "testo"
+# ==========================================================
+FTS_COLONNE = ["oggetto", "descrizione", "argomento", "tipologia", "fonte", "note"]
+# pesi bm25 nello stesso ordine di FTS_COLONNE (l'oggetto conta di più)
+FTS_PESI = (10.0, 5.0, 3.0, 2.0, 2.0, 1.0)
+FTS_ATTIVO = False  # False se la SQLite in uso non ha FTS5 → ricerca con LIKE
+
+
+def sql_trigger_fts():
+    """Trigger che tengono norme_fts allineata a `norme`."""
+    cols = ", ".join(FTS_COLONNE)
+    new_cols = ", ".join(f"new.{col}" for col in FTS_COLONNE)
+    old_cols = ", ".join(f"old.{col}" for col in FTS_COLONNE)
+    return [f"""
+            CREATE TRIGGER IF NOT EXISTS norme_fts_ai AFTER INSERT ON norme BEGIN
+                INSERT INTO norme_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+            END
+        """, f"""
+            CREATE TRIGGER IF NOT EXISTS norme_fts_ad AFTER DELETE ON norme BEGIN
+                INSERT INTO norme_fts(norme_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+            END
+        """, f"""
+            CREATE TRIGGER IF NOT EXISTS norme_fts_au AFTER UPDATE OF {cols} ON norme BEGIN
+                INSERT INTO norme_fts(norme_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                INSERT INTO norme_fts(rowid, {cols}) VALUES (new.id, {new_cols});
+            END
+        """]
+
+
+def sql_tabella_fts(nome="norme_fts"):
+    return f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {nome} USING fts5(
+                {", ".join(FTS_COLONNE)},
+                content='norme', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+        """
+
+
+def crea_indice_fts(conn):
+    """Crea (se manca) la tabella FTS5 sincronizzata con `norme` via trigger."""
+    global FTS_ATTIVO
+    try:
+        esiste = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='norme_fts'"
+        ).fetchone()
+        conn.execute(sql_tabella_fts())
+        for sql in sql_trigger_fts():
+            conn.execute(sql)
+        if not esiste:
+            # prima creazione: indicizza gli atti già presenti
+            conn.execute("INSERT INTO norme_fts(norme_fts) VALUES ('rebuild')")
+        conn.commit()
+        FTS_ATTIVO = True
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        FTS_ATTIVO = False
+        print("⚠️ FTS5 non disponibile, ricerca testuale con LIKE:", e)
+
+
+def espressione_fts(testo):
+    """Converte la ricerca "Google-like" in espressioni MATCH FTS5.
+    Ritorna (inclusi, esclusi): ogni parola diventa un prefisso ("parola"*),
+    le parole precedute da '-' finiscono negli esclusi. Stringhe vuote se assenti."""
+    inclusi, esclusi = [], []
+    for token in testo.split():
+        escludi = token.startswith("-") and len(token) > 1
+        word = token[1:] if escludi else token
+        if not any(ch.isalnum() for ch in word):
+            continue
+        term = '"' + word.replace('"', '""') + '"*'
+        (esclusi if escludi else inclusi).append(term)
+    return " AND ".join(inclusi), " OR ".join(esclusi)
+
+
+def clausole_testo_like(testo):
+    """Ricerca testuale senza FTS5: LIKE su tutte le colonne ricercabili."""
+    testo_clauses = []
+    testo_params = []
+    for token in testo.split():
+        if token.startswith("-") and len(token) > 1:
+            # parola da escludere
+            word = token[1:]
+            sub_parts = []
+            for col in FTS_COLONNE:
+                sub_parts.append(f"{col} NOT LIKE ?")
+                testo_params.append(f"%{word}%")
+            testo_clauses.append("(" + " AND ".join(sub_parts) + ")")
+        else:
+            # parola (o frase) da cercare
+            sub_parts = []
+            for col in FTS_COLONNE:
+                sub_parts.append(f"{col} LIKE ?")
+                testo_params.append(f"%{token}%")
+            testo_clauses.append("(" + " OR ".join(sub_parts) + ")")
+    if not testo_clauses:
+        return "", []
+    return " AND (" + " AND ".join(testo_clauses) + ")", testo_params
+
+
+def clausole_testo(testo):
+    """Filtro "testo" come condizione WHERE (senza ordinamento per rilevanza):
+    FTS5 se disponibile, altrimenti LIKE. Lo usa l'export, così trova gli
+    stessi atti della pagina di ricerca."""
+    testo = (testo or "").strip()
+    if not testo:
+        return "", []
+    if not FTS_ATTIVO:
+        return clausole_testo_like(testo)
+    inclusi, esclusi = espressione_fts(testo)
+    where, params = "", []
+    if inclusi:
+        where += " AND id IN (SELECT rowid FROM norme_fts WHERE norme_fts MATCH ?)"
+        params.append(inclusi)
+    if esclusi:
+        where += " AND id NOT IN (SELECT rowid FROM norme_fts WHERE norme_fts MATCH ?)"
+        params.append(esclusi)
+    return where, params
+
+
+# ==========================================================
+# 🧮 GENERAZIONE DATI + CACHE FACCETTE (menù a tendina)
+# ==========================================================
+# Il contatore `generazione` in tabella meta cresce a ogni scrittura su norme
+# (incrementa_generazione); le cache derivate dai dati sono valide finché non
+# cambia. L'identità in meta cambia quando il file DB viene sostituito.
+FACCETTE_COLONNE = ["tipologia", "argomento", "fonte"]
+_faccette_lock = threading.Lock()
+_faccette_cache = {"generazione": None, "valori": None}
+_conteggi_cache = {"versione": None, "valori": {}}  # conteggi di /esportazione
+CONTEGGI_CACHE_MAX = 1000
+
+
+def crea_generazione_dati(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (chiave TEXT PRIMARY KEY, valore)")
+    conn.execute("INSERT OR IGNORE INTO meta (chiave, valore) VALUES ('generazione', 0)")
+    conn.execute("INSERT OR IGNORE INTO meta (chiave, valore) VALUES ('identita', ?)", (secrets.token_hex(8),))
+    conn.commit()
 
-def crea_database():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    # Tabella norme
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS norme (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            anno TEXT,
-            numero TEXT,
-            tipologia TEXT,
-            categoria TEXT,
-            argomento TEXT,
-            oggetto TEXT,
-            fonte TEXT,
-            filepdf TEXT,
-            descrizione TEXT,
-            stato TEXT,
-            note TEXT
-        )
-    ''')
-    # Tabella audit
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS audit (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts TEXT DEFAULT CURRENT_TIMESTAMP,
-            action TEXT NOT NULL,
-            norma_id INTEGER,
-            actor TEXT,
-            ip TEXT,
-            user_agent TEXT,
-            details TEXT
-        )
-    ''')
+
+def generazione_dati(conn=None):
+    """Contatore delle modifiche a `norme` (0 se la tabella meta manca)."""
+    conn = conn or get_db(readonly=True)
+    try:
+        row = conn.execute("SELECT valore FROM meta WHERE chiave = 'generazione'").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+
+def incrementa_generazione(conn):
+    """Da chiamare una volta nella transazione di ogni scrittura su `norme`,
+    prima del commit (un UPDATE per transazione, non uno per riga)."""
+    conn.execute("UPDATE meta SET valore = valore + 1 WHERE chiave = 'generazione'")
+
+
+def rinnova_identita_db(conn):
+    """Nuova identità del file DB, da assegnare quando viene sostituito (es. da
+    rete): due copie con la stessa generazione possono avere dati diversi."""
+    conn.execute("INSERT OR REPLACE INTO meta (chiave, valore) VALUES ('identita', ?)", (secrets.token_hex(8),))
     conn.commit()
-    conn.close()
+
+
+def versione_dati(conn=None):
+    """Identità del file DB + generazione: chiave delle cache derivate che
+    sopravvivono alla sostituzione del DB (es. export su disco)."""
+    conn = conn or get_db(readonly=True)
+    try:
+        row = conn.execute("SELECT valore FROM meta WHERE chiave = 'identita'").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    return f"{row[0] if row else 'x'}-{generazione_dati(conn)}"
+
+
+def invalida_cache_dati():
+    """Svuota le cache derivate (es. dopo la sostituzione del file DB da rete)."""
+    with _faccette_lock:
+        _faccette_cache["generazione"] = None
+        _faccette_cache["valori"] = None
+        _conteggi_cache["versione"] = None
+        _conteggi_cache["valori"] = {}
+
+
+def faccette(conn=None):
+    """Valori distinti con conteggio per tipologia/argomento/fonte:
+    {"tipologia": [(valore, n_atti), ...], ...}, ricalcolati solo se i dati cambiano."""
+    conn = conn or get_db(readonly=True)
+    gen = generazione_dati(conn)
+    with _faccette_lock:
+        if _faccette_cache["generazione"] == gen and _faccette_cache["valori"] is not None:
+            return _faccette_cache["valori"]
+    valori = {}
+    for col in FACCETTE_COLONNE:
+        valori[col] = [tuple(r) for r in conn.execute(f"""
+            SELECT {col}, COUNT(*) FROM norme
+            WHERE TRIM({col}) <> ''
+            GROUP BY {col} ORDER BY {col}
+        """)]
+    with _faccette_lock:
+        _faccette_cache["generazione"] = gen
+        _faccette_cache["valori"] = valori
+    return valori
+
+
+def valori_faccetta(col, conn=None):
+    return [v for v, _ in faccette(conn)[col]]
+
+
+def conteggi_faccette(conn=None):
+    """{"tipologia": {valore: n_atti}, ...} per mostrare i conteggi nei filtri."""
+    return {col: dict(vals) for col, vals in faccette(conn).items()}
+
 
 def ensure_audit_table():
     """Chiamata aggiuntiva (idempotente) per garantire la tabella audit.
        È safe anche se già creata da crea_database()."""
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_db()
         c = conn.cursor()
         c.execute('''
             CREATE TABLE IF NOT EXISTS audit (
@@ -517,49 +2652,400 @@ def ensure_audit_table():
             )
         ''')
         conn.commit()
-        conn.close()
     except Exception:
         traceback.print_exc()
 
+
+# ==========================================================
+# 📥 IMPORT EXCEL (normalizzazione + upsert in blocco)
+# ==========================================================
+COLONNE_NORME = ["anno", "numero", "tipologia", "categoria", "argomento", "oggetto",
+                 "fonte", "filepdf", "descrizione", "stato", "note"]
+# UNIQUE (migrazione 4): lo stesso atto può comparire sotto più argomenti
+CHIAVE_NORME = ["anno", "numero", "tipologia", "fonte", "argomento"]
+# colonne mostrate ed esportate: le colonne di servizio (anno_n, numero_n,
+# numero_suffisso, hash_riga) restano fuori da pagine, JSON ed export
+COLONNE_ATTO = ["id"] + COLONNE_NORME
+SQL_ATTO = f"SELECT {', '.join(COLONNE_ATTO)} FROM norme"
+
+
+def atto_pubblico(row):
+    """dict dell'atto con le sole COLONNE_ATTO (per JSON e conflitti)."""
+    return {col: row[col] for col in COLONNE_ATTO}
+
+
+# righe per lotto nella lettura in streaming: la memoria di picco dipende da
+# questo valore, non dalla dimensione del file
+EXCEL_LOTTO = int(os.environ.get("COMPENDIO_EXCEL_LOTTO", "2000"))
+
+
+def _cella_testo(valore):
+    """Valore di cella come testo, come pd.read_excel(dtype=str): vuoto → "",
+    numeri interi senza ".0", spazi ai bordi rimossi."""
+    if valore is None:
+        return ""
+    if isinstance(valore, float) and valore.is_integer():
+        valore = int(valore)
+    return str(valore).strip()
+
+
+def leggi_excel_a_lotti(path, dimensione=None):
+    """Legge il primo foglio in streaming (openpyxl read_only, iter_rows) senza
+    caricare il workbook in memoria. Ritorna (colonne presenti, generatore di
+    DataFrame con le colonne COLONNE_NORME di al più `dimensione` righe); le
+    colonne assenti dal file sono "". Il file resta aperto finché il
+    generatore non è esaurito."""
+    from openpyxl import load_workbook
+    dimensione = dimensione or EXCEL_LOTTO
+    wb = load_workbook(path, read_only=True, data_only=True)
+    righe = wb.worksheets[0].iter_rows(values_only=True)
+    intestazione = [_cella_testo(v).lower() for v in next(righe, ())]
+    presenti = [col for col in COLONNE_NORME if col in intestazione]
+    posizioni = [intestazione.index(col) if col in intestazione else None for col in COLONNE_NORME]
+
+    def lotti():
+        try:
+            lotto = []
+            for riga in righe:
+                lotto.append(tuple(_cella_testo(riga[i]) if i is not None and i < len(riga) else ""
+                                   for i in posizioni))
+                if len(lotto) >= dimensione:
+                    yield pd.DataFrame(lotto, columns=COLONNE_NORME)
+                    lotto = []
+            if lotto:
+                yield pd.DataFrame(lotto, columns=COLONNE_NORME)
+        finally:
+            wb.close()
+
+    return presenti, lotti()
+
+
+def hash_riga(valori):
+    """Hash (BLAKE2b, 8 byte) dei valori di COLONNE_NORME di una riga, come
+    intero a 64 bit con segno (la colonna hash_riga). Stabile tra versioni di
+    Python e pandas: NULL/NaN valgono '', ogni valore è preceduto dalla sua
+    lunghezza così i confini tra i campi non sono ambigui."""
+    h = hashlib.blake2b(digest_size=8)
+    for valore in valori:
+        testo = "" if valore is None or (isinstance(valore, float) and valore != valore) else str(valore)
+        dati = testo.encode("utf-8")
+        h.update(b"%d:" % len(dati))
+        h.update(dati)
+    return int.from_bytes(h.digest(), "big", signed=True)
+
+
+def hash_righe(df):
+    """hash_riga() di ogni riga di `df` (colonne COLONNE_NORME), in lista."""
+    return [hash_riga(valori) for valori in df[COLONNE_NORME].itertuples(index=False, name=None)]
+
+
+def _ricalcola_hash(conn, tabella, colonna_id):
+    """Calcola hash_riga delle righe di `tabella` che non l'hanno, a lotti di
+    EXCEL_LOTTO righe. Ritorna il numero di righe aggiornate."""
+    totale, ultimo = 0, -1
+    while True:
+        df = pd.read_sql_query(
+            f"SELECT {colonna_id} AS rid, {', '.join(COLONNE_NORME)} FROM {tabella}"
+            f" WHERE hash_riga IS NULL AND {colonna_id} > ? ORDER BY {colonna_id} LIMIT ?",
+            conn, params=(ultimo, EXCEL_LOTTO))
+        if df.empty:
+            return totale
+        df[COLONNE_NORME] = df[COLONNE_NORME].fillna("").astype(str)
+        conn.executemany(f"UPDATE {tabella} SET hash_riga = ? WHERE {colonna_id} = ?",
+                         zip(hash_righe(df), df["rid"].tolist()))
+        ultimo = int(df["rid"].iloc[-1])
+        totale += len(df)
+
+
+def aggiorna_hash_mancanti(conn):
+    """Calcola hash_riga delle righe che non l'hanno (inserite o modificate
+    fuori dall'import). Ritorna il numero di righe aggiornate."""
+    # aggiorna solo hash_riga: nessun trigger FTS/generazione coinvolto
+    aggiornate = _ricalcola_hash(conn, "norme", "id")
+    conn.commit()
+    return aggiornate
+
+
+def _sql_stessa_chiave(a, b):
+    return " AND ".join(f"{a}.{col} = {b}.{col}" for col in CHIAVE_NORME)
+
+
+def carica_excel_in_appoggio(conn, path, solo_complete=True):
+    """Legge l'Excel a lotti (leggi_excel_a_lotti) nella tabella TEMP
+    import_norme con il suo hash e tiene una sola riga per chiave (vince
+    l'ultima). La tabella sta nel file temporaneo di SQLite, non in memoria:
+    né il foglio né l'elenco delle righe vengono mai caricati interi.
+    Le scritture su `norme` partono poi da qui con un'unica istruzione
+    INSERT ... SELECT: i trigger FTS5 eseguiti riga per riga in istruzioni
+    separate scaricano l'indice a ogni riga e rallentano di due ordini di
+    grandezza. Ritorna le colonne presenti nel file."""
+    scarta_appoggio(conn)
+    # cambiare temp_store elimina le tabelle TEMP: l'unica è import_norme
+    conn.execute("PRAGMA temp_store = FILE")
+    conn.execute(f"CREATE TEMP TABLE import_norme ({', '.join(COLONNE_NORME)}, hash_riga)")
+    presenti, lotti = leggi_excel_a_lotti(path)
+    inserisci = f"INSERT INTO temp.import_norme VALUES ({', '.join('?' for _ in COLONNE_NORME)}, ?)"
+    for df in lotti:
+        if solo_complete:
+            df = df[df["anno"].ne("") & df["numero"].ne("")]
+        else:
+            df = df[df["anno"].ne("") | df["numero"].ne("")]
+        conn.executemany(inserisci, ((*riga, h) for riga, h in zip(
+            df.itertuples(index=False, name=None), hash_righe(df))))
+    conn.execute(f"CREATE INDEX temp.import_norme_chiave ON import_norme ({', '.join(CHIAVE_NORME)})")
+    conn.execute(
+        "DELETE FROM temp.import_norme WHERE rowid NOT IN "
+        f"(SELECT MAX(rowid) FROM temp.import_norme GROUP BY {', '.join(CHIAVE_NORME)})")
+    conn.commit()
+    return presenti
+
+
+def _completa_appoggio(conn, presenti):
+    """Le colonne assenti dal file prendono il valore del DB per gli atti già
+    presenti; l'hash di quelle righe viene ricalcolato."""
+    assenti = [col for col in COLONNE_NORME if col not in presenti and col not in CHIAVE_NORME]
+    if not assenti:
+        return
+    stessa = _sql_stessa_chiave("n", "import_norme")
+    valori = ", ".join(f"COALESCE(CAST(n.{col} AS TEXT), '')" for col in assenti)
+    conn.execute(
+        f"UPDATE temp.import_norme SET ({', '.join(assenti)}, hash_riga) = "
+        f"(SELECT {valori}, NULL FROM norme n WHERE {stessa})"
+        f" WHERE EXISTS (SELECT 1 FROM norme n WHERE {stessa})")
+    _ricalcola_hash(conn, "temp.import_norme", "rowid")
+    conn.commit()
+
+
+def scarta_appoggio(conn):
+    """Elimina la tabella di appoggio e ripristina temp_store = MEMORY."""
+    conn.execute("DROP TABLE IF EXISTS temp.import_norme")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+def confronta_excel(conn, presenti, max_righe=50):
+    """Confronta la tabella di appoggio con `norme` tramite chiave e hash, in
+    SQL. Ritorna {"nuovi": n, "modificati": n, "invariati": n, "mancanti": n,
+    "esempi": {categoria: DataFrame di al più `max_righe` righe}}; nelle righe
+    modificate le colonne assenti dal file hanno il valore del DB."""
+    try:
+        return _confronta_appoggio(conn, presenti, max_righe)
+    finally:
+        scarta_appoggio(conn)
+
+
+def _confronta_appoggio(conn, presenti, max_righe):
+    aggiorna_hash_mancanti(conn)
+    _completa_appoggio(conn, presenti)
+    collega = f"FROM temp.import_norme s LEFT JOIN norme n ON {_sql_stessa_chiave('n', 's')}"
+    nuovi, modificati, invariati = conn.execute(
+        "SELECT COALESCE(SUM(n.id IS NULL), 0),"
+        " COALESCE(SUM(n.id IS NOT NULL AND n.hash_riga IS NOT s.hash_riga), 0),"
+        f" COALESCE(SUM(n.hash_riga = s.hash_riga), 0) {collega}").fetchone()
+    solo_db = f"FROM norme n WHERE NOT EXISTS (SELECT 1 FROM temp.import_norme s WHERE {_sql_stessa_chiave('s', 'n')})"
+    mancanti = conn.execute(f"SELECT COUNT(*) {solo_db}").fetchone()[0]
+    colonne = ", ".join(f"s.{col}" for col in COLONNE_NORME)
+    esempi = {
+        "nuovi": f"SELECT {colonne} {collega} WHERE n.id IS NULL",
+        "modificati": f"SELECT {colonne} {collega} WHERE n.id IS NOT NULL AND n.hash_riga IS NOT s.hash_riga",
+        "mancanti": f"SELECT n.id, {', '.join('n.' + col for col in CHIAVE_NORME)} {solo_db}",
+    }
+    return {
+        "nuovi": nuovi, "modificati": modificati, "invariati": invariati, "mancanti": mancanti,
+        "esempi": {nome: pd.read_sql_query(sql + " LIMIT ?", conn, params=(max_righe,)).fillna("")
+                   for nome, sql in esempi.items()},
+    }
+
+
+def sql_upsert_norme(colonne_aggiornate):
+    """INSERT ... ON CONFLICT DO UPDATE sulla chiave unica dalla tabella di
+    appoggio. Legge solo il delta (righe il cui hash differisce da quello in
+    DB) e le righe identiche non vengono riscritte (il WHERE esclude l'UPDATE)."""
+    colonne = ", ".join(COLONNE_NORME + ["hash_riga"])
+    sql = (f"INSERT INTO norme ({colonne}) SELECT {colonne} FROM temp.import_norme s"
+           f" WHERE NOT EXISTS (SELECT 1 FROM norme n WHERE {_sql_stessa_chiave('n', 's')}"
+           " AND n.hash_riga = s.hash_riga)")
+    aggiornabili = [col for col in colonne_aggiornate if col not in CHIAVE_NORME]
+    if not aggiornabili:
+        return sql + f" ON CONFLICT({', '.join(CHIAVE_NORME)}) DO NOTHING"
+    return sql + (
+        f" ON CONFLICT({', '.join(CHIAVE_NORME)}) DO UPDATE SET "
+        + ", ".join(f"{col} = excluded.{col}" for col in aggiornabili + ["hash_riga"])
+        + f" WHERE ({', '.join('norme.' + col for col in aggiornabili)})"
+        + f" IS NOT ({', '.join('excluded.' + col for col in aggiornabili)})"
+    )
+
+
+def applica_excel(conn, presenti):
+    """Scrive in una transazione solo il delta (righe nuove e modificate) della
+    tabella di appoggio; aggiorna solo le colonne presenti nel file.
+    Ritorna {"inseriti": n, "aggiornati": n, "invariati": n, "mancanti": n}
+    (mancanti: atti non presenti nel file, segnalati, non eliminati)."""
+    aggiorna_hash_mancanti(conn)
+    _completa_appoggio(conn, presenti)
+    try:
+        righe = conn.execute("SELECT COUNT(*) FROM temp.import_norme").fetchone()[0]
+        mancanti = conn.execute(
+            "SELECT COUNT(*) FROM norme n WHERE NOT EXISTS (SELECT 1 FROM temp.import_norme s"
+            f" WHERE {_sql_stessa_chiave('s', 'n')})").fetchone()[0]
+        prima = conn.execute("SELECT COUNT(*) FROM norme").fetchone()[0]
+        scritte = conn.execute(sql_upsert_norme(presenti)).rowcount  # senza i trigger
+        dopo = conn.execute("SELECT COUNT(*) FROM norme").fetchone()[0]
+        if scritte:
+            incrementa_generazione(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        scarta_appoggio(conn)
+    inseriti = dopo - prima
+    return {"inseriti": inseriti, "aggiornati": scritte - inseriti,
+            "invariati": righe - scritte, "mancanti": mancanti}
+
+
+def anteprima_excel_html(diff, azione):
+    """Pagina di anteprima (dry-run) del confronto Excel ↔ DB."""
+    def tabella(titolo, nome, colonne):
+        totale, righe = diff[nome], diff["esempi"][nome]
+        html = [f"<h3>{titolo}: {totale}</h3>"]
+        if len(righe):
+            html.append("<table border='1' cellpadding='4' cellspacing='0'><tr>"
+                        + "".join(f"<th>{escape(c)}</th>" for c in colonne) + "</tr>")
+            for riga in righe[colonne].itertuples(index=False):
+                html.append("<tr>" + "".join(f"<td>{escape(v)}</td>" for v in riga) + "</tr>")
+            html.append("</table>")
+            if totale > len(righe):
+                html.append(f"<p>… e altre {totale - len(righe)}.</p>")
+        return "\n".join(html)
+
+    return f"""
+    <div style='font-family:sans-serif;margin:30px;'>
+    <h2>🔍 Anteprima importazione Excel</h2>
+    <p>{diff['nuovi']} nuovi, {diff['modificati']} modificati,
+       {diff['invariati']} invariati, {diff['mancanti']} presenti solo nel database (non verranno eliminati).</p>
+    <form method='POST' action='{azione}'>
+        <input type='hidden' name='conferma' value='1'>
+        <button type='submit'
+                style='padding:10px 20px;background:#0073e6;color:white;border:none;border-radius:6px;cursor:pointer;'>
+            ✅ Applica modifiche</button>
+        <a href='/admin_dashboard' style='margin-left:20px;'>Annulla</a>
+    </form>
+    {tabella("Nuovi", "nuovi", CHIAVE_NORME + ["oggetto"])}
+    {tabella("Modificati", "modificati", CHIAVE_NORME + ["oggetto"])}
+    {tabella("Solo nel database", "mancanti", ["id"] + CHIAVE_NORME)}
+    </div>
+    """
+
+
+# Ricaricamento completo: la nuova tabella (norme_nuova, con il suo indice
+# FTS) si costruisce accanto a quella in uso, prima i dati e poi gli indici;
+# lo scambio è un'unica transazione di DROP + RENAME. Le ricerche in corso
+# continuano sulla tabella vecchia e un errore a metà non tocca il catalogo.
+TABELLA_OMBRA = "norme_nuova"
+
+
+def _nome_indice_ombra(nome):
+    # gli indici non si possono rinominare: quelli della tabella nuova hanno
+    # un nome diverso da quelli in uso, alternato a ogni ricaricamento
+    return nome[:-len("__r")] if nome.endswith("__r") else nome + "__r"
+
+
+def scarta_tabella_ombra(conn):
+    conn.execute(f"DROP TABLE IF EXISTS {TABELLA_OMBRA}_fts")
+    conn.execute(f"DROP TABLE IF EXISTS {TABELLA_OMBRA}")
+    conn.commit()
+
+
+def costruisci_tabella_ombra(conn):
+    """Crea norme_nuova con lo schema di `norme` e la riempie dalla tabella di
+    appoggio con un solo INSERT ... SELECT, poi ne crea indici e indice FTS.
+    Gli atti già presenti (stessa chiave) mantengono il loro id, i nuovi
+    proseguono la numerazione: audit e collegamenti restano validi."""
+    scarta_tabella_ombra(conn)
+    schema = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'norme'").fetchone()[0]
+    conn.execute(re.sub(r'^CREATE TABLE\s+("?)norme\1', f"CREATE TABLE {TABELLA_OMBRA}", schema))
+    conn.execute(f"INSERT INTO sqlite_sequence (name, seq) SELECT '{TABELLA_OMBRA}', seq"
+                 " FROM sqlite_sequence WHERE name = 'norme'")
+    colonne = ", ".join(COLONNE_NORME + ["hash_riga"])
+    conn.execute(
+        f"INSERT INTO {TABELLA_OMBRA} (id, {colonne})"
+        f" SELECT (SELECT n.id FROM norme n WHERE {_sql_stessa_chiave('n', 's')}), {colonne}"
+        " FROM temp.import_norme s ORDER BY s.rowid")
+    conn.commit()
+    indici = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'norme' AND sql IS NOT NULL"
+    ).fetchall()
+    for nome, sql in indici:
+        conn.execute(re.sub(r'^(CREATE (?:UNIQUE )?INDEX)\s+("?)\w+\2\s+ON\s+("?)norme\3',
+                            lambda m: f"{m.group(1)} {_nome_indice_ombra(nome)} ON {TABELLA_OMBRA}", sql))
+    if FTS_ATTIVO:
+        # content='norme' si riferisce alla tabella per nome: dopo lo scambio è quella nuova
+        conn.execute(sql_tabella_fts(f"{TABELLA_OMBRA}_fts"))
+        cols = ", ".join(FTS_COLONNE)
+        conn.execute(f"INSERT INTO {TABELLA_OMBRA}_fts (rowid, {cols}) SELECT id, {cols} FROM {TABELLA_OMBRA}")
+    conn.commit()
+
+
+def riallinea_doppioni(conn):
+    """Dopo un ricaricamento completo norme_doppioni.tenuta_id punta all'atto
+    con la stessa chiave del doppione; se non c'è più resta il vecchio id,
+    che nessun atto riusa (il doppione si potrà ripristinare). Senza commit."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'norme_doppioni'").fetchone():
+        conn.execute("UPDATE norme_doppioni SET tenuta_id = COALESCE("
+                     f"(SELECT n.id FROM norme n WHERE {_sql_stessa_chiave('n', 'norme_doppioni')}), tenuta_id)")
+
+
+def scambia_tabella_ombra(conn):
+    """Mette norme_nuova al posto di `norme` in un'unica transazione breve,
+    ricreando i trigger (che vengono eliminati con la tabella vecchia)."""
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if FTS_ATTIVO:
+            conn.execute("DROP TABLE IF EXISTS norme_fts")
+        conn.execute("DROP TABLE norme")
+        conn.execute(f"ALTER TABLE {TABELLA_OMBRA} RENAME TO norme")
+        if FTS_ATTIVO:
+            conn.execute(f"ALTER TABLE {TABELLA_OMBRA}_fts RENAME TO norme_fts")
+            for sql in sql_trigger_fts():
+                conn.execute(sql)
+        conn.execute(sql_trigger_hash())
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'pdf_files'").fetchone():
+            for sql in sql_trigger_pdf():
+                conn.execute(sql)
+            collega_pdf(conn)
+        riallinea_doppioni(conn)
+        incrementa_generazione(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    conn.execute("ANALYZE norme")
+    conn.commit()
+
+
 def importa_dati_excel():
     if not os.path.exists(EXCEL_FILE):
         print("⚠️ File Excel non trovato.")
         return
-    df = pd.read_excel(EXCEL_FILE)
-    df.columns = [c.strip().lower() for c in df.columns]
-    colonne_richieste = ["anno", "numero"]
-    for col in colonne_richieste:
-        if col not in df.columns:
-            print(f"⚠️ Colonna mancante: {col}")
-            return
-    df = df[~(df["anno"].astype(str).str.strip().eq("") &
-              df["numero"].astype(str).str.strip().eq(""))]
-    df = df.fillna("").astype(str)
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM norme")
-    for _, row in df.iterrows():
-        c.execute("""
-            INSERT INTO norme (
-                anno, numero, tipologia, categoria, argomento, oggetto,
-                fonte, filepdf, descrizione, stato, note
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            row.get("anno", "").strip(),
-            row.get("numero", "").strip(),
-            row.get("tipologia", "").strip(),
-            row.get("categoria", "").strip(),
-            row.get("argomento", "").strip(),
-            row.get("oggetto", "").strip(),
-            row.get("fonte", "").strip(),
-            row.get("filepdf", "").strip(),
-            row.get("descrizione", "").strip(),
-            row.get("stato", "").strip(),
-            row.get("note", "").strip()
-        ))
-    conn.commit()
-    conn.close()
-    print(f"✅ Importazione completata: {len(df)} record importati da {EXCEL_FILE}.")
+    conn = get_db()
+    try:
+        presenti = carica_excel_in_appoggio(conn, EXCEL_FILE, solo_complete=False)
+        for col in ["anno", "numero"]:
+            if col not in presenti:
+                print(f"⚠️ Colonna mancante: {col}")
+                return
+        costruisci_tabella_ombra(conn)
+        scambia_tabella_ombra(conn)
+    except Exception:
+        conn.rollback()
+        scarta_tabella_ombra(conn)
+        raise
+    finally:
+        scarta_appoggio(conn)
+    totale = conn.execute("SELECT COUNT(*) FROM norme").fetchone()[0]
+    print(f"✅ Importazione completata: {totale} record importati da {EXCEL_FILE}.")
+
 
 def require_write_lock(view_func):
     """Decorator: permette l'accesso in scrittura solo se questa istanza ha (o ottiene) il lock di rete.
@@ -568,18 +3054,17 @@ def require_write_lock(view_func):
     """
     @wraps(view_func)
     def wrapper(*args, **kwargs):
-        global HAS_WRITE_LOCK
-        # Se non abbiamo ancora il lock, decidiamo cosa fare ora
-        if not HAS_WRITE_LOCK:
-            if is_online():
-                # ONLINE: proviamo ad acquisire il lock sulla cartella di rete
-                if not acquire_lock():
-                    flash("⚠️ Il sistema è in sola consultazione: un altro utente sta modificando i dati.", "warning")
-                    return redirect(url_for("ricerca"))
-            else:
-                # OFFLINE: nessun lock di rete, ma permettiamo scrittura sulla copia locale
-                HAS_WRITE_LOCK = True
-        return view_func(*args, **kwargs)
+        # il lock può averlo già il thread di sync: l'utente se ne aggiunge titolare
+        if is_online():
+            # ONLINE: proviamo ad acquisire il lock sulla cartella di rete
+            if not acquire_lock("utente"):
+                flash("⚠️ Il sistema è in sola consultazione: un altro utente sta modificando i dati.", "warning")
+                return redirect(url_for("ricerca"))
+        else:
+            # OFFLINE: nessun lock di rete, ma permettiamo scrittura sulla copia locale
+            acquire_lock_offline("utente")
+        with scrittura_in_corso():
+            return view_func(*args, **kwargs)
     return wrapper
 
 def admin_required(view_func):
@@ -603,18 +3088,16 @@ def admin_dashboard():
         return redirect(url_for("admin_login"))
 
     # Conteggio atti
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    indice_pdf_aggiornato(get_db())
+    c = get_db(readonly=True).cursor()
     c.execute("SELECT COUNT(*) FROM norme")
     totale_norme = c.fetchone()[0]
     c.execute("SELECT COUNT(*) FROM norme WHERE filepdf IS NULL OR TRIM(filepdf) = ''")
     norme_senza_pdf = c.fetchone()[0]
-    conn.close()
 
-    # Conteggio PDF presenti in cartella
-    pdf_dir = PDF_FOLDER
-    totale_pdf = len([f for f in os.listdir(pdf_dir)
-                      if f.lower().endswith(".pdf")]) if os.path.exists(pdf_dir) else 0
+    # Conteggio dei PDF (nomi logici in pdf_files)
+    c.execute("SELECT COUNT(*) FROM pdf_files")
+    totale_pdf = c.fetchone()[0]
 
     # Data ultimo aggiornamento Excel
     if os.path.exists(EXCEL_FILE):
@@ -645,8 +3128,7 @@ def verifica_integrita():
         flash("⚠️ Accesso non autorizzato.", "warning")
         return redirect(url_for("admin_login"))
 
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    c = get_db(readonly=True).cursor()
 
     problemi = []
 
@@ -679,7 +3161,10 @@ def verifica_integrita():
     if duplicati:
         problemi.append(f"{len(duplicati)} combinazioni anno/numero/fonte duplicate.")
 
-    conn.close()
+    # Query principali senza indice (schema non migrato o indici rimossi)
+    lente = query_senza_indice(c.connection)
+    if lente:
+        problemi.append(f"Query senza indice: {'; '.join(lente)}.")
 
     if not problemi:
         flash("✅ Verifica completata: nessun problema di integrità evidente.", "success")
@@ -699,41 +3184,16 @@ def report_incoerenze():
         flash("⚠️ Accesso non autorizzato.", "warning")
         return redirect(url_for("admin_login"))
 
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-
-    # Atti senza PDF associato
-    c.execute("SELECT COUNT(*) FROM norme WHERE filepdf IS NULL OR TRIM(filepdf) = ''")
-    cnt_senza_pdf = c.fetchone()[0]
-
-    # Elenco PDF indicati nel DB
-    c.execute("SELECT filepdf FROM norme WHERE filepdf IS NOT NULL AND TRIM(filepdf) <> ''")
-    files_db_rows = c.fetchall()
-    conn.close()
-
-    files_db = {row[0] for row in files_db_rows if row[0]}
-    pdf_mancanti = []
-    pdf_orfani = []
-
-    # PDF presenti sul disco ma non collegati
-    if os.path.isdir(PDF_FOLDER):
-        for f in os.listdir(PDF_FOLDER):
-            if not f.lower().endswith(".pdf"):
-                continue
-            if f not in files_db:
-                pdf_orfani.append(f)
-
-    # PDF indicati nel DB ma non trovati in cartella
-    for f in files_db:
-        full_path = os.path.join(PDF_FOLDER, f)
-        if not os.path.exists(full_path):
-            pdf_mancanti.append(f)
+    indice_pdf_aggiornato(get_db())
+    atti_senza_pdf, mancanti, pdf_orfani = analisi_pdf(get_db(readonly=True))
+    cnt_senza_pdf = len(atti_senza_pdf)
+    pdf_mancanti = sorted({a[3] for a in mancanti})
 
     parti_msg = [f"{cnt_senza_pdf} atti senza PDF associato."]
     if pdf_mancanti:
-        parti_msg.append(f"{len(pdf_mancanti)} PDF mancanti sul disco (presenti in DB ma non in cartella).")
+        parti_msg.append(f"{len(pdf_mancanti)} PDF mancanti sul disco (citati in DB ma non in archivio).")
     if pdf_orfani:
-        parti_msg.append(f"{len(pdf_orfani)} PDF presenti in cartella ma non collegati ad alcun atto.")
+        parti_msg.append(f"{len(pdf_orfani)} PDF in archivio ma non collegati ad alcun atto.")
 
     msg = "📊 Report incongruenze: " + " ".join(parti_msg)
     flash(msg, "info")
@@ -749,28 +3209,8 @@ def report_incoerenze():
 @app.route("/diagnostica_pdf")
 @admin_required
 def diagnostica_pdf():
-    pdf_dir = PDF_FOLDER
-    pdf_files = {f for f in os.listdir(pdf_dir) if f.lower().endswith(".pdf")}
-
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-
-    # Tutti gli atti con filepdf compilato
-    atti = c.execute("SELECT id, anno, numero, filepdf FROM norme").fetchall()
-    conn.close()
-
-    # Atti senza PDF (campo DB vuoto)
-    atti_senza_pdf = [a for a in atti if not a[3]]
-
-    # PDF mancanti sul disco
-    pdf_mancanti = [
-        a for a in atti 
-        if a[3] and a[3] not in pdf_files
-    ]
-
-    # PDF orfani (presenti sul disco ma non in DB)
-    pdf_in_db = {a[3] for a in atti if a[3]}
-    pdf_orfani = sorted(pdf_files - pdf_in_db)
+    indice_pdf_aggiornato(get_db())
+    atti_senza_pdf, pdf_mancanti, pdf_orfani = analisi_pdf(get_db(readonly=True))
 
     return render_template(
         "diagnostica_pdf.html",
@@ -778,98 +3218,72 @@ def diagnostica_pdf():
         pdf_mancanti=pdf_mancanti,
         pdf_orfani=pdf_orfani
     )
-@app.route("/diagnostica_pdf_export_csv")
-@admin_required
-def diagnostica_pdf_export_csv():
-    import csv
-    from io import StringIO
-
-    pdf_dir = PDF_FOLDER
-    pdf_files = {f for f in os.listdir(pdf_dir) if f.lower().endswith(".pdf")}
 
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    atti = c.execute("SELECT id, anno, numero, filepdf FROM norme").fetchall()
-    conn.close()
-
-    atti_senza_pdf = [a for a in atti if not a[3]]
-    pdf_mancanti = [a for a in atti if a[3] and a[3] not in pdf_files]
-    pdf_in_db = {a[3] for a in atti if a[3]}
-    pdf_orfani = sorted(pdf_files - pdf_in_db)
-
-    # Create CSV in memory
-    output = StringIO()
-    writer = csv.writer(output, delimiter=';')
-
-    writer.writerow(["SEZIONE", "ID", "Anno", "Numero", "Nome PDF"])
 
+def righe_diagnostica_pdf(atti_senza_pdf, pdf_mancanti, pdf_orfani):
     for a in atti_senza_pdf:
-        writer.writerow(["ATTO SENZA PDF", a[0], a[1], a[2], ""])
+        yield ["ATTO SENZA PDF", a[0], a[1], a[2], ""]
 
     for a in pdf_mancanti:
-        writer.writerow(["PDF MANCANTE", a[0], a[1], a[2], a[3]])
+        yield ["PDF MANCANTE", a[0], a[1], a[2], a[3]]
 
     for f in pdf_orfani:
-        writer.writerow(["PDF ORFANO", "", "", "", f])
-
-    output.seek(0)
-
-    return Response(
-        output.getvalue(),
-        mimetype='text/csv',
-        headers={
-            "Content-Disposition": "attachment; filename=diagnostica_pdf.csv"
-        }
-    )
-@app.route("/diagnostica_pdf_export_xlsx")
-@admin_required
-def diagnostica_pdf_export_xlsx():
-    from openpyxl import Workbook
-    from openpyxl.styles import Font
-    from io import BytesIO
+        yield ["PDF ORFANO", "", "", "", f]
 
-    pdf_dir = PDF_FOLDER
-    pdf_files = {f for f in os.listdir(pdf_dir) if f.lower().endswith(".pdf")}
 
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    atti = c.execute("SELECT id, anno, numero, filepdf FROM norme").fetchall()
-    conn.close()
+@tipo_lavoro("diagnostica_pdf")
+def lavoro_diagnostica_pdf(parametri, avanzamento):
+    """Report della diagnostica PDF in CSV (;) o Excel."""
+    avanzamento(0, 1, "🔎 Confronto tra cartella PDF e database…")
+    with uso_db():
+        indice_pdf_aggiornato(get_db())
+        righe = list(righe_diagnostica_pdf(*analisi_pdf(get_db(readonly=True))))
+    intestazione = ["SEZIONE", "ID", "Anno", "Numero", "Nome PDF"]
 
-    atti_senza_pdf = [a for a in atti if not a[3]]
-    pdf_mancanti = [a for a in atti if a[3] and a[3] not in pdf_files]
-    pdf_in_db = {a[3] for a in atti if a[3]}
-    pdf_orfani = sorted(pdf_files - pdf_in_db)
+    if parametri.get("formato") == "xlsx":
+        from openpyxl import Workbook
+        from openpyxl.styles import Font
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Diagnostica PDF"
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Diagnostica PDF"
+        ws.append(intestazione)
+        for cell in ws[1]:
+            cell.font = Font(bold=True)
+        for riga in righe:
+            ws.append(riga)
+        nome = "diagnostica_pdf.xlsx"
+        percorso = file_lavoro(nome)
+        wb.save(percorso)
+        mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        import csv
 
-    header = ["SEZIONE", "ID", "Anno", "Numero", "Nome PDF"]
-    ws.append(header)
-    for cell in ws[1]:
-        cell.font = Font(bold=True)
+        nome = "diagnostica_pdf.csv"
+        percorso = file_lavoro(nome)
+        with open(percorso, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(intestazione)
+            writer.writerows(righe)
+        mimetype = "text/csv"
 
-    for a in atti_senza_pdf:
-        ws.append(["ATTO SENZA PDF", a[0], a[1], a[2], ""])
+    avanzamento(1, 1)
+    return {"file": percorso, "nome": nome, "mimetype": mimetype,
+            "messaggio": f"✅ Diagnostica PDF: {len(righe)} segnalazioni."}
 
-    for a in pdf_mancanti:
-        ws.append(["PDF MANCANTE", a[0], a[1], a[2], a[3]])
 
-    for f in pdf_orfani:
-        ws.append(["PDF ORFANO", "", "", "", f])
+@app.route("/diagnostica_pdf_export_csv")
+@admin_required
+def diagnostica_pdf_export_csv():
+    accoda_lavoro("diagnostica_pdf", {"formato": "csv"}, "Diagnostica PDF (CSV)")
+    return redirect(url_for("lavori_pagina"))
 
-    file_stream = BytesIO()
-    wb.save(file_stream)
-    file_stream.seek(0)
 
-    return Response(
-        file_stream.getvalue(),
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={
-            "Content-Disposition": "attachment; filename=diagnostica_pdf.xlsx"
-        }
-    )
+@app.route("/diagnostica_pdf_export_xlsx")
+@admin_required
+def diagnostica_pdf_export_xlsx():
+    accoda_lavoro("diagnostica_pdf", {"formato": "xlsx"}, "Diagnostica PDF (Excel)")
+    return redirect(url_for("lavori_pagina"))
 
 # ==========================================================
 # ⚠️ ADMIN — PAGINA DI GESTIONE CONFLITTI
@@ -882,7 +3296,100 @@ def admin_conflitti():
         return redirect(url_for("admin_login"))
 
     conflitti = load_conflicts()
-    return render_template("admin_conflitti.html", conflitti=conflitti)
+    doppioni = doppioni_in_sospeso(get_db(readonly=True))
+    try:
+        return render_template("admin_conflitti.html", conflitti=conflitti, doppioni=doppioni)
+    except TemplateNotFound:
+        return _render_conflitti(conflitti, doppioni)
+
+
+def doppioni_in_sospeso(conn):
+    """Atti duplicati spostati in norme_doppioni dalla migrazione 4, ognuno con
+    la riga rimasta in `norme` (None se nel frattempo è stata eliminata)."""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'norme_doppioni'").fetchone():
+        return []
+    doppioni = []
+    for riga in conn.execute(f"SELECT id, tenuta_id, {', '.join(COLONNE_NORME)} FROM norme_doppioni ORDER BY tenuta_id, id"):
+        tenuta = conn.execute(SQL_ATTO + " WHERE id=?", (riga["tenuta_id"],)).fetchone()
+        doppioni.append({
+            "id": riga["id"],
+            "doppione": {col: riga[col] for col in ["id"] + COLONNE_NORME},
+            "tenuta": atto_pubblico(tenuta) if tenuta else None,
+        })
+    return doppioni
+
+
+def _render_conflitti(conflitti, doppioni):
+    # Fallback HTML se manca il template admin_conflitti.html
+    def tabella(righe, intestazioni):
+        html = ["<table border='1' cellpadding='4' cellspacing='0'><tr><th>Campo</th>"
+                + "".join(f"<th>{escape(t)}</th>" for t in intestazioni) + "</tr>"]
+        for col in ["id"] + COLONNE_NORME:
+            celle = "".join(f"<td>{escape((r or {}).get(col) or '')}</td>" for r in righe)
+            html.append(f"<tr><td>{escape(col)}</td>{celle}</tr>")
+        html.append("</table>")
+        return "".join(html)
+
+    html = ["<h2>Conflitti di sincronizzazione</h2>"]
+    for i, conf in enumerate(conflitti):
+        html.append(f"<h4>{escape(conf['key'])}</h4>")
+        html.append(tabella([conf["local"], conf["network"]], ["Locale", "Rete"]))
+        html.append(f"<form method='post' action='{url_for('risolvi_conflitto', conf_id=i)}'>"
+                    "<button name='azione' value='mantieni_locale'>Mantieni locale</button> "
+                    "<button name='azione' value='mantieni_rete'>Mantieni rete</button></form>")
+    html.append("<h2>Atti duplicati (migrazione chiave unica)</h2>")
+    for d in doppioni:
+        html.append(f"<h4>Doppione #{d['id']} dell'atto #{escape(d['tenuta']['id'] if d['tenuta'] else '—')}</h4>")
+        html.append(tabella([d["tenuta"], d["doppione"]], ["Nel compendio", "Doppione"]))
+        html.append(f"<form method='post' action='{url_for('risolvi_doppione', doppione_id=d['id'])}'>"
+                    "<button name='azione' value='scarta'>Scarta il doppione</button> "
+                    "<button name='azione' value='usa_doppione'>Usa i dati del doppione</button></form>")
+    if not conflitti and not doppioni:
+        html.append("<p>✅ Nessun conflitto da risolvere.</p>")
+    html.append("<p><a href='/admin_dashboard'>⬅︎ Torna alla dashboard</a></p>")
+    return "\n".join(html)
+
+
+@app.post("/admin/conflitti/doppione/<int:doppione_id>")
+@require_write_lock
+def risolvi_doppione(doppione_id):
+    if not session.get("admin"):
+        flash("⚠️ Accesso non autorizzato.", "warning")
+        return redirect(url_for("admin_login"))
+
+    conn = get_db()
+    c = conn.cursor()
+    doppione = c.execute(f"SELECT tenuta_id, {', '.join(COLONNE_NORME)} FROM norme_doppioni WHERE id=?",
+                         (doppione_id,)).fetchone()
+    if not doppione:
+        flash("❌ Doppione non trovato.", "danger")
+        return redirect(url_for("admin_conflitti"))
+
+    scelta = request.form.get("azione")
+    if scelta == "usa_doppione":
+        # la chiave è la stessa: cambiano solo i campi non di chiave
+        campi = [col for col in COLONNE_NORME if col not in CHIAVE_NORME]
+        c.execute(f"UPDATE norme SET {', '.join(f'{col}=?' for col in campi)} WHERE id=?",
+                  (*(doppione[col] for col in campi), doppione["tenuta_id"]))
+        if c.rowcount:
+            flash("✔ Dati del doppione applicati all'atto.", "success")
+        else:
+            # l'atto rimasto è stato eliminato: il doppione torna nel compendio
+            c.execute(f"INSERT INTO norme (id, {', '.join(COLONNE_NORME)}) VALUES (?{', ?' * len(COLONNE_NORME)})",
+                      (doppione_id, *(doppione[col] for col in COLONNE_NORME)))
+            c.execute("DELETE FROM norme_doppioni WHERE id=?", (doppione_id,))
+            riallinea_doppioni(conn)  # gli altri doppioni della chiave puntano a questo
+            flash("✔ Doppione ripristinato nel compendio.", "success")
+        incrementa_generazione(conn)
+    elif scelta == "scarta":
+        flash("✔ Doppione scartato.", "success")
+    else:
+        flash("❌ Azione non valida.", "danger")
+        return redirect(url_for("admin_conflitti"))
+    c.execute("DELETE FROM norme_doppioni WHERE id=?", (doppione_id,))
+    conn.commit()
+    log_event("risolvi_doppione", doppione["tenuta_id"], {"doppione": doppione_id, "azione": scelta})
+    return redirect(url_for("admin_conflitti"))
 
 
 @app.post("/admin/conflitti/risolvi/<int:conf_id>")
@@ -899,48 +3406,49 @@ def risolvi_conflitto(conf_id):
     conf = conflitti[conf_id]
     scelta = request.form.get("azione")
 
-    # Estraggo chiavi
-    anno, numero, tipologia, fonte = conf["key"].split("::")
+    # Estraggo chiavi (tutte le colonne di CHIAVE_NORME)
+    chiave = valori_chiave_conflitto(conf)
+    where = " AND ".join(f"{col}=?" for col in CHIAVE_NORME)
 
     if scelta == "mantieni_locale":
         row = conf["local"]
 
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_db()
         c = conn.cursor()
-        c.execute("""
+        c.execute(f"""
             UPDATE norme SET
                 anno=?, numero=?, tipologia=?, argomento=?, oggetto=?,
                 descrizione=?, stato=?, note=?, fonte=?, filepdf=?
-            WHERE anno=? AND numero=? AND tipologia=? AND fonte=?
+            WHERE {where}
         """, (
             row["anno"], row["numero"], row["tipologia"], row["argomento"],
             row["oggetto"], row["descrizione"], row["stato"], row["note"],
             row["fonte"], row["filepdf"],
-            anno, numero, tipologia, fonte
+            *chiave
         ))
+        incrementa_generazione(conn)
         conn.commit()
-        conn.close()
 
         flash("✔ Versione LOCALE applicata.", "success")
 
     elif scelta == "mantieni_rete":
         row = conf["network"]
 
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_db()
         c = conn.cursor()
-        c.execute("""
+        c.execute(f"""
             UPDATE norme SET
                 anno=?, numero=?, tipologia=?, argomento=?, oggetto=?,
                 descrizione=?, stato=?, note=?, fonte=?, filepdf=?
-            WHERE anno=? AND numero=? AND tipologia=? AND fonte=?
+            WHERE {where}
         """, (
             row["anno"], row["numero"], row["tipologia"], row["argomento"],
             row["oggetto"], row["descrizione"], row["stato"], row["note"],
             row["fonte"], row["filepdf"],
-            anno, numero, tipologia, fonte
+            *chiave
         ))
+        incrementa_generazione(conn)
         conn.commit()
-        conn.close()
 
         flash("✔ Versione DI RETE ripristinata.", "success")
 
@@ -963,8 +3471,7 @@ def rimuovi_atto():
         flash("⚠️ Accesso non autorizzato.", "warning")
         return redirect(url_for("admin_login"))
 
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db(readonly=request.method == "GET")
     c = conn.cursor()
 
     # ------------------------------
@@ -974,7 +3481,6 @@ def rimuovi_atto():
         atto_id = request.form.get("atto_id", "").strip()
         if not atto_id:
             flash("❌ Nessun atto selezionato.", "error")
-            conn.close()
             return redirect(url_for("rimuovi_atto"))
 
         # Recupero info atto (per log) + nome file PDF
@@ -982,7 +3488,6 @@ def rimuovi_atto():
         row = c.fetchone()
         if not row:
             flash("❌ Atto non trovato.", "error")
-            conn.close()
             return redirect(url_for("rimuovi_atto"))
 
         filepdf = row["filepdf"]
@@ -995,25 +3500,18 @@ def rimuovi_atto():
             "filepdf": filepdf,
         }
 
-        # Elimino PDF se presente
-        if filepdf:
-            pdf_path = os.path.join(PDF_FOLDER, filepdf)
-            if os.path.exists(pdf_path):
-                try:
-                    os.remove(pdf_path)
-                except Exception:
-                    traceback.print_exc()
-
-        # Elimino riga dal database
+        # Elimino riga dal database e PDF, se nessun altro atto lo cita
         try:
             c.execute("DELETE FROM norme WHERE id = ?", (atto_id,))
+            da_potare = elimina_pdf(conn, filepdf) if filepdf else None
+            incrementa_generazione(conn)
             conn.commit()
+            pota_archivio_pdf(conn, [da_potare])
             flash("✅ Atto eliminato correttamente (database + PDF).", "success")
         except Exception as e:
+            conn.rollback()
             traceback.print_exc()
             flash(f"❌ Errore durante l'eliminazione dell'atto: {e}", "error")
-        finally:
-            conn.close()
 
         # Log in audit
         log_event("delete_single_norma", norma_id=info_atto["id"], details=info_atto)
@@ -1025,13 +3523,7 @@ def rimuovi_atto():
     # ------------------------------
 
     # Elenco fonti per il menù a tendina
-    c.execute("""
-        SELECT DISTINCT fonte
-        FROM norme
-        WHERE fonte IS NOT NULL AND TRIM(fonte) <> ''
-        ORDER BY fonte
-    """)
-    fonti = [row["fonte"] for row in c.fetchall()]
+    fonti = valori_faccetta("fonte", conn)
 
     # Se sono stati passati criteri di ricerca, cerco gli atti corrispondenti
     anno = request.args.get("anno", "").strip()
@@ -1052,12 +3544,10 @@ def rimuovi_atto():
             query += " AND fonte = ?"
             params.append(fonte_sel)
 
-        query += " ORDER BY anno DESC, numero ASC"
+        query += ORDINE_NORME
         c.execute(query, params)
         risultati = c.fetchall()
 
-    conn.close()
-
     return render_template(
         "admin_rimuovi_atto.html",
         fonti=fonti,
@@ -1120,52 +3610,48 @@ def clear_log():
     flash("🧹 Log svuotato correttamente.", "success")
     return redirect(url_for("admin_dashboard"))
 
-@app.route("/import_excel")
+
+def testo_esito_import(esito):
+    return (f"✅ Importazione completata: {esito['inseriti']} nuovi atti, "
+            f"{esito['aggiornati']} aggiornati, {esito['invariati']} invariati"
+            f" ({esito['mancanti']} atti del database non presenti nel file).")
+
+
+@tipo_lavoro("import_excel", scrive_db=True)
+def lavoro_import_excel(parametri, avanzamento):
+    """Applica al DB il file Excel `percorso` (solo le righe cambiate)."""
+    percorso = parametri["percorso"]
+    try:
+        avanzamento(0, 2, "📥 Lettura del file Excel…")
+        with uso_db():
+            conn = get_db()
+            presenti = carica_excel_in_appoggio(conn, percorso)
+            avanzamento(1, 2, "💾 Aggiornamento del database…")
+            esito = applica_excel(conn, presenti)
+        avanzamento(2, 2)
+    finally:
+        if parametri.get("rimuovi") and os.path.exists(percorso):
+            os.remove(percorso)
+    return {"messaggio": testo_esito_import(esito)}
+
+
+@app.route("/import_excel", methods=["GET", "POST"])
 @require_write_lock
 def import_excel():
+    """GET ?anteprima=1 → confronto senza scrivere; altrimenti accoda l'import."""
     if not session.get("admin"):
         flash("⚠️ Accesso non autorizzato.", "warning")
         return redirect(url_for("admin_login"))
     if not os.path.exists(EXCEL_FILE):
         flash("❌ File Excel non trovato.", "error")
         return redirect(url_for("admin_dashboard"))
+    if not (request.method == "GET" and request.args.get("anteprima")):
+        accoda_lavoro("import_excel", {"percorso": EXCEL_FILE}, "Importazione da Elenconorme.xlsx")
+        return redirect(url_for("lavori_pagina"))
     try:
-        df = pd.read_excel(EXCEL_FILE)
-        df.columns = [c.strip().lower() for c in df.columns]
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        nuovi, aggiornati = 0, 0
-        for _, row in df.iterrows():
-            anno = str(row.get("anno", "")).strip()
-            numero = str(row.get("numero", "")).strip()
-            if not anno or not numero:
-                continue
-            esiste = c.execute("SELECT COUNT(*) FROM norme WHERE anno=? AND numero=?", (anno, numero)).fetchone()[0]
-            if esiste:
-                aggiornati += 1
-                continue
-            else:
-                nuovi += 1
-                c.execute("""
-                    INSERT INTO norme (anno, numero, tipologia, categoria, argomento, oggetto,
-                                       fonte, filepdf, descrizione, stato, note)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    anno,
-                    numero,
-                    str(row.get("tipologia", "")),
-                    str(row.get("categoria", "")),
-                    str(row.get("argomento", "")),
-                    str(row.get("oggetto", "")),
-                    str(row.get("fonte", "")),
-                    str(row.get("filepdf", "")),
-                    str(row.get("descrizione", "")),
-                    str(row.get("stato", "")),
-                    str(row.get("note", "")),
-                ))
-        conn.commit()
-        conn.close()
-        flash(f"✅ Importazione completata: {nuovi} nuovi atti aggiunti, {aggiornati} già presenti.", "success")
+        conn = get_db()
+        presenti = carica_excel_in_appoggio(conn, EXCEL_FILE)
+        return anteprima_excel_html(confronta_excel(conn, presenti), url_for("import_excel"))
     except Exception as e:
         traceback.print_exc()
         flash(f"❌ Errore durante l’importazione Excel: {e}", "error")
@@ -1179,50 +3665,27 @@ def upload_excel():
         return redirect(url_for("admin_login"))
 
     if request.method == "POST":
+        upload_path = os.path.join(BASE_DIR, "ElencoNorme_uploaded.xlsx")
+        conferma = request.form.get("conferma") and os.path.exists(upload_path)
         file = request.files.get("file")
-        if not file or not file.filename.lower().endswith(".xlsx"):
+        if not conferma and (not file or not file.filename.lower().endswith(".xlsx")):
             flash("❌ Caricare un file Excel valido (.xlsx).", "error")
             return redirect(url_for("upload_excel"))
 
         try:
-            upload_path = os.path.join(BASE_DIR, "ElencoNorme_uploaded.xlsx")
-            file.save(upload_path)
-            df = pd.read_excel(upload_path)
-            df.columns = [c.strip().lower() for c in df.columns]
-            conn = sqlite3.connect(DB_FILE)
-            c = conn.cursor()
-            nuovi, aggiornati = 0, 0
-            for _, row in df.iterrows():
-                anno = str(row.get("anno", "")).strip()
-                numero = str(row.get("numero", "")).strip()
-                if not anno or not numero:
-                    continue
-                esiste = c.execute("SELECT COUNT(*) FROM norme WHERE anno=? AND numero=?", (anno, numero)).fetchone()[0]
-                if esiste:
-                    aggiornati += 1
-                else:
-                    nuovi += 1
-                    c.execute("""
-                        INSERT INTO norme (anno, numero, tipologia, categoria, argomento, oggetto,
-                                           fonte, filepdf, descrizione, stato, note)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        anno,
-                        numero,
-                        str(row.get("tipologia", "")),
-                        str(row.get("categoria", "")),
-                        str(row.get("argomento", "")),
-                        str(row.get("oggetto", "")),
-                        str(row.get("fonte", "")),
-                        str(row.get("filepdf", "")),
-                        str(row.get("descrizione", "")),
-                        str(row.get("stato", "")),
-                        str(row.get("note", "")),
-                    ))
-            conn.commit()
-            conn.close()
-            os.remove(upload_path)
-            flash(f"✅ Importazione completata: {nuovi} nuovi atti, {aggiornati} già presenti.", "success")
+            if not conferma:
+                file.save(upload_path)
+            if conferma or not request.form.get("anteprima"):
+                # l'import gira in background sul file spostato tra quelli dei lavori
+                percorso = file_lavoro("ElencoNorme_uploaded.xlsx")
+                shutil.move(upload_path, percorso)
+                accoda_lavoro("import_excel", {"percorso": percorso, "rimuovi": True},
+                              "Importazione del file Excel caricato")
+                return redirect(url_for("lavori_pagina"))
+            conn = get_db()
+            presenti = carica_excel_in_appoggio(conn, upload_path)
+            # il file resta salvato fino alla conferma
+            return anteprima_excel_html(confronta_excel(conn, presenti), url_for("upload_excel"))
         except Exception as e:
             traceback.print_exc()
             flash(f"❌ Errore durante l’importazione Excel: {e}", "error")
@@ -1233,6 +3696,8 @@ def upload_excel():
     <form method='POST' enctype='multipart/form-data' style='text-align:center;margin-top:30px;'>
         <input type='file' name='file' accept='.xlsx' required>
         <br><br>
+        <label><input type='checkbox' name='anteprima' value='1' checked> Mostra prima le differenze</label>
+        <br><br>
         <button type='submit' style='padding:10px 20px;background:#0073e6;color:white;border:none;border-radius:6px;cursor:pointer;'>📊 Importa Excel</button>
     </form>
     <p style='text-align:center;margin-top:20px;'>
@@ -1247,14 +3712,16 @@ def clear_database():
         flash("⚠️ Accesso non autorizzato.", "warning")
         return redirect(url_for("admin_login"))
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("DELETE FROM norme")
+        conn = get_db()
+        conn.execute("DELETE FROM norme")
+        conn.execute("DELETE FROM pdf_files")
+        incrementa_generazione(conn)
         conn.commit()
-        conn.close()
-        for f in os.listdir(PDF_FOLDER):
-            if f.lower().endswith(".pdf"):
-                os.remove(os.path.join(PDF_FOLDER, f))
+        for cartella in (PDF_FOLDER, PDF_ARCHIVIO_DIR):
+            for f in os.listdir(cartella):
+                if f.lower().endswith(".pdf"):
+                    os.remove(os.path.join(cartella, f))
+        riconcilia_pdf(conn)
         flash("💣 Database e PDF svuotati correttamente.", "success")
     except Exception as e:
         traceback.print_exc()
@@ -1268,7 +3735,7 @@ def fix_nan_db():
         flash("⚠️ Accesso non autorizzato.", "warning")
         return redirect(url_for("admin_login"))
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_db()
         c = conn.cursor()
         c.execute("""
             UPDATE norme SET
@@ -1280,38 +3747,116 @@ def fix_nan_db():
                 fonte       = CASE WHEN lower(fonte) = 'nan' THEN '' ELSE fonte END,
                 filepdf     = CASE WHEN lower(filepdf) = 'nan' THEN '' ELSE filepdf END
         """)
+        incrementa_generazione(conn)
         conn.commit()
-        conn.close()
         flash("🧹 Database ripulito da tutti i valori 'nan'.", "success")
     except Exception as e:
         traceback.print_exc()
         flash(f"❌ Errore durante la pulizia DB: {e}", "danger")
     return redirect(url_for("admin_dashboard"))
 
+
+@tipo_lavoro("backup_pdf")
+def lavoro_backup_pdf(parametri, avanzamento):
+    """ZIP di tutti i PDF (con i nomi logici) in BACKUP_DIR, scaricabile a lavoro finito."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M")
+    zip_name = f"backup_pdf_{timestamp}.zip"
+    zip_path = os.path.join(BACKUP_DIR, zip_name)
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    with uso_db():
+        conn = get_db()
+        riconcilia_pdf(conn)
+        pdf = [(nome, percorso_blob(sha256)) for nome, sha256 in conn.execute("""
+            SELECT p.nome, p.sha256 FROM pdf_files p JOIN pdf_blob b ON b.sha256 = p.sha256
+            ORDER BY p.nome
+        """)]
+    avanzamento(0, len(pdf), "🗜️ Compressione dei PDF…")
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for fatti, (nome, full_path) in enumerate(pdf, 1):
+            zipf.write(full_path, nome)
+            avanzamento(fatti, len(pdf))
+    return {"file": zip_path, "nome": zip_name, "mimetype": "application/zip",
+            "messaggio": f"🗃️ Backup PDF creato: {zip_name} ({len(pdf)} file)"}
+
+
 @app.route("/backup_pdfs")
 @require_write_lock
 def backup_pdfs():
     if not session.get("admin"):
         flash("⚠️ Accesso non autorizzato.", "warning")
         return redirect(url_for("admin_login"))
+    accoda_lavoro("backup_pdf", descrizione="Backup ZIP dei PDF")
+    return redirect(url_for("lavori_pagina"))
+
+
+def percorso_dentro(base, percorso):
+    """True se `percorso` (già risolto con realpath) sta sotto `base`."""
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M")
-        zip_name = f"backup_pdf_{timestamp}.zip"
-        zip_path = os.path.join(BACKUP_DIR, zip_name)
-        os.makedirs(BACKUP_DIR, exist_ok=True)
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(PDF_FOLDER):
-                for file in files:
-                    if file.lower().endswith(".pdf"):
-                        full_path = os.path.join(root, file)
-                        arcname = os.path.relpath(full_path, PDF_FOLDER)
-                        zipf.write(full_path, arcname)
-        flash(f"🗃️ Backup PDF creato: {zip_name}", "success")
-        return send_file(zip_path, as_attachment=True)
-    except Exception as e:
-        traceback.print_exc()
-        flash(f"❌ Errore durante il backup PDF: {e}", "error")
-        return redirect(url_for("admin_dashboard"))
+        return percorso != base and os.path.commonpath([base, percorso]) == base
+    except ValueError:  # Windows: unità diverse
+        return False
+
+
+def estrai_zip_parallelo(zip_path, cartella, completato=None):
+    """Estrae lo ZIP in `cartella` con il pool di trasferimento (copia atomica
+    per file). Ritorna i membri non estratti [(nome, errore), ...]."""
+    def membro(nome):
+        @contextmanager
+        def apri():
+            # un ZipFile per thread: gli handle non vanno condivisi
+            with zipfile.ZipFile(zip_path, "r") as z, z.open(nome) as f:
+                yield f
+        return apri
+
+    # i PDF vanno tutti al primo livello della cartella (l'unico che
+    # riconcilia_pdf legge): dei membri in sottocartelle conta solo il nome.
+    # Il percorso finale (link simbolici compresi) deve restare nella cartella.
+    base = os.path.realpath(cartella)
+    lavori, scartati, nomi = [], [], set()
+    with zipfile.ZipFile(zip_path, "r") as z:
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            nome = os.path.basename(info.filename.replace("\\", "/"))
+            dst = os.path.realpath(os.path.join(base, nome))
+            if nome in ("", ".", "..") or not percorso_dentro(base, dst) or os.path.dirname(dst) != base:
+                print("⚠️ Percorso non valido nello ZIP, ignorato:", info.filename)
+                scartati.append((info.filename, "percorso non valido"))
+                continue
+            if nome in nomi:
+                print("⚠️ Nome ripetuto nello ZIP, ignorato:", info.filename)
+                scartati.append((info.filename, "nome già presente in un'altra cartella dello ZIP"))
+                continue
+            nomi.add(nome)
+            lavori.append((info.filename, membro(info.filename), dst))
+    return scartati + trasferisci(lavori, completato)
+
+
+@tipo_lavoro("import_pdf")
+def lavoro_import_pdf(parametri, avanzamento):
+    """Estrae lo ZIP caricato nella cartella d'ingresso, archivia i PDF
+    (un nome già presente prende il nuovo contenuto), poi elimina lo ZIP."""
+    zip_path = parametri["zip"]
+    try:
+        with zipfile.ZipFile(zip_path, "r") as z:
+            totale = sum(1 for info in z.infolist() if not info.is_dir())
+        estratti = [0]
+
+        def completato(_):
+            estratti[0] += 1
+            avanzamento(estratti[0], totale)
+
+        avanzamento(0, totale, "📦 Estrazione dei PDF…")
+        falliti = estrai_zip_parallelo(zip_path, PDF_FOLDER, completato)
+        with uso_db():
+            riconcilia_pdf(get_db())
+    finally:
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+    if falliti:
+        return {"messaggio": f"⚠️ {len(falliti)} file non estratti: {', '.join(n for n, _ in falliti[:5])}"}
+    return {"messaggio": f"✅ {estratti[0]} PDF importati con successo nella cartella PDF condivisa."}
+
 
 @app.route("/import_pdfs", methods=["GET", "POST"])
 @require_write_lock
@@ -1326,12 +3871,10 @@ def import_pdfs():
             flash("❌ Caricare un file ZIP valido.", "error")
             return redirect(url_for("import_pdfs"))
         try:
-            temp_path = os.path.join(BASE_DIR, "temp_import.zip")
+            temp_path = file_lavoro("temp_import.zip")
             file.save(temp_path)
-            with zipfile.ZipFile(temp_path, "r") as zip_ref:
-                zip_ref.extractall(PDF_FOLDER)
-            os.remove(temp_path)
-            flash("✅ PDF importati con successo nella cartella PDF condivisa.", "success")
+            accoda_lavoro("import_pdf", {"zip": temp_path}, f"Importazione PDF da {secure_filename(file.filename)}")
+            return redirect(url_for("lavori_pagina"))
         except Exception as e:
             traceback.print_exc()
             flash(f"❌ Errore durante l’importazione dei PDF: {e}", "error")
@@ -1347,6 +3890,105 @@ def import_pdfs():
     <p style="text-align:center;margin-top:20px;"><a href='/admin_dashboard'>⬅️ Torna alla dashboard</a></p>
     """
 
+
+# ==========================================================
+# 🧵 PAGINA DEI LAVORI (avanzamento e download dei risultati)
+# ==========================================================
+def lavori_visibili(conn, lavoro_id=None):
+    """Lavori visibili alla sessione: tutti per l'admin, altrimenti quelli
+    avviati da questa sessione."""
+    query = "SELECT * FROM lavori WHERE 1=1"
+    params = []
+    if lavoro_id is not None:
+        query += " AND id = ?"
+        params.append(lavoro_id)
+    if not session.get("admin"):
+        propri = [int(i) for i in session.get("lavori") or []]
+        query += f" AND id IN ({', '.join('?' * len(propri)) or 'NULL'})"
+        params.extend(propri)
+    return conn.execute(query + " ORDER BY id DESC LIMIT 100", params).fetchall()
+
+
+def stato_lavoro(lavoro):
+    stato = {k: lavoro[k] for k in ("id", "tipo", "descrizione", "stato", "fatti", "totale", "messaggio")}
+    stato["creato"] = datetime.fromtimestamp(lavoro["creato"]).strftime("%d/%m/%Y %H:%M:%S")
+    stato["scaricabile"] = bool(lavoro["stato"] == "completato" and lavoro["file"] and os.path.exists(lavoro["file"]))
+    stato["eta_secondi"] = None
+    if lavoro["stato"] == "in_corso" and lavoro["fatti"] and lavoro["iniziato"]:
+        trascorso = time.time() - lavoro["iniziato"]
+        stato["eta_secondi"] = round(trascorso * (lavoro["totale"] - lavoro["fatti"]) / lavoro["fatti"], 1)
+    return stato
+
+
+@app.get("/lavori/stato")
+def lavori_stato():
+    with db_lavori() as conn:
+        resp = jsonify([stato_lavoro(lavoro) for lavoro in lavori_visibili(conn)])
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.get("/lavori/<int:lavoro_id>/scarica")
+def lavoro_scarica(lavoro_id):
+    with db_lavori() as conn:
+        lavoro = next(iter(lavori_visibili(conn, lavoro_id)), None)
+    if lavoro is None or not stato_lavoro(lavoro)["scaricabile"]:
+        flash("⚠️ Risultato non disponibile.", "warning")
+        return redirect(url_for("lavori_pagina"))
+    return send_file(lavoro["file"], as_attachment=True, download_name=lavoro["nome_file"],
+                     mimetype=lavoro["mimetype"])
+
+
+@app.get("/lavori")
+def lavori_pagina():
+    indietro = "/admin_dashboard" if session.get("admin") else "/ricerca"
+    return """
+    <h2 style='font-family:sans-serif;text-align:center;margin-top:40px;'>🧵 Lavori in background</h2>
+    <table id='lavori' style='font-family:sans-serif;font-size:14px;margin:20px auto;border-collapse:collapse;min-width:70%;'>
+        <tr style='background:#B30000;color:white;'>
+            <th style='padding:6px;'>#</th><th>Avviato</th><th>Operazione</th><th>Avanzamento</th><th>Esito</th><th></th>
+        </tr>
+    </table>
+    <p style='text-align:center;margin-top:20px;'><a href='""" + indietro + """'>⬅️ Indietro</a></p>
+    <script>
+      // lo stato è nel DB dei lavori: la pagina si può ricaricare o chiudere
+      const STATI = {in_coda: "⏳ In coda", in_corso: "⚙️ In corso", completato: "✅ Completato", errore: "❌ Errore"};
+      function cella(testo) {
+        const td = document.createElement("td");
+        td.style.padding = "6px";
+        td.style.borderBottom = "1px solid #ddd";
+        td.textContent = testo == null ? "" : testo;
+        return td;
+      }
+      async function aggiorna() {
+        const lavori = await (await fetch("/lavori/stato", {cache: "no-store"})).json();
+        const tabella = document.getElementById("lavori");
+        while (tabella.rows.length > 1) tabella.deleteRow(1);
+        for (const l of lavori) {
+          const tr = tabella.insertRow();
+          const perc = l.totale ? Math.round(100 * l.fatti / l.totale) : 0;
+          let avanzamento = STATI[l.stato] || l.stato;
+          if (l.stato === "in_corso" && l.totale) {
+            avanzamento += ` ${perc}% (${l.fatti}/${l.totale})`;
+            if (l.eta_secondi != null) avanzamento += ` – ancora ~${Math.ceil(l.eta_secondi)} s`;
+          }
+          [l.id, l.creato, l.descrizione || l.tipo, avanzamento, l.messaggio].forEach(v => tr.appendChild(cella(v)));
+          const azioni = cella("");
+          if (l.scaricabile) {
+            const a = document.createElement("a");
+            a.href = `/lavori/${l.id}/scarica`;
+            a.textContent = "⬇️ Scarica";
+            azioni.appendChild(a);
+          }
+          tr.appendChild(azioni);
+        }
+        if (lavori.some(l => l.stato === "in_coda" || l.stato === "in_corso")) setTimeout(aggiorna, 1000);
+      }
+      aggiorna();
+    </script>
+    """
+
+
 # ==========================================================
 # 🔒 LOGOUT – chiusura immediata, senza redirect o template
 # ==========================================================
@@ -1403,376 +4045,1071 @@ def shutdown():
     func()
     return "OK", 200
 
+
 # ==========================================================
 # 🔍 RICERCA / ESPORTAZIONE
 # ==========================================================
-@app.route("/ricerca")
-def ricerca():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    tipologie = [r["tipologia"] for r in c.execute(
-        "SELECT DISTINCT tipologia FROM norme WHERE tipologia != '' ORDER BY tipologia").fetchall()]
-    argomenti = [r["argomento"] for r in c.execute(
-        "SELECT DISTINCT argomento FROM norme WHERE argomento != '' ORDER BY argomento").fetchall()]
-    fonti = [r["fonte"] for r in c.execute(
-        "SELECT DISTINCT fonte FROM norme WHERE fonte != '' ORDER BY fonte").fetchall()]
-
-    query = "SELECT * FROM norme WHERE 1=1"
+RICERCA_PER_PAGINA = 50
+RICERCA_PER_PAGINA_MAX = 500
+RICERCA_FILTRI = ("anno", "anno_da", "anno_a", "numero", "tipo", "argomento", "fonte", "testo")
+
+
+def ricerca_senza_filtri(args):
+    """True se la ricerca non filtra nulla (tutto l'archivio)."""
+    return not any(str(args.get(k) or "").strip() not in ("", "Tutto") for k in RICERCA_FILTRI)
+
+
+def costruisci_ricerca(args):
+    """Traduce i parametri di /ricerca in (select_from, where, params, ordinamento).
+    ordinamento = [(espressione, verso, colonna_risultato), ...], chiuso da norme.id
+    così da essere univoco (serve alla paginazione keyset)."""
+    # le colonne dell'ordinamento servono al cursore keyset
+    colonne = ", ".join(f"norme.{col}" for col in COLONNE_ATTO + ["anno_n", "numero_n", "numero_suffisso"])
+    query = f"SELECT {colonne} FROM norme"
+    where = " WHERE 1=1"
     params = []
+    ordinamento = [
+        ("anno_n", "DESC", "anno_n"),
+        ("numero_n", "ASC", "numero_n"),
+        ("numero_suffisso", "ASC", "numero_suffisso"),
+        ("norme.id", "ASC", "id"),
+    ]
 
-    # Filtri base
-    if request.args.get("anno"):
-        query += " AND anno LIKE ?"
-        params.append(f"%{request.args.get('anno')}%")
-    if request.args.get("numero"):
-        query += " AND numero = ?"
-        params.append(request.args.get("numero"))
-    if request.args.get("tipo") and request.args.get("tipo") != "Tutto":
-        query += " AND tipologia=?"
-        params.append(request.args.get("tipo"))
-    if request.args.get("argomento") and request.args.get("argomento") != "Tutto":
-        query += " AND argomento LIKE ?"
-        params.append(f"%{request.args.get('argomento')}%")
-    if request.args.get("fonte") and request.args.get("fonte") != "Tutto":
-        query += " AND fonte=?"
-        params.append(request.args.get("fonte"))
-
-    # Ricerca "Google-like" sul testo
-    testo = (request.args.get("testo") or "").strip()
-    if testo:
-        tokens = testo.split()
-        testo_clauses = []
-        testo_params = []
-
-        # colonne su cui fare ricerca testuale
-        searchable_cols = ["oggetto", "descrizione", "argomento", "tipologia", "fonte", "note"]
-
-        for token in tokens:
-            if token.startswith("-") and len(token) > 1:
-                # parola da escludere
-                word = token[1:]
-                sub_parts = []
-                for col in searchable_cols:
-                    sub_parts.append(f"{col} NOT LIKE ?")
-                    testo_params.append(f"%{word}%")
-                testo_clauses.append("(" + " AND ".join(sub_parts) + ")")
-            else:
-                # parola (o frase) da cercare
-                word = token
-                sub_parts = []
-                for col in searchable_cols:
-                    sub_parts.append(f"{col} LIKE ?")
-                    testo_params.append(f"%{word}%")
-                testo_clauses.append("(" + " OR ".join(sub_parts) + ")")
+    # Filtri base (anno esatto o intervallo anno_da/anno_a, numero esatto)
+    anno_numero_sql, anno_numero_params = clausole_anno_numero(args)
+    where += anno_numero_sql
+    params.extend(anno_numero_params)
+    if args.get("tipo") and args.get("tipo") != "Tutto":
+        where += " AND tipologia=?"
+        params.append(args.get("tipo"))
+    if args.get("argomento") and args.get("argomento") != "Tutto":
+        where += " AND argomento LIKE ?"
+        params.append(f"%{args.get('argomento')}%")
+    if args.get("fonte") and args.get("fonte") != "Tutto":
+        where += " AND fonte=?"
+        params.append(args.get("fonte"))
+
+    # Ricerca "Google-like" sul testo (FTS5, ordinata per rilevanza bm25)
+    testo = (args.get("testo") or "").strip()
+    if testo and FTS_ATTIVO:
+        inclusi, esclusi = espressione_fts(testo)
+        if inclusi:
+            match = f"({inclusi}) NOT ({esclusi})" if esclusi else inclusi
+            pesi = ", ".join(str(p) for p in FTS_PESI)
+            query = f"""
+                SELECT {colonne}, fts.score AS fts_score FROM norme
+                JOIN (SELECT rowid AS fts_id, bm25(norme_fts, {pesi}) AS score
+                      FROM norme_fts WHERE norme_fts MATCH ?) AS fts
+                  ON fts.fts_id = norme.id"""
+            params.insert(0, match)
+            ordinamento.insert(0, ("fts.score", "ASC", "fts_score"))
+        elif esclusi:
+            where += " AND norme.id NOT IN (SELECT rowid FROM norme_fts WHERE norme_fts MATCH ?)"
+            params.append(esclusi)
+    elif testo:
+        testo_sql, testo_params = clausole_testo_like(testo)
+        where += testo_sql
+        params.extend(testo_params)
+
+    return query, where, params, ordinamento
+
+
+def order_by(ordinamento):
+    return " ORDER BY " + ", ".join(f"{expr} {verso}" for expr, verso, _ in ordinamento)
+
+
+def clausola_keyset(ordinamento, valori):
+    """Condizione "dopo l'ultima riga vista" per un ordinamento a versi misti."""
+    parti, params = [], []
+    for i, (expr, verso, _) in enumerate(ordinamento):
+        op = "<" if verso == "DESC" else ">"
+        cond = [f"{e} = ?" for e, _, _ in ordinamento[:i]] + [f"{expr} {op} ?"]
+        parti.append("(" + " AND ".join(cond) + ")")
+        params.extend(valori[:i])
+        params.append(valori[i])
+    return " AND (" + " OR ".join(parti) + ")", params
+
+
+def codifica_cursore(row, ordinamento):
+    valori = [row[col] for _, _, col in ordinamento]
+    return base64.urlsafe_b64encode(json.dumps(valori).encode("utf-8")).decode("ascii")
+
+
+def decodifica_cursore(testo, ordinamento):
+    """Ritorna i valori del cursore, o None se assente/non valido."""
+    if not testo:
+        return None
+    try:
+        valori = json.loads(base64.urlsafe_b64decode(testo.encode("ascii")))
+    except (ValueError, UnicodeError):
+        return None
+    if not isinstance(valori, list) or len(valori) != len(ordinamento):
+        return None
+    return valori
+
+
+def pagina_ricerca(conn, args, per_pagina):
+    """Una pagina di risultati (keyset): ritorna (righe, cursore_successivo)."""
+    query, where, params, ordinamento = costruisci_ricerca(args)
+    valori = decodifica_cursore(args.get("cursore"), ordinamento)
+    if valori is not None:
+        keyset_sql, keyset_params = clausola_keyset(ordinamento, valori)
+        where += keyset_sql
+        params = params + keyset_params
+    rows = conn.execute(
+        query + where + order_by(ordinamento) + " LIMIT ?", params + [per_pagina + 1]
+    ).fetchall()
+    if len(rows) > per_pagina:
+        return rows[:per_pagina], codifica_cursore(rows[per_pagina - 1], ordinamento)
+    return rows, None
+
+
+def leggi_per_pagina(args):
+    try:
+        n = int(args.get("per_pagina", RICERCA_PER_PAGINA))
+    except (TypeError, ValueError):
+        n = RICERCA_PER_PAGINA
+    return max(1, min(n, RICERCA_PER_PAGINA_MAX))
+
+
+class RisultatiRicerca:
+    """Risultati letti dal cursore SQLite mentre il template li scorre,
+    senza caricarli tutti in memoria. len() e bool() usano un COUNT."""
 
-        if testo_clauses:
-            query += " AND (" + " AND ".join(testo_clauses) + ")"
-            params.extend(testo_params)
+    def __init__(self, conn, sql, params, sql_count):
+        self.conn = conn
+        self.sql = sql
+        self.params = params
+        self.sql_count = sql_count
+        self._totale = None
 
-    norme = c.execute(query + " ORDER BY anno DESC, numero ASC", params).fetchall()
+    def __iter__(self):
+        return iter(self.conn.execute(self.sql, self.params))
+
+    def __len__(self):
+        if self._totale is None:
+            self._totale = self.conn.execute(self.sql_count, self.params).fetchone()[0]
+        return self._totale
+
+    def __bool__(self):
+        return len(self) > 0
+
+
+@app.route("/ricerca")
+def ricerca():
+    conn = get_db(readonly=True)
+    c = conn.cursor()
+    tipologie = valori_faccetta("tipologia", conn)
+    argomenti = valori_faccetta("argomento", conn)
+    fonti = valori_faccetta("fonte", conn)
+    conteggi = conteggi_faccette(conn)
 
     # conteggio totale se servisse
     c.execute("SELECT COUNT(*) FROM norme")
     totale = c.fetchone()[0]
 
-    conn.close()
-    return render_template(
+    # Modalità paginata: prima pagina + cursore per "carica altri". È quella
+    # predefinita senza filtri (tutto l'archivio); ?tutti=1 mostra l'elenco completo.
+    paginata = request.args.get("per_pagina") or request.args.get("cursore") or (
+        ricerca_senza_filtri(request.args) and not request.args.get("tutti"))
+    if paginata:
+        per_pagina = leggi_per_pagina(request.args)
+        norme, cursore = pagina_ricerca(conn, request.args, per_pagina)
+        pagina_successiva = link_altri = None
+        if cursore:
+            argomenti_url = {**request.args.to_dict(), "cursore": cursore, "per_pagina": per_pagina}
+            pagina_successiva = url_for("ricerca_pagina", **argomenti_url)
+            link_altri = url_for("ricerca", **argomenti_url)
+        pagina = render_template(
+            "ricerca.html",
+            norme=norme,
+            tipologie=tipologie,
+            categorie=argomenti,
+            fonti=fonti,
+            totale=totale,
+            conteggi=conteggi,
+            cursore=cursore,
+            pagina_successiva=pagina_successiva
+        )
+        return aggiungi_navigazione_ricerca(pagina, link_altri, len(norme))
+
+    # Modalità completa: la pagina viene inviata mentre si leggono le righe
+    query, where, params, ordinamento = costruisci_ricerca(request.args)
+    norme = RisultatiRicerca(
+        conn,
+        query + where + order_by(ordinamento),
+        params,
+        "SELECT COUNT(*) FROM (" + query + where + ")"
+    )
+    return stream_template(
         "ricerca.html",
         norme=norme,
         tipologie=tipologie,
         categorie=argomenti,
         fonti=fonti,
-        totale=totale
+        totale=totale,
+        conteggi=conteggi
     )
 
+
+def aggiungi_navigazione_ricerca(pagina, link_altri, mostrati):
+    """Link "pagina successiva" / "mostra tutti" in fondo alla pagina paginata
+    (prima di </body>), così il resto dell'archivio è raggiungibile anche
+    con un ricerca.html che non usa `pagina_successiva`."""
+    if not link_altri:
+        return pagina
+    tutti = url_for("ricerca", **{k: v for k, v in request.args.to_dict().items()
+                                  if k not in ("cursore", "per_pagina")}, tutti=1)
+    nav = f"""
+    <nav class="pagina-successiva" style="text-align:center;margin:20px 0;">
+      <span>Mostrati {mostrati} atti.</span>
+      <a href="{escape(link_altri)}">Pagina successiva ➡️</a> ·
+      <a href="{escape(tutti)}">Mostra tutti</a>
+    </nav>
+    """
+    prima, chiusura, dopo = pagina.rpartition("</body>")
+    if chiusura:
+        return prima + nav + chiusura + dopo
+    return pagina + nav
+
+
+@app.route("/ricerca/pagina")
+def ricerca_pagina():
+    """Pagina successiva dei risultati in JSON (pulsante "carica altri")."""
+    per_pagina = leggi_per_pagina(request.args)
+    rows, cursore = pagina_ricerca(get_db(readonly=True), request.args, per_pagina)
+    pagina_successiva = None
+    if cursore:
+        pagina_successiva = url_for("ricerca_pagina", **{**request.args.to_dict(), "cursore": cursore})
+    return jsonify({
+        "norme": [atto_pubblico(r) for r in rows],
+        "cursore": cursore,
+        "pagina_successiva": pagina_successiva,
+        "per_pagina": per_pagina,
+    })
+
+
 @app.route("/esportazione")
 def esportazione():
     tipo = request.args.get("tipo", "risultati")
     filtri = request.args.to_dict()
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    query = "SELECT COUNT(*) as totale FROM norme WHERE 1=1"
+    totale = conteggio_export(get_db(readonly=True), tipo, filtri)
+    return render_template("esportazione.html", tipo=tipo, totale=totale, filtri=filtri)
+
+
+def filtri_export(tipo, filtri):
+    """WHERE (con i parametri) dell'esportazione: tutto l'archivio oppure i
+    risultati filtrati come nella pagina di ricerca."""
+    where = " WHERE 1=1"
     params = []
     if tipo == "risultati":
-        if filtri.get("anno"):
-            query += " AND anno LIKE ?"
-            params.append(f"%{filtri['anno']}%")
-        if filtri.get("numero"):
-            query += " AND numero LIKE ?"
-            params.append(filtri["numero"])
+        anno_numero_sql, anno_numero_params = clausole_anno_numero(filtri)
+        where += anno_numero_sql
+        params.extend(anno_numero_params)
         if filtri.get("tipologia") and filtri["tipologia"] != "Tutto":
-            query += " AND tipologia = ?"
+            where += " AND tipologia = ?"
             params.append(filtri["tipologia"])
         if filtri.get("argomento") and filtri["argomento"] != "Tutto":
-            query += " AND argomento LIKE ?"
+            where += " AND argomento LIKE ?"
             params.append(f"%{filtri['argomento']}%")
         if filtri.get("fonte") and filtri["fonte"] != "Tutto":
-            query += " AND fonte = ?"
+            where += " AND fonte = ?"
             params.append(filtri["fonte"])
-        if filtri.get("testo"):
-            query += " AND (oggetto LIKE ? OR descrizione LIKE ?)"
-            params.extend([f"%{filtri['testo']}%", f"%{filtri['testo']}%"])
-    totale = c.execute(query, params).fetchone()["totale"]
-    conn.close()
-    return render_template("esportazione.html", tipo=tipo, totale=totale, filtri=filtri)
+        testo_sql, testo_params = clausole_testo(filtri.get("testo"))
+        where += testo_sql
+        params.extend(testo_params)
+    return where, params
+
+
+# ----------------------------------------------------------
+# Cache su disco degli export (i conteggi di /esportazione restano in memoria)
+# ----------------------------------------------------------
+# Un file per voce in export_cache/, di nome <versione_dati>_<impronta di
+# filtri normalizzati, campi e formato>.<formato>: resta valido finché i dati
+# non cambiano (generazione) e il file DB non viene sostituito (identità).
+# Oltre EXPORT_CACHE_MAX_MB si eliminano prima le voci di versioni passate,
+# poi le meno usate (mtime).
+EXPORT_CACHE_MAX_MB = int(os.getenv("COMPENDIO_EXPORT_CACHE_MB", "200"))
+FORMATI_EXPORT = {
+    "excel": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "pdf": ("application/pdf", "pdf"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson; charset=utf-8", "ndjson"),
+}
+
+
+def filtri_normalizzati(tipo, filtri):
+    """I soli filtri che cambiano la query di filtri_export, nella forma in
+    cui vi vengono usati (anno e numero senza spazi, "Tutto" = nessun filtro)."""
+    if tipo != "risultati":
+        return {}
+    normalizzati = {k: str(filtri.get(k) or "").strip() for k in ("anno", "anno_da", "anno_a", "numero")}
+    for k in ("tipologia", "argomento", "fonte"):
+        normalizzati[k] = "" if filtri.get(k) == "Tutto" else (filtri.get(k) or "")
+    normalizzati["testo"] = (filtri.get("testo") or "").strip()
+    return {k: v for k, v in normalizzati.items() if v}
+
+
+def impronta_export(tipo, filtri, campi=(), formato="conteggio"):
+    dati = json.dumps([filtri_normalizzati(tipo, filtri), list(campi), formato],
+                      ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(dati.encode("utf-8")).hexdigest()[:32]
+
+
+def percorso_cache_export(versione, tipo, filtri, campi, formato):
+    return os.path.join(EXPORT_CACHE_DIR, f"{versione}_{impronta_export(tipo, filtri, campi, formato)}.{formato}")
+
+
+def usa_cache_export(percorso):
+    """True se la voce è in cache; ne aggiorna l'ultimo uso per l'LRU."""
+    try:
+        os.utime(percorso)
+        return True
+    except OSError:
+        return False
+
+
+def pota_cache_export():
+    """Riporta la cache sotto EXPORT_CACHE_MAX_MB."""
+    try:
+        voci = []
+        for nome in os.listdir(EXPORT_CACHE_DIR):
+            percorso = os.path.join(EXPORT_CACHE_DIR, nome)
+            st = os.stat(percorso)
+            if nome.endswith(".part"):
+                if st.st_mtime < time.time() - 3600:  # export interrotto da un arresto
+                    os.remove(percorso)
+                continue
+            voci.append((nome.split("_", 1)[0], st.st_mtime, st.st_size, percorso))
+        versione = versione_dati()
+        # prima le versioni passate, poi dalla meno usata di recente
+        voci.sort(key=lambda v: (v[0] == versione, v[1]))
+        totale = sum(v[2] for v in voci)
+        for _, _, dimensione, percorso in voci:
+            if totale <= EXPORT_CACHE_MAX_MB * 1024 * 1024:
+                break
+            try:
+                os.remove(percorso)
+                totale -= dimensione
+            except OSError:
+                pass  # in uso (es. download in corso su Windows)
+    except Exception:
+        traceback.print_exc()
+
+
+def copia_in_cache_export(percorso, sorgente):
+    """Mette in cache una copia del file `sorgente` (export prodotto da un lavoro)."""
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    tmp = f"{percorso}.{secrets.token_hex(4)}.part"
+    shutil.copyfile(sorgente, tmp)
+    os.replace(tmp, percorso)
+    pota_cache_export()
+
+
+def flusso_con_cache(flusso, percorso):
+    """Inoltra i byte di `flusso` e intanto li salva: la voce entra in cache
+    solo se il flusso arriva in fondo (non se il client si disconnette)."""
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    tmp = f"{percorso}.{secrets.token_hex(4)}.part"
+    try:
+        with open(tmp, "wb") as f:
+            for pezzo in flusso:
+                f.write(pezzo)
+                yield pezzo
+        os.replace(tmp, percorso)
+        pota_cache_export()
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def conteggio_export(conn, tipo, filtri):
+    """Numero di atti esportati con questi filtri, in cache in memoria come
+    le faccette finché i dati non cambiano."""
+    versione, chiave = versione_dati(conn), impronta_export(tipo, filtri)
+    with _faccette_lock:
+        if _conteggi_cache["versione"] == versione and chiave in _conteggi_cache["valori"]:
+            return _conteggi_cache["valori"][chiave]
+    where, params = filtri_export(tipo, filtri)
+    totale = conn.execute("SELECT COUNT(*) FROM norme" + where, params).fetchone()[0]
+    with _faccette_lock:
+        if _conteggi_cache["versione"] != versione or len(_conteggi_cache["valori"]) >= CONTEGGI_CACHE_MAX:
+            _conteggi_cache["versione"], _conteggi_cache["valori"] = versione, {}
+        _conteggi_cache["valori"][chiave] = totale
+    return totale
+
+
+# ----------------------------------------------------------
+# Export Excel in streaming: l'xlsx (uno zip di file XML) viene scritto riga
+# per riga dal cursore SQLite e inviato a pezzi mentre si genera. Le celle
+# usano stringhe inline e stili con nome definiti una volta in styles.xml:
+# la memoria non cresce con il numero di righe e il download parte subito.
+# ----------------------------------------------------------
+EXPORT_PEZZO = 64 * 1024   # byte accumulati prima di inviare un pezzo
+EXPORT_TITOLO = "COMUNE DI MILANO – Sistema GESTIONE ATTI"
+EXPORT_LARGHEZZE = {"anno": 10, "numero": 12, "tipologia": 20, "fonte": 20, "argomento": 20,
+                    "oggetto": 40, "descrizione": 45, "stato": 15, "note": 25}
+_XML_NON_VALIDI = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_NS_XLSX = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_XML_DICHIARAZIONE = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_TIPO_SPREADSHEETML = "application/vnd.openxmlformats-officedocument.spreadsheetml"
+
+# stili con nome in styles.xml: nome → (font, riempimento, bordo, allineamento);
+# le celle vi fanno riferimento con s=<indice> (0 = stile Normale)
+_CENTRO = '<alignment horizontal="center" vertical="center" wrapText="1"/>'
+_TESTO = '<alignment horizontal="left" vertical="top" wrapText="1"/>'
+XLSX_STILI = {
+    "Export titolo": (2, 2, 0, '<alignment horizontal="center" vertical="center"/>'),
+    "Export intestazione": (1, 2, 1, '<alignment horizontal="center" vertical="center"/>'),
+    "Export centro": (0, 3, 1, _CENTRO),
+    "Export testo": (0, 3, 1, _TESTO),
+    "Export centro alternato": (0, 4, 1, _CENTRO),
+    "Export testo alternato": (0, 4, 1, _TESTO),
+}
+_XLSX_INDICE_STILE = {nome: i for i, nome in enumerate(XLSX_STILI, start=1)}
+
+
+def _xlsx_styles():
+    xf = [(f'numFmtId="0" fontId="{font}" fillId="{fill}" borderId="{bordo}"'
+           ' applyFont="1" applyFill="1" applyBorder="1" applyAlignment="1"', allineamento)
+          for font, fill, bordo, allineamento in XLSX_STILI.values()]
+    n = len(xf) + 1
+    riempimenti = "".join(
+        f'<fill><patternFill patternType="solid"><fgColor rgb="FF{colore}"/><bgColor rgb="FF{colore}"/></patternFill></fill>'
+        for colore in ("B30000", "FFFFFF", "F5F5F5"))
+    bordo = "".join(f'<{lato} style="thin"><color rgb="FFCCCCCC"/></{lato}>' for lato in ("left", "right", "top", "bottom"))
+    return (
+        _XML_DICHIARAZIONE + f'<styleSheet xmlns="{_NS_XLSX}">'
+        '<fonts count="3"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><color rgb="FFFFFFFF"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="14"/><color rgb="FFFFFFFF"/><name val="Calibri"/></font></fonts>'
+        '<fills count="5"><fill><patternFill patternType="none"/></fill>'
+        f'<fill><patternFill patternType="gray125"/></fill>{riempimenti}</fills>'
+        f'<borders count="2"><border/><border>{bordo}<diagonal/></border></borders>'
+        f'<cellStyleXfs count="{n}"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>'
+        + "".join(f"<xf {attributi}>{allineamento}</xf>" for attributi, allineamento in xf)
+        + f'</cellStyleXfs><cellXfs count="{n}"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        + "".join(f'<xf {attributi} xfId="{i}">{allineamento}</xf>'
+                  for i, (attributi, allineamento) in enumerate(xf, start=1))
+        + f'</cellXfs><cellStyles count="{n}"><cellStyle name="Normal" xfId="0" builtinId="0"/>'
+        + "".join(f'<cellStyle name="{nome}" xfId="{i}"/>' for nome, i in _XLSX_INDICE_STILE.items())
+        + "</cellStyles></styleSheet>"
+    )
+
+
+def _xlsx_parti_fisse(foglio):
+    return [
+        ("[Content_Types].xml", _XML_DICHIARAZIONE
+         + '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+         '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+         '<Default Extension="xml" ContentType="application/xml"/>'
+         f'<Override PartName="/xl/workbook.xml" ContentType="{_TIPO_SPREADSHEETML}.sheet.main+xml"/>'
+         f'<Override PartName="/xl/worksheets/sheet1.xml" ContentType="{_TIPO_SPREADSHEETML}.worksheet+xml"/>'
+         f'<Override PartName="/xl/styles.xml" ContentType="{_TIPO_SPREADSHEETML}.styles+xml"/>'
+         '</Types>'),
+        ("_rels/.rels", _XML_DICHIARAZIONE
+         + '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+         f'<Relationship Id="rId1" Type="{_NS_REL}/officeDocument" Target="xl/workbook.xml"/></Relationships>'),
+        ("xl/workbook.xml", _XML_DICHIARAZIONE
+         + f'<workbook xmlns="{_NS_XLSX}" xmlns:r="{_NS_REL}"><sheets>'
+         f'<sheet name="{_xml_testo(foglio)}" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+        ("xl/_rels/workbook.xml.rels", _XML_DICHIARAZIONE
+         + '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+         f'<Relationship Id="rId1" Type="{_NS_REL}/worksheet" Target="worksheets/sheet1.xml"/>'
+         f'<Relationship Id="rId2" Type="{_NS_REL}/styles" Target="styles.xml"/></Relationships>'),
+        ("xl/styles.xml", _xlsx_styles()),
+    ]
+
+
+def _xml_testo(valore):
+    return escape(_XML_NON_VALIDI.sub("", valore))
+
+
+def _lettera_colonna(n):
+    lettere = ""
+    while n:
+        n, resto = divmod(n - 1, 26)
+        lettere = chr(65 + resto) + lettere
+    return lettere
+
+
+class _UscitaAPezzi:
+    """File in sola scrittura e non posizionabile: zipfile vi scrive come su
+    uno stream e i byte prodotti si ritirano con preleva()."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, dati):
+        self.buffer += dati
+        return len(dati)
+
+    def flush(self):
+        pass
+
+    def preleva(self):
+        dati, self.buffer = bytes(self.buffer), bytearray()
+        return dati
+
+
+def flusso_xlsx(righe, campi, foglio="Atti Esportati", titolo=EXPORT_TITOLO):
+    """Generatore dei byte di un xlsx con gli atti di `righe` (cursore SQLite)
+    nelle colonne `campi`: titolo unito sulla prima riga, intestazioni, righe
+    alternate. Ogni valore è esportato come testo."""
+    chiavi = [campo.strip().lower() for campo in campi]
+    colonne = {d[0] for d in righe.description}
+    lettere = [_lettera_colonna(i) for i in range(1, len(campi) + 1)]
+    stili = [("centro" if k in ("anno", "numero", "stato") else "testo") for k in chiavi]
+    stili = {pari: [_XLSX_INDICE_STILE[f"Export {s}{' alternato' if pari else ''}"] for s in stili]
+             for pari in (True, False)}
+
+    def riga_xml(n, valori, indici, altezza=""):
+        celle = "".join(
+            f'<c r="{lettera}{n}" s="{s}" t="inlineStr"><is><t xml:space="preserve">{_xml_testo(v)}</t></is></c>'
+            if v else f'<c r="{lettera}{n}" s="{s}"/>'
+            for lettera, s, v in zip(lettere, indici, valori))
+        return f'<row r="{n}"{altezza}>{celle}</row>'
+
+    uscita = _UscitaAPezzi()
+    with zipfile.ZipFile(uscita, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nome, contenuto in _xlsx_parti_fisse(foglio):
+            zf.writestr(nome, contenuto)
+        yield uscita.preleva()
+        with zf.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            larghezze = "".join(
+                f'<col min="{i}" max="{i}" width="{EXPORT_LARGHEZZE.get(k, 18)}" customWidth="1"/>'
+                for i, k in enumerate(chiavi, start=1))
+            intestazione = [_XLSX_INDICE_STILE["Export intestazione"]] * len(campi)
+            sheet.write((
+                _XML_DICHIARAZIONE + f'<worksheet xmlns="{_NS_XLSX}"><cols>{larghezze}</cols><sheetData>'
+                + riga_xml(1, [titolo], [_XLSX_INDICE_STILE["Export titolo"]] * len(campi),
+                           ' ht="25" customHeight="1"')
+                + riga_xml(2, campi, intestazione)
+            ).encode("utf-8"))
+            lotto = []
+            for n, row in enumerate(righe, start=3):
+                valori = [str(row[k]) if k in colonne and row[k] is not None else "" for k in chiavi]
+                lotto.append(riga_xml(n, valori, stili[n % 2 == 0]))
+                if len(lotto) >= 200:
+                    sheet.write("".join(lotto).encode("utf-8"))
+                    lotto = []
+                    if len(uscita.buffer) >= EXPORT_PEZZO:
+                        yield uscita.preleva()
+            sheet.write(("".join(lotto) + "</sheetData>"
+                         f'<mergeCells count="1"><mergeCell ref="A1:{lettere[-1]}1"/></mergeCells>'
+                         "</worksheet>").encode("utf-8"))
+    yield uscita.preleva()
+
+
+# CSV e JSON lines (un oggetto per riga) per gli strumenti a valle: testo
+# generato dal cursore a pezzi di EXPORT_PEZZO byte, nessun documento in memoria.
+def select_campi_export(campi):
+    """Espressioni SELECT per i campi scelti: solo colonne di `norme` note,
+    gli altri campi restano vuoti (i nomi arrivano dal form)."""
+    ammesse = ["id"] + COLONNE_NORME
+    return ", ".join(k if k in ammesse else "NULL" for k in (c.strip().lower() for c in campi))
+
+
+def flusso_csv(righe, intestazioni):
+    """CSV con separatore ';' come gli altri CSV del programma, preceduto dal
+    BOM UTF-8: senza, Excel lo apre come ANSI e rovina le lettere accentate."""
+    import csv
+    from io import StringIO
+    buffer = StringIO()
+    buffer.write("\ufeff")
+    writer = csv.writer(buffer, delimiter=";")
+    writer.writerow(intestazioni)
+    for row in righe:
+        writer.writerow(["" if v is None else v for v in row])
+        if buffer.tell() >= EXPORT_PEZZO:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def flusso_ndjson(righe, chiavi):
+    """Un oggetto JSON per riga con le chiavi `chiavi` (valori nulli → null)."""
+    pezzo, dimensione = [], 0
+    for row in righe:
+        linea = json.dumps(dict(zip(chiavi, row)), ensure_ascii=False) + "\n"
+        pezzo.append(linea)
+        dimensione += len(linea)
+        if dimensione >= EXPORT_PEZZO:
+            yield "".join(pezzo).encode("utf-8")
+            pezzo, dimensione = [], 0
+    yield "".join(pezzo).encode("utf-8")
+
 
 # ==========================================================
-# 🧾 ESECUZIONE DELL'ESPORTAZIONE (Excel / PDF)
+# 📄 EXPORT PDF A PARTI (pool di processi + unione)
 # ==========================================================
-@app.route("/esegui_export", methods=["POST"])
-def esegui_export():
-    import io
-    from flask import send_file as send_file_flask
-    from openpyxl import Workbook
-    from openpyxl.utils import get_column_letter
-    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+# Una sola Table platypus con tutte le righe costa in modo quasi quadratico
+# (a ogni pagina la parte restante viene ricreata e rimisurata) e doc.build
+# gira su un solo core. Qui le righe sono divise in parti di
+# EXPORT_PDF_RIGHE_PARTE, ognuna impaginata da un processo del pool in un PDF
+# a sé con una sola LongTable (la testata si ripete solo a inizio pagina; il
+# costo della divisione in pagine resta limitato dalla dimensione della parte);
+# le parti sono poi unite nell'ordine in un solo file su disco.
+EXPORT_PDF_RIGHE_PARTE = int(os.getenv("COMPENDIO_PDF_RIGHE_PARTE", "2000"))
+EXPORT_PDF_PROCESSI = int(os.getenv("COMPENDIO_PDF_PROCESSI", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+
+
+def _larghezze_pdf(campi, larghezza_utile):
+    from reportlab.lib.units import cm
+    col_widths_guess = []
+    for name in campi:
+        nome = name.lower()
+        if nome in ["anno"]:
+            col_widths_guess.append(2.0 * cm)
+        elif nome in ["numero"]:
+            col_widths_guess.append(2.5 * cm)
+        elif nome in ["tipologia", "fonte", "argomento"]:
+            col_widths_guess.append(4.0 * cm)
+        elif nome in ["stato"]:
+            col_widths_guess.append(2.5 * cm)
+        elif nome in ["note"]:
+            col_widths_guess.append(5.0 * cm)
+        elif nome in ["oggetto"]:
+            col_widths_guess.append(7.0 * cm)
+        elif nome in ["descrizione"]:
+            col_widths_guess.append(8.0 * cm)
+        else:
+            col_widths_guess.append(larghezza_utile / len(campi))
+    scale = larghezza_utile / sum(col_widths_guess)
+    return [w * scale for w in col_widths_guess]
+
+
+def rendi_parte_pdf(righe, campi, percorso, intestazione, generato_il):
+    """Impagina una parte dell'export (righe = liste di stringhe) nel PDF
+    `percorso`. Gira nei processi del pool: usa solo gli argomenti."""
     from reportlab.lib import colors
+    from reportlab.lib.enums import TA_LEFT
     from reportlab.lib.pagesizes import A4, landscape
     from reportlab.lib.units import cm
     from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, LongTable, TableStyle
+
+    page_width, page_height = landscape(A4)
+    doc = SimpleDocTemplate(
+        percorso,
+        pagesize=(page_width, page_height),
+        leftMargin=1 * cm,
+        rightMargin=1 * cm,
+        topMargin=2.5 * cm,
+        bottomMargin=2 * cm,
+    )
+    styles = getSampleStyleSheet()
+    story = []
+
+    def draw_header_footer(canvas, doc_obj):
+        canvas.setFillColor(colors.HexColor("#B30000"))
+        canvas.rect(0, page_height - 50, page_width, 25, stroke=0, fill=1)
+        canvas.setFillColor(colors.white)
+        canvas.setFont("Helvetica-Bold", 13)
+        canvas.drawString(2 * cm, page_height - 42, "COMUNE DI MILANO – Sistema GESTIONE ATTI")
+        canvas.setFont("Helvetica", 9)
+        canvas.setFillColor(colors.gray)
+        canvas.drawString(2 * cm, 1 * cm, "Comune di Milano – Sistema GESTIONE ATTI")
+        canvas.drawRightString(page_width - 2 * cm, 1 * cm, generato_il)
+
+    if intestazione:
+        story.append(Spacer(1, 1 * cm))
+        story.append(Paragraph("<b>Archivio Atti Esportato</b>", styles["Heading2"]))
+        story.append(Paragraph("Esportazione generata automaticamente dal sistema <b>GESTIONE ATTI</b>.", styles["Normal"]))
+        story.append(Spacer(1, 0.5 * cm))
+        story.append(Spacer(1, 6))
+
+    if righe:
+        normal_style = styles["Normal"]
+        normal_style.fontSize = 8
+        normal_style.leading = 10
+        normal_style.alignment = TA_LEFT
+        header_style = ParagraphStyle(
+            "HeaderStyle",
+            parent=styles["Normal"],
+            fontName="Helvetica-Bold",
+            fontSize=9,
+            textColor=colors.white,
+            alignment=1
+        )
+        stile_tabella = TableStyle([
+            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#B30000")),
+            ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+            ("FONTSIZE", (0, 0), (-1, 0), 9),
+            ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+            ("ALIGN", (0, 0), (-1, 0), "CENTER"),
+            ("VALIGN", (0, 0), (-1, 0), "MIDDLE"),
+            ("FONTNAME", (0, 1), (-1, -1), "Helvetica"),
+            ("FONTSIZE", (0, 1), (-1, -1), 8),
+            ("TEXTCOLOR", (0, 1), (-1, -1), colors.black),
+            ("ALIGN", (0, 1), (-1, -1), "LEFT"),
+            ("VALIGN", (0, 1), (-1, -1), "TOP"),
+            ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.Color(0.94, 0.94, 0.94)]),
+            ("GRID", (0, 0), (-1, -1), 0.25, colors.Color(0.8, 0.8, 0.8)),
+            ("LEFTPADDING", (0, 0), (-1, -1), 5),
+            ("RIGHTPADDING", (0, 0), (-1, -1), 5),
+            ("TOPPADDING", (0, 0), (-1, -1), 3),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 3),
+        ])
+        col_widths = _larghezze_pdf(campi, page_width - 2 * cm)
+        data = [[Paragraph(campo, header_style) for campo in campi]]
+        for riga in righe:
+            data.append([Paragraph(val.replace("\n", "<br/>"), normal_style) for val in riga])
+        table = LongTable(data, colWidths=col_widths, repeatRows=1)
+        table.setStyle(stile_tabella)
+        story.append(table)
+    elif intestazione:
+        story.append(Paragraph("Nessun atto disponibile per l’esportazione.", styles["Normal"]))
+
+    doc.build(story, onFirstPage=draw_header_footer, onLaterPages=draw_header_footer)
+    return len(righe)
+
+
+class _UnionePdf:
+    """Unisce in un solo PDF, nell'ordine, le parti scritte da ReportLab.
+    Vale per il loro formato (xref classica, un solo nodo /Pages, niente
+    object stream): gli oggetti sono rinumerati e copiati, Catalog e Pages
+    delle parti sono sostituiti da quelli del documento unito. Tiene in
+    memoria una parte alla volta."""
+
+    def __init__(self, out):
+        self.out = out
+        self.posizioni = [None, None, None]  # 1 = Pages, 2 = Catalog, 3 = Info
+        self.pagine = []
+        out.write(b"%PDF-1.4\n%\x93\x8c\x8b\x9e ReportLab Generated PDF document (opensource)\n")
+
+    def _scrivi_oggetto(self, numero, corpo):
+        self.posizioni[numero - 1] = self.out.tell()
+        self.out.write(b"%d 0 obj\n" % numero + corpo + b"\nendobj\n")
+
+    def aggiungi(self, percorso):
+        with open(percorso, "rb") as f:
+            dati = f.read()
+        inizio_xref = int(dati[dati.rindex(b"startxref") + 9:].split()[0])
+        voci = dati[inizio_xref:].split(b"\n")
+        totale = int(voci[1].split()[1])
+        posizioni = {n: int(voci[2 + n][:10]) for n in range(1, totale)}
+        fini = dict(zip(sorted(posizioni.values()), sorted(posizioni.values())[1:] + [inizio_xref]))
+        trailer = dati[dati.index(b"trailer", inizio_xref):]
+        radice = int(re.search(rb"/Root (\d+) 0 R", trailer).group(1))
+        info = int(re.search(rb"/Info (\d+) 0 R", trailer).group(1))
+
+        def corpo(n):
+            testo = dati[posizioni[n]:fini[posizioni[n]]]
+            return testo[testo.index(b" obj") + 4:testo.rindex(b"endobj")].strip(b"\r\n")
+
+        nodo_pagine = int(re.search(rb"/Pages (\d+) 0 R", corpo(radice)).group(1))
+        if self.posizioni[2] is None:
+            self._scrivi_oggetto(3, corpo(info))
+        saltati = {radice, nodo_pagine, info}
+        base = len(self.posizioni)
+        nuovi = {}
+        for n in sorted(posizioni):
+            if n not in saltati:
+                nuovi[n] = base + len(nuovi) + 1
+        self.posizioni.extend([None] * len(nuovi))
+
+        def rinumera(m):
+            return b"%d 0 R" % (1 if int(m.group(1)) == nodo_pagine else nuovi[int(m.group(1))])
+
+        for n, numero in nuovi.items():
+            # i riferimenti stanno nel dizionario, mai nei dati dello stream
+            testa, sep, stream = corpo(n).partition(b"\nstream\n")
+            testa = re.sub(rb"(\d+) 0 R", rinumera, testa)
+            if re.search(rb"/Type /Page\b", testa):
+                self.pagine.append(numero)
+            self._scrivi_oggetto(numero, testa + sep + stream)
+
+    def chiudi(self):
+        kids = b" ".join(b"%d 0 R" % n for n in self.pagine)
+        self._scrivi_oggetto(1, b"<<\n/Count %d /Kids [ %s ] /Type /Pages\n>>" % (len(self.pagine), kids))
+        self._scrivi_oggetto(2, b"<<\n/PageMode /UseNone /Pages 1 0 R /Type /Catalog\n>>")
+        inizio_xref = self.out.tell()
+        self.out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(self.posizioni) + 1))
+        for posizione in self.posizioni:
+            self.out.write(b"%010d 00000 n \n" % posizione)
+        self.out.write(
+            b"trailer\n<<\n/Info 3 0 R\n/Root 2 0 R\n/Size %d\n>>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(self.posizioni) + 1, inizio_xref)
+        )
+
+
+# ----------------------------------------------------------
+# Pool di processi (creato al primo export grande, riusato)
+# ----------------------------------------------------------
+_pool_pdf = None
+_pool_pdf_lock = threading.Lock()
+
+
+def pool_pdf():
+    global _pool_pdf
+    with _pool_pdf_lock:
+        if _pool_pdf is None:
+            # spawn ovunque: un fork del server multi-thread erediterebbe lock presi
+            _pool_pdf = ProcessPoolExecutor(
+                max_workers=EXPORT_PDF_PROCESSI,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool_pdf
+
+
+def chiudi_pool_pdf():
+    global _pool_pdf
+    with _pool_pdf_lock:
+        if _pool_pdf is not None:
+            _pool_pdf.shutdown(wait=False, cancel_futures=True)
+            _pool_pdf = None
+
+
+if not PROCESSO_FIGLIO:
+    atexit.register(chiudi_pool_pdf)
+
+# ----------------------------------------------------------
+# Avanzamento degli export PDF (letto da /export/stato)
+# ----------------------------------------------------------
+_avanzamento_pdf_lock = threading.Lock()
+AVANZAMENTO_PDF = {}  # id → stato; l'id arriva dal form ("avanzamento")
+
+
+def _avanzamento_pdf(chiave, **valori):
+    with _avanzamento_pdf_lock:
+        scaduti = [k for k, v in AVANZAMENTO_PDF.items() if v["fine"] and v["fine"] < time.time() - 600]
+        for k in scaduti:
+            del AVANZAMENTO_PDF[k]
+        AVANZAMENTO_PDF.setdefault(chiave, {
+            "in_corso": True, "righe_totali": 0, "righe_fatte": 0,
+            "inizio": time.time(), "fine": None, "errore": None,
+        }).update(valori)
+
+
+def stato_export_pdf(chiave):
+    """Copia dello stato di un export PDF con stima del tempo residuo."""
+    with _avanzamento_pdf_lock:
+        stato = dict(AVANZAMENTO_PDF.get(chiave) or {"in_corso": False, "righe_totali": 0, "righe_fatte": 0})
+    stato["eta_secondi"] = None
+    if stato["in_corso"] and stato["righe_fatte"] and stato.get("inizio"):
+        trascorso = time.time() - stato["inizio"]
+        residuo = stato["righe_totali"] - stato["righe_fatte"]
+        stato["eta_secondi"] = round(trascorso * residuo / stato["righe_fatte"], 1)
+    return stato
+
+
+def _blocchi_pdf(cursore, chiavi):
+    """Righe di `cursore` a blocchi di EXPORT_PDF_RIGHE_PARTE, come liste di testi."""
+    while True:
+        righe = cursore.fetchmany(EXPORT_PDF_RIGHE_PARTE)
+        if not righe:
+            return
+        colonne = righe[0].keys()
+        yield [[str(r[k]) if k in colonne and r[k] else "" for k in chiavi] for r in righe]
+
+
+def _scrivi_pdf_a_parti(blocchi, campi, tmp, generato_il, chiave, avanza, parti, in_corso):
+    """Impagina i blocchi in parti (nel pool se EXPORT_PDF_PROCESSI > 1) e le
+    unisce in `tmp` nell'ordine del documento. `parti` e `in_corso` sono del
+    chiamante, che in caso di errore annulla i futuri e rimuove i file."""
+    # con un solo processo le parti sono impaginate qui, una alla volta
+    pool = pool_pdf() if EXPORT_PDF_PROCESSI > 1 else None
+    with open(tmp, "wb") as out:
+        unione = _UnionePdf(out)
+
+        def unisci_prima():
+            futuro, parte, fatte = in_corso.popleft()
+            if futuro is not None:
+                futuro.result()
+            unione.aggiungi(parte)
+            os.remove(parte)
+            with _avanzamento_pdf_lock:
+                AVANZAMENTO_PDF[chiave]["righe_fatte"] += fatte
+                fatte = AVANZAMENTO_PDF[chiave]["righe_fatte"]
+            if avanza:
+                avanza(fatte)
+
+        for i, blocco in enumerate(blocchi):
+            parte = f"{tmp}.{i}.part"
+            parti.append(parte)
+            argomenti = (blocco, campi, parte, i == 0, generato_il)
+            if pool is None:
+                rendi_parte_pdf(*argomenti)
+                in_corso.append((None, parte, len(blocco)))
+            else:
+                in_corso.append((pool.submit(rendi_parte_pdf, *argomenti), parte, len(blocco)))
+            # al massimo due parti in attesa per processo
+            if len(in_corso) >= 2 * EXPORT_PDF_PROCESSI:
+                unisci_prima()
+        while in_corso:
+            unisci_prima()
+        unione.chiudi()
+
+
+def scrivi_pdf_export(cursore, campi, percorso, totale, chiave=None, avanza=None):
+    """Scrive in `percorso` il PDF delle righe di `cursore` (SQL_ATTO).
+    Le righe sono lette a blocchi: in memoria restano solo le parti in lavorazione.
+    `avanza(righe_fatte)` è chiamata a ogni parte completata."""
+    chiave = chiave or secrets.token_hex(8)
+    generato_il = datetime.now().strftime("%d/%m/%Y %H:%M")
+    blocchi = _blocchi_pdf(cursore, [campo.lower() for campo in campi])
+    _avanzamento_pdf(chiave, righe_totali=totale)
+
+    tmp = f"{percorso}.{secrets.token_hex(4)}.part"
+    parti = []
+    in_corso = deque()  # (futuro o None, parte, righe) nell'ordine del documento
+    try:
+        if totale <= EXPORT_PDF_RIGHE_PARTE:
+            # una parte sola: niente pool né unione
+            righe = [riga for blocco in blocchi for riga in blocco]
+            rendi_parte_pdf(righe, campi, tmp, True, generato_il)
+            _avanzamento_pdf(chiave, righe_fatte=len(righe))
+            if avanza:
+                avanza(len(righe))
+        else:
+            _scrivi_pdf_a_parti(blocchi, campi, tmp, generato_il, chiave, avanza, parti, in_corso)
+        os.replace(tmp, percorso)
+        _avanzamento_pdf(chiave, in_corso=False, fine=time.time())
+    except Exception as e:
+        for futuro, _, _ in in_corso:
+            if futuro is not None:
+                futuro.cancel()
+        _avanzamento_pdf(chiave, in_corso=False, fine=time.time(), errore=str(e))
+        raise
+    finally:
+        for parte in parti + [tmp]:
+            if os.path.exists(parte):
+                os.remove(parte)
+
+
+@app.get("/export/stato")
+def export_stato():
+    resp = jsonify(stato_export_pdf(request.args.get("id", "")))
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.get("/export/eventi")
+def export_eventi():
+    chiave = request.args.get("id", "")
+
+    def genera():
+        while True:
+            stato = stato_export_pdf(chiave)
+            yield f"data: {json.dumps(stato)}\n\n"
+            if not stato["in_corso"]:
+                break
+            time.sleep(0.5)
+
+    resp = app.response_class(genera(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+# ==========================================================
+# 🧾 ESECUZIONE DELL'ESPORTAZIONE (Excel / PDF)
+# ==========================================================
+def flusso_export(c, formato, where, params, campi, conta=None):
+    """Generatore dei byte di un export Excel, CSV o NDJSON;
+    `conta(n)` riceve il numero di righe lette finora."""
+    if formato in ("csv", "ndjson"):
+        righe = c.execute(f"SELECT {select_campi_export(campi)} FROM norme{where}{ORDINE_NORME}", params)
+    else:
+        righe = c.execute(SQL_ATTO + where + ORDINE_NORME, params)
+    if conta:
+        righe = _conta_righe(righe, conta)
+    if formato == "csv":
+        return flusso_csv(righe, campi)
+    if formato == "ndjson":
+        return flusso_ndjson(righe, [campo.strip().lower() for campo in campi])
+    return flusso_xlsx(righe, campi)
+
+
+def _conta_righe(righe, conta):
+    for n, riga in enumerate(righe, 1):
+        conta(n)
+        yield riga
+
+
+@tipo_lavoro("export")
+def lavoro_export(parametri, avanzamento):
+    """Export completo in un file scaricabile da /lavori, poi messo in cache."""
+    tipo, filtri, campi, formato = (parametri[k] for k in ("tipo", "filtri", "campi", "formato"))
+    percorso = file_lavoro(parametri["nome"])
+    where, params = filtri_export(tipo, filtri)
+    with uso_db():
+        conn = get_db(readonly=True)
+        totale = conteggio_export(conn, tipo, filtri)
+        voce_cache = percorso_cache_export(versione_dati(conn), tipo, filtri, campi, formato)
+        avanzamento(0, totale, f"📄 Esportazione {formato.upper()} in corso…")
+        if formato == "pdf":
+            scrivi_pdf_export(conn.execute(SQL_ATTO + where + ORDINE_NORME, params),
+                              campi, percorso, totale, avanza=lambda n: avanzamento(n, totale))
+        else:
+            with open(percorso, "wb") as f:
+                for pezzo in flusso_export(conn.cursor(), formato, where, params, campi,
+                                           conta=lambda n: avanzamento(n, totale)):
+                    f.write(pezzo)
+    avanzamento(totale, totale)
+    copia_in_cache_export(voce_cache, percorso)
+    return {"file": percorso, "nome": parametri["nome"], "mimetype": FORMATI_EXPORT[formato][0],
+            "messaggio": f"✅ Esportati {totale} atti."}
+
+
+@app.route("/esegui_export", methods=["POST"])
+def esegui_export():
+    from flask import send_file as send_file_flask
 
     tipo = request.form.get("tipo", "risultati")
     campi = request.form.getlist("campi")
     formato = request.form.get("formato", "excel")
-    filtri = {k: v for k, v in request.form.items() if k not in ["campi", "formato"] and k != "tipo"}
+    filtri = {k: v for k, v in request.form.items()
+              if k not in ["campi", "formato", "avanzamento", "in_background"] and k != "tipo"}
 
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db(readonly=True)
     c = conn.cursor()
-    query = "SELECT * FROM norme WHERE 1=1"
-    params = []
-    if tipo == "risultati":
-        if filtri.get("anno"):
-            query += " AND CAST(anno AS TEXT) LIKE ?"
-            params.append(f"%{filtri['anno']}%")
-        if filtri.get("numero"):
-            query += " AND CAST(numero AS TEXT) LIKE ?"
-            params.append(f"{filtri['numero']}")
-        if filtri.get("tipologia") and filtri["tipologia"] != "Tutto":
-            query += " AND tipologia = ?"
-            params.append(filtri["tipologia"])
-        if filtri.get("argomento") and filtri["argomento"] != "Tutto":
-            query += " AND argomento LIKE ?"
-            params.append(f"%{filtri['argomento']}%")
-        if filtri.get("fonte") and filtri["fonte"] != "Tutto":
-            query += " AND fonte = ?"
-            params.append(filtri["fonte"])
-        if filtri.get("testo"):
-            query += " AND (oggetto LIKE ? OR descrizione LIKE ?)"
-            params.extend([f"%{filtri['testo']}%", f"%{filtri['testo']}%"])
-    dati = c.execute(query + " ORDER BY anno DESC, numero ASC", params).fetchall()
-    conn.close()
+    where, params = filtri_export(tipo, filtri)
+    query = SQL_ATTO + where
 
-    if not dati:
+    totale = conteggio_export(conn, tipo, filtri)
+    if not totale:
         flash("⚠️ Nessun dato trovato per l'esportazione.", "warning")
         return redirect(url_for("ricerca"))
 
+    if formato not in FORMATI_EXPORT:
+        flash("Formato esportazione non valido.", "error")
+        return redirect(url_for("ricerca"))
+
     if not campi:
         campi = ["Anno", "Numero", "Tipologia", "Oggetto"]
 
-    if formato == "excel":
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Atti Esportati"
-        rosso_milano = "B30000"
-        bianco = "FFFFFF"
-        grigio_chiaro = "F5F5F5"
-        bold_font = Font(bold=True, color=bianco)
-        header_fill = PatternFill(start_color=rosso_milano, end_color=rosso_milano, fill_type="solid")
-        normal_fill = PatternFill(start_color=bianco, end_color=bianco, fill_type="solid")
-        alt_fill = PatternFill(start_color=grigio_chiaro, end_color=grigio_chiaro, fill_type="solid")
-        thin_border = Border(
-            left=Side(style="thin", color="CCCCCC"),
-            right=Side(style="thin", color="CCCCCC"),
-            top=Side(style="thin", color="CCCCCC"),
-            bottom=Side(style="thin", color="CCCCCC")
-        )
-        last_col_letter = get_column_letter(len(campi))
-        ws.merge_cells(f"A1:{last_col_letter}1")
-        cell_header = ws["A1"]
-        cell_header.value = "COMUNE DI MILANO – Sistema GESTIONE ATTI"
-        cell_header.font = Font(bold=True, color="FFFFFF", size=14)
-        cell_header.fill = header_fill
-        cell_header.alignment = Alignment(horizontal="center", vertical="center")
-        ws.row_dimensions[1].height = 25
-
-        ws.append(campi)
-        for cell in ws[2]:
-            cell.font = bold_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-            cell.border = thin_border
-
-        for i, row in enumerate(dati, start=3):
-            for j, campo in enumerate(campi, start=1):
-                key = campo.strip().lower()
-                val = str(row[key]) if key in row.keys() and row[key] is not None else ""
-                cell = ws.cell(row=i, column=j, value=val)
-                cell.fill = alt_fill if (i % 2 == 0) else normal_fill
-                cell.border = thin_border
-                if key in ["anno", "numero", "stato"]:
-                    cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-                else:
-                    cell.alignment = Alignment(horizontal="left", vertical="top", wrap_text=True)
-
-        col_widths = {}
-        for idx, campo in enumerate(campi, start=1):
-            nome = campo.lower()
-            if nome in ["anno"]:
-                col_widths[idx] = 10
-            elif nome in ["numero"]:
-                col_widths[idx] = 12
-            elif nome in ["tipologia", "fonte", "argomento"]:
-                col_widths[idx] = 20
-            elif nome in ["oggetto"]:
-                col_widths[idx] = 40
-            elif nome in ["descrizione"]:
-                col_widths[idx] = 45
-            elif nome in ["stato"]:
-                col_widths[idx] = 15
-            elif nome in ["note"]:
-                col_widths[idx] = 25
-            else:
-                col_widths[idx] = 18
-        for col_idx, width in col_widths.items():
-            ws.column_dimensions[get_column_letter(col_idx)].width = width
-
-        binary_excel = io.BytesIO()
-        wb.save(binary_excel)
-        binary_excel.seek(0)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        return send_file_flask(
-            binary_excel,
-            as_attachment=True,
-            download_name=f"atti_{tipo}_{timestamp}.xlsx",
-            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-
-    elif formato == "pdf":
-        import io
-        from reportlab.lib.pagesizes import A4, landscape
-        from reportlab.lib.units import cm
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-        binary_pdf = io.BytesIO()
-        page_width, page_height = landscape(A4)
-        doc = SimpleDocTemplate(
-            binary_pdf,
-            pagesize=(page_width, page_height),
-            leftMargin=1 * cm,
-            rightMargin=1 * cm,
-            topMargin=2.5 * cm,
-            bottomMargin=2 * cm,
+    mimetype, estensione = FORMATI_EXPORT[formato]
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    download_name = f"atti_{tipo}_{timestamp}.{estensione}"
+    voce_cache = percorso_cache_export(versione_dati(conn), tipo, filtri, campi, formato)
+    if usa_cache_export(voce_cache):
+        return send_file_flask(voce_cache, as_attachment=True, download_name=download_name, mimetype=mimetype)
+
+    # PDF di più parti (o su richiesta qualsiasi formato): lavoro in background
+    if request.form.get("in_background") or (formato == "pdf" and totale > EXPORT_PDF_RIGHE_PARTE):
+        accoda_lavoro("export", {"tipo": tipo, "filtri": filtri, "campi": campi,
+                                 "formato": formato, "nome": download_name},
+                      f"Esportazione {formato.upper()} di {totale} atti")
+        return redirect(url_for("lavori_pagina"))
+
+    if formato != "pdf":
+        return app.response_class(
+            stream_with_context(flusso_con_cache(flusso_export(c, formato, where, params, campi), voce_cache)),
+            mimetype=mimetype,
+            headers={"Content-Disposition": f"attachment; filename={download_name}"},
         )
-        styles = getSampleStyleSheet()
-        story = []
-
-        from reportlab.lib import colors
-
-        def draw_header_footer(canvas, doc_obj):
-            canvas.setFillColor(colors.HexColor("#B30000"))
-            canvas.rect(0, page_height - 50, page_width, 25, stroke=0, fill=1)
-            canvas.setFillColor(colors.white)
-            canvas.setFont("Helvetica-Bold", 13)
-            canvas.drawString(2 * cm, page_height - 42, "COMUNE DI MILANO – Sistema GESTIONE ATTI")
-            canvas.setFont("Helvetica", 9)
-            canvas.setFillColor(colors.gray)
-            canvas.drawString(2 * cm, 1 * cm, "Comune di Milano – Sistema GESTIONE ATTI")
-            canvas.drawRightString(page_width - 2 * cm, 1 * cm, datetime.now().strftime("%d/%m/%Y %H:%M"))
 
-        story.append(Spacer(1, 1 * cm))
-        story.append(Paragraph("<b>Archivio Atti Esportato</b>", styles["Heading2"]))
-        story.append(Paragraph("Esportazione generata automaticamente dal sistema <b>GESTIONE ATTI</b>.", styles["Normal"]))
-        story.append(Spacer(1, 0.5 * cm))
+    # PDF piccolo: una parte sola, impaginata qui e scritta direttamente nella cache
+    scrivi_pdf_export(c.execute(query + ORDINE_NORME, params), campi, voce_cache,
+                      totale, request.form.get("avanzamento"))
+    risposta = send_file_flask(voce_cache, as_attachment=True, download_name=download_name, mimetype=mimetype)
+    pota_cache_export()
+    return risposta
 
-        if dati:
-            from reportlab.lib.enums import TA_LEFT
-            normal_style = styles["Normal"]
-            normal_style.fontSize = 8
-            normal_style.leading = 10
-            normal_style.alignment = TA_LEFT
-            header_style = ParagraphStyle(
-                "HeaderStyle",
-                parent=styles["Normal"],
-                fontName="Helvetica-Bold",
-                fontSize=9,
-                textColor=colors.white,
-                alignment=1
-            )
-            data = [[Paragraph(campo, header_style) for campo in campi]]
-            for row in dati:
-                riga = []
-                for c_field in campi:
-                    key = c_field.lower()
-                    val = ""
-                    if key in row.keys() and row[key]:
-                        val = str(row[key])
-                    riga.append(Paragraph(val.replace("\n", "<br/>"), normal_style))
-                data.append(riga)
-
-            usable_width = page_width - 2 * cm
-            col_widths_guess = []
-            for name in campi:
-                nome = name.lower()
-                if nome in ["anno"]:
-                    col_widths_guess.append(2.0 * cm)
-                elif nome in ["numero"]:
-                    col_widths_guess.append(2.5 * cm)
-                elif nome in ["tipologia", "fonte", "argomento"]:
-                    col_widths_guess.append(4.0 * cm)
-                elif nome in ["stato"]:
-                    col_widths_guess.append(2.5 * cm)
-                elif nome in ["note"]:
-                    col_widths_guess.append(5.0 * cm)
-                elif nome in ["oggetto"]:
-                    col_widths_guess.append(7.0 * cm)
-                elif nome in ["descrizione"]:
-                    col_widths_guess.append(8.0 * cm)
-                else:
-                    col_widths_guess.append(usable_width / len(campi))
-            scale = usable_width / sum(col_widths_guess)
-            col_widths = [w * scale for w in col_widths_guess]
-
-            table = Table(data, colWidths=col_widths, repeatRows=1)
-            table.setStyle(TableStyle([
-                ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#B30000")),
-                ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-                ("FONTSIZE", (0, 0), (-1, 0), 9),
-                ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-                ("ALIGN", (0, 0), (-1, 0), "CENTER"),
-                ("VALIGN", (0, 0), (-1, 0), "MIDDLE"),
-                ("FONTNAME", (0, 1), (-1, -1), "Helvetica"),
-                ("FONTSIZE", (0, 1), (-1, -1), 8),
-                ("TEXTCOLOR", (0, 1), (-1, -1), colors.black),
-                ("ALIGN", (0, 1), (-1, -1), "LEFT"),
-                ("VALIGN", (0, 1), (-1, -1), "TOP"),
-                ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.Color(0.94, 0.94, 0.94)]),
-                ("GRID", (0, 0), (-1, -1), 0.25, colors.Color(0.8, 0.8, 0.8)),
-                ("LEFTPADDING", (0, 0), (-1, -1), 5),
-                ("RIGHTPADDING", (0, 0), (-1, -1), 5),
-                ("TOPPADDING", (0, 0), (-1, -1), 3),
-                ("BOTTOMPADDING", (0, 0), (-1, -1), 3),
-            ]))
-            story.append(Spacer(1, 6))
-            story.append(table)
-        else:
-            story.append(Paragraph("Nessun atto disponibile per l’esportazione.", styles["Normal"]))
-
-        doc.build(story, onFirstPage=draw_header_footer, onLaterPages=draw_header_footer)
-        binary_pdf.seek(0)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        return send_file_flask(
-            binary_pdf,
-            as_attachment=True,
-            download_name=f"atti_{tipo}_{timestamp}.pdf",
-            mimetype="application/pdf"
-        )
 
-    flash("Formato esportazione non valido.", "error")
-    return redirect(url_for("ricerca"))
 # ==========================================================
 # 📊 DETTAGLIO / MODIFICA / INSERIMENTO ATTI (con Audit)
 # ==========================================================
@@ -1795,59 +5132,134 @@ def registra_audit(azione, norma_id, old_row, new_data):
     except Exception:
         traceback.print_exc()
 
-def aggiorna_excel_singolo(norma_id):
-    """Aggiorna (se esiste) la riga corrispondente in EXCEL_FILE per l'atto indicato."""
-    if not os.path.exists(EXCEL_FILE):
-        return
+
+# ==========================================================
+# 📗 EXCEL SPECCHIO DEL DATABASE (rigenerato in background)
+# ==========================================================
+# Il DB è la fonte dei dati; Elenconorme.xlsx ne è una copia rigenerata al più
+# una volta ogni EXCEL_SPECCHIO_INTERVALLO secondi, solo se la generazione dei
+# dati è cambiata dall'ultima scrittura (meta 'generazione_excel'), e comunque
+# prima dell'invio in rete, dei backup e alla chiusura. Una modifica costa
+# così un solo UPDATE su SQLite, non la rilettura e riscrittura del file.
+EXCEL_SPECCHIO_INTERVALLO = int(os.getenv("COMPENDIO_EXCEL_INTERVALLO", "60"))
+EXCEL_INTESTAZIONI = ["Anno", "Tipologia", "Numero", "Oggetto", "Argomento",
+                      "Fonte", "FilePDF", "Descrizione", "Stato", "Note"]
+_specchio_lock = threading.Lock()
+_specchio_stop = threading.Event()
+_specchio_avviato = threading.Event()
+
+
+def _intestazioni_excel():
+    """Intestazioni del file esistente che corrispondono a colonne di `norme`
+    (stesso ordine e stesse maiuscole), altrimenti EXCEL_INTESTAZIONI."""
+    if os.path.exists(EXCEL_FILE):
+        from openpyxl import load_workbook
+        try:
+            wb = load_workbook(EXCEL_FILE, read_only=True)
+            try:
+                prima = next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), ())
+            finally:
+                wb.close()
+            intestazioni = [str(v).strip() for v in prima
+                            if v is not None and str(v).strip().lower() in COLONNE_NORME]
+            if {"anno", "numero"} <= {v.lower() for v in intestazioni}:
+                return intestazioni
+        except Exception:
+            traceback.print_exc()
+    return list(EXCEL_INTESTAZIONI)
+
+
+def _valore_excel(colonna, valore):
+    # anno e numero interi tornano numeri, come nel file originale
+    if colonna in ("anno", "numero") and isinstance(valore, str) and valore.isdigit() \
+            and str(int(valore)) == valore:
+        return int(valore)
+    return valore
+
+
+def scrivi_excel_specchio(forza=False):
+    """Rigenera EXCEL_FILE da `norme` (openpyxl write_only, file temporaneo +
+    os.replace) se i dati sono cambiati dall'ultima scrittura.
+    Ritorna True se il file è stato scritto."""
+    from openpyxl import Workbook
+    with _specchio_lock, uso_db():
+        conn = get_db()
+        generazione = generazione_dati(conn)
+        scritta = conn.execute("SELECT valore FROM meta WHERE chiave = 'generazione_excel'").fetchone()
+        if scritta is None:
+            # prima esecuzione: il file esistente vale come allineato
+            conn.execute("INSERT INTO meta (chiave, valore) VALUES ('generazione_excel', ?)", (generazione,))
+            conn.commit()
+            scritta = (generazione,)
+        if not forza and scritta[0] == generazione and os.path.exists(EXCEL_FILE):
+            return False
+
+        intestazioni = _intestazioni_excel()
+        colonne = [v.lower() for v in intestazioni]
+        wb = Workbook(write_only=True)
+        foglio = wb.create_sheet("Sheet1")
+        foglio.append(intestazioni)
+        for riga in conn.execute(f"SELECT {', '.join(colonne)} FROM norme ORDER BY id"):
+            foglio.append([_valore_excel(col, v) for col, v in zip(colonne, riga)])
+        tmp = EXCEL_FILE + ".tmp.xlsx"
+        try:
+            wb.save(tmp)
+            os.replace(tmp, EXCEL_FILE)
+        except OSError:
+            # es. file aperto in Excel su Windows: si riprova al prossimo giro
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        conn.execute("UPDATE meta SET valore = ? WHERE chiave = 'generazione_excel'", (generazione,))
+        conn.commit()
+    print(f"📗 Excel aggiornato dal database (generazione {generazione}).")
+    return True
+
+
+def _worker_specchio():
+    while not _specchio_stop.wait(EXCEL_SPECCHIO_INTERVALLO):
+        try:
+            scrivi_excel_specchio()
+        except Exception:
+            traceback.print_exc()
+
+
+def avvia_specchio_excel():
+    """Avvia (una volta sola) il thread che tiene allineato l'Excel."""
+    if not _specchio_avviato.is_set():
+        _specchio_avviato.set()
+        threading.Thread(target=_worker_specchio, name="excel-specchio", daemon=True).start()
+
+
+def svuota_specchio_excel():
+    """Scrive subito l'Excel se ci sono modifiche in sospeso (chiusura, invio, backup)."""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        r = c.execute("SELECT * FROM norme WHERE id=?", (norma_id,)).fetchone()
-        conn.close()
-        if not r:
-            return
-        df = pd.read_excel(EXCEL_FILE)
-        # normalizza nomi
-        cols = [c.strip().lower() for c in df.columns]
-        colmap = {c.lower(): i for i, c in enumerate(df.columns)}
-        # match per anno + numero + fonte
-        mask = (
-            df.iloc[:, colmap.get("anno")].astype(str).str.strip() == str(r["anno"]).strip()
-        ) & (
-            df.iloc[:, colmap.get("numero")].astype(str).str.strip() == str(r["numero"]).strip()
-        )
-        if "fonte" in colmap:
-            mask &= df.iloc[:, colmap["fonte"]].astype(str).str.strip() == str(r["fonte"]).strip()
-        if not mask.any():
-            # non trovato → opzionale: append
-            return
-        idx = df[mask].index
-        def set_if_col(colname, value):
-            ci = colmap.get(colname)
-            if ci is not None:
-                df.iloc[idx, ci] = value
-        set_if_col("anno", r["anno"])
-        set_if_col("numero", r["numero"])
-        set_if_col("tipologia", r["tipologia"])
-        set_if_col("argomento", r["argomento"])
-        set_if_col("oggetto", r["oggetto"])
-        set_if_col("descrizione", r["descrizione"])
-        set_if_col("stato", r["stato"])
-        set_if_col("note", r["note"])
-        set_if_col("fonte", r["fonte"])
-        set_if_col("filepdf", r["filepdf"])
-        df.to_excel(EXCEL_FILE, index=False)
+        scrivi_excel_specchio()
     except Exception:
         traceback.print_exc()
 
+
+if not PROCESSO_FIGLIO:
+    atexit.register(svuota_specchio_excel)
+
+
+@app.post("/excel/aggiorna")
+def excel_aggiorna():
+    if not session.get("admin"):
+        flash("⚠️ Accesso non autorizzato.", "warning")
+        return redirect(url_for("admin_login"))
+    try:
+        scrivi_excel_specchio(forza=True)
+        flash("📗 Excel rigenerato dal database.", "success")
+    except Exception as e:
+        traceback.print_exc()
+        flash(f"❌ Errore durante l'aggiornamento dell'Excel: {e}", "error")
+    return redirect(request.referrer or url_for("admin_dashboard"))
+
+
 @app.route("/dettaglio/<int:norma_id>")
 def dettaglio(norma_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    norma = c.execute("SELECT * FROM norme WHERE id=?", (norma_id,)).fetchone()
-    conn.close()
+    norma = get_db(readonly=True).execute(SQL_ATTO + " WHERE id=?", (norma_id,)).fetchone()
 
     # Pulizia NAN + None
     if norma:
@@ -1856,14 +5268,16 @@ def dettaglio(norma_id):
             if v is None or str(v).strip().lower() == "nan":
                 norma[k] = ""
 
-    return render_template("dettaglio.html", norma=norma)
+    # la storia delle modifiche (con IP e utenti) è visibile solo all'admin
+    storia = storia_atto(get_db(readonly=True), norma_id) if session.get("admin") else None
+    return render_template("dettaglio.html", norma=norma, storia=storia)
+
 
 @app.route("/modifica/<int:norma_id>", methods=["GET", "POST"])
 @require_write_lock
 def modifica(norma_id):
     """Modifica atto con blocco per singolo record."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db(readonly=request.method == "GET")
     c = conn.cursor()
 
     # -------------------------
@@ -1871,7 +5285,7 @@ def modifica(norma_id):
     # -------------------------
     if request.method == "POST":
         # Dati vecchi
-        old = c.execute("SELECT * FROM norme WHERE id=?", (norma_id,)).fetchone()
+        old = c.execute(SQL_ATTO + " WHERE id=?", (norma_id,)).fetchone()
 
         # Nuovi dati
         data = {k: request.form.get(k, "").strip() for k in
@@ -1879,26 +5293,30 @@ def modifica(norma_id):
                  "descrizione", "stato", "note", "fonte"]}
 
         # UPDATE
-        c.execute("""
-            UPDATE norme SET
-                anno=?, numero=?, tipologia=?, argomento=?, oggetto=?, 
-                descrizione=?, stato=?, note=?, fonte=?
-            WHERE id=?
-        """, (
-            data["anno"], data["numero"], data["tipologia"], data["argomento"],
-            data["oggetto"], data["descrizione"], data["stato"], data["note"],
-            data["fonte"], norma_id
-        ))
-        conn.commit()
+        try:
+            c.execute("""
+                UPDATE norme SET
+                    anno=?, numero=?, tipologia=?, argomento=?, oggetto=?,
+                    descrizione=?, stato=?, note=?, fonte=?
+                WHERE id=?
+            """, (
+                data["anno"], data["numero"], data["tipologia"], data["argomento"],
+                data["oggetto"], data["descrizione"], data["stato"], data["note"],
+                data["fonte"], norma_id
+            ))
+            incrementa_generazione(conn)
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            flash("⚠️ Esiste già un atto con stessi anno, numero, tipologia, fonte e argomento.", "warning")
+            return redirect(url_for("modifica", norma_id=norma_id))
 
-        # Aggiornamento Excel locale
-        aggiorna_excel_singolo(norma_id)
+        # l'Excel si riallinea in background (specchio del DB)
+        avvia_specchio_excel()
 
         # Audit
         registra_audit("modifica", norma_id, old, data)
 
-        conn.close()
-
         # 🔓 Rilascio lock per QUESTO ATTO
         release_record_lock(norma_id)
 
@@ -1914,13 +5332,11 @@ def modifica(norma_id):
 
     # Prova a prendere il lock per questo atto
     if not acquire_record_lock(norma_id):
-        conn.close()
         flash("⚠️ Questo atto è attualmente in modifica da un altro utente.", "warning")
         return redirect(url_for("dettaglio", norma_id=norma_id))
 
     # Carica record e mostra pagina di modifica
-    norma = c.execute("SELECT * FROM norme WHERE id=?", (norma_id,)).fetchone()
-    conn.close()
+    norma = c.execute(SQL_ATTO + " WHERE id=?", (norma_id,)).fetchone()
 
     return render_template("modifica.html", norma=norma)
 
@@ -1928,16 +5344,9 @@ def modifica(norma_id):
 @require_write_lock
 def inserisci():
     # combobox valori
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    tipologie = [r["tipologia"] for r in c.execute(
-        "SELECT DISTINCT tipologia FROM norme WHERE tipologia != '' ORDER BY tipologia").fetchall()]
-    argomenti = [r["argomento"] for r in c.execute(
-        "SELECT DISTINCT argomento FROM norme WHERE argomento != '' ORDER BY argomento").fetchall()]
-    fonti = [r["fonte"] for r in c.execute(
-        "SELECT DISTINCT fonte FROM norme WHERE fonte != '' ORDER BY fonte").fetchall()]
-    conn.close()
+    tipologie = valori_faccetta("tipologia")
+    argomenti = valori_faccetta("argomento")
+    fonti = valori_faccetta("fonte")
 
     if request.method == "POST":
         campi = ["anno", "numero", "tipologia", "argomento", "oggetto",
@@ -1956,37 +5365,31 @@ def inserisci():
         file = request.files.get("filepdf")
         filepdf_name = ""
         pdf_caricato = False
+        conn = get_db()
+        c = conn.cursor()
         if file and allowed_file(file.filename):
-            base_name = secure_filename(file.filename.rsplit(".", 1)[0])
-            filepdf_name = f"{base_name}.pdf"
-            save_path = os.path.join(PDF_FOLDER, filepdf_name)
-            file.save(save_path)
+            sha256, dimensione = archivia_upload(file)
+            filepdf_name = nome_pdf_caricato(conn, file, sha256)
             pdf_caricato = True
 
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO norme (anno, numero, tipologia, argomento, oggetto,
-                               descrizione, stato, note, fonte, filepdf)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (*dati, filepdf_name))
-        conn.commit()
+        try:
+            if pdf_caricato:
+                registra_pdf(conn, filepdf_name, sha256, dimensione)
+            c.execute("""
+                INSERT INTO norme (anno, numero, tipologia, argomento, oggetto,
+                                   descrizione, stato, note, fonte, filepdf)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (*dati, filepdf_name))
+            incrementa_generazione(conn)
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            if pdf_caricato:
+                pota_archivio_pdf(conn, [sha256])
+            flash("⚠️ Esiste già un atto con stessi anno, numero, tipologia, fonte e argomento.", "warning")
+            return redirect(url_for("inserisci"))
         new_id = c.lastrowid
-        conn.close()
-
-        if os.path.exists(EXCEL_FILE):
-            try:
-                df = pd.read_excel(EXCEL_FILE)
-                nuova_riga = pd.DataFrame([{
-                    "Anno": dati[0], "Numero": dati[1], "Tipologia": dati[2],
-                    "Argomento": dati[3], "Oggetto": dati[4], "Descrizione": dati[5],
-                    "Stato": dati[6], "Note": dati[7], "Fonte": dati[8],
-                    "FilePDF": filepdf_name
-                }])
-                df = pd.concat([df, nuova_riga], ignore_index=True)
-                df.to_excel(EXCEL_FILE, index=False)
-            except Exception:
-                traceback.print_exc()
+        avvia_specchio_excel()  # l'Excel si riallinea in background
 
         log_event("insert", norma_id=new_id, details={
             "anno": dati[0], "numero": dati[1], "tipologia": dati[2],
@@ -2012,11 +5415,7 @@ def inserisci():
 @app.route("/carica_pdf/<int:norma_id>", methods=["GET", "POST"])
 @require_write_lock
 def carica_pdf(norma_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    norma = c.execute("SELECT * FROM norme WHERE id=?", (norma_id,)).fetchone()
-    conn.close()
+    norma = get_db(readonly=True).execute(SQL_ATTO + " WHERE id=?", (norma_id,)).fetchone()
 
     if request.method == "POST":
         file = request.files.get("filepdf")
@@ -2024,39 +5423,25 @@ def carica_pdf(norma_id):
             flash("⚠️ Caricare un file PDF valido.", "error")
             return redirect(url_for("carica_pdf", norma_id=norma_id))
         try:
-            base_name = secure_filename(file.filename.rsplit(".", 1)[0])
-            final_name = f"{base_name}.pdf"
-            save_path = os.path.join(PDF_FOLDER, final_name)
-            file.save(save_path)
+            sha256, dimensione = archivia_upload(file)
 
             # aggiorna DB
-            conn = sqlite3.connect(DB_FILE)
-            conn.row_factory = sqlite3.Row
-            c = conn.cursor()
-            old_row = c.execute("SELECT filepdf FROM norme WHERE id=?", (norma_id,)).fetchone()
+            conn = get_db()
+            final_name = nome_pdf_caricato(conn, file, sha256, norma_id)
+            old_row = conn.execute("SELECT filepdf FROM norme WHERE id=?", (norma_id,)).fetchone()
             old_name = old_row["filepdf"] if old_row else ""
-            c.execute("UPDATE norme SET filepdf=? WHERE id=?", (final_name, norma_id))
+            conn.execute("UPDATE norme SET filepdf=? WHERE id=?", (final_name, norma_id))
+            sostituito = registra_pdf(conn, final_name, sha256, dimensione)
+            incrementa_generazione(conn)
             conn.commit()
-            conn.close()
+            pota_archivio_pdf(conn, [sostituito])
 
             # audit pdf_upload/pdf_replace
             action = "pdf_replace" if (old_name or "") else "pdf_upload"
             log_event(action, norma_id=norma_id, details={"old": old_name or "", "new": final_name})
 
-            # aggiorna Excel (best effort)
-            try:
-                if os.path.exists(EXCEL_FILE) and norma:
-                    df = pd.read_excel(EXCEL_FILE)
-                    mask = (df["Anno"].astype(str) == str(norma["anno"])) & \
-                           (df["Numero"].astype(str) == str(norma["numero"]))
-                    if "FilePDF" in df.columns and mask.any():
-                        df.loc[mask, "FilePDF"] = final_name
-                        df.to_excel(EXCEL_FILE, index=False)
-            except Exception:
-                traceback.print_exc()
-
-            backup_excel()
-            backup_pdf()
+            backup_excel()  # allinea prima l'Excel al DB
+            backup_pdf(conn)
 
             # 🔓 Rilascio lock dopo il caricamento del PDF
             try:
@@ -2074,32 +5459,143 @@ def carica_pdf(norma_id):
 
 @app.route("/pdf/<filename>")
 def apri_pdf(filename):
-    pdf_folder = PDF_FOLDER
     if not filename.lower().endswith(".pdf"):
         filename += ".pdf"
-    path = os.path.join(pdf_folder, filename)
-    if not os.path.exists(path):
+    path = percorso_pdf(get_db(readonly=True), filename)
+    if path is None:
         flash(f"⚠️ Il file PDF \"{filename}\" non è stato trovato nella cartella PDF condivisa.", "error")
         return redirect(url_for("ricerca"))
-    return send_from_directory(pdf_folder, filename)
+    if path.startswith(PDF_FOLDER):
+        return send_from_directory(PDF_FOLDER, filename)  # non ancora archiviato
+    return send_file(path, mimetype="application/pdf", download_name=filename)
+
 
 # ==========================================================
 # 👀 AUDIT VIEW (solo admin) — endpoint + alias robusti
 # ==========================================================
-def _render_audit_table(rows):
+AUDIT_PER_PAGINA = 100
+AUDIT_FILTRI = ("action", "norma_id", "actor", "ip", "dal", "al")
+
+
+def _data_iso(testo):
+    """'YYYY-MM-DD' se valida, altrimenti None."""
+    try:
+        return datetime.strptime((testo or "").strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+def _inizio_giorno_utc(data_iso, giorni=0):
+    """Mezzanotte locale di data_iso (+ giorni) come 'YYYY-MM-DD HH:MM:SS' UTC,
+    il formato di audit.ts: i filtri dal/al sono date locali."""
+    giorno = datetime.strptime(data_iso, "%Y-%m-%d") + timedelta(days=giorni)
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.mktime(giorno.timetuple())))
+
+
+def filtri_audit(args):
+    """(where, params) dai filtri della consultazione audit (indici: migrazione 3)."""
+    where, params = " WHERE 1=1", []
+    for col in ("action", "actor", "ip"):
+        valore = (args.get(col) or "").strip()
+        if valore:
+            where += f" AND {col} = ?"
+            params.append(valore)
+    norma_id = (args.get("norma_id") or "").strip()
+    if norma_id.isdigit():
+        where += " AND norma_id = ?"
+        params.append(int(norma_id))
+    dal, al = _data_iso(args.get("dal")), _data_iso(args.get("al"))
+    if dal:
+        where += " AND ts >= ?"
+        params.append(_inizio_giorno_utc(dal))
+    if al:
+        where += " AND ts < ?"
+        params.append(_inizio_giorno_utc(al, giorni=1))
+    return where, params
+
+
+def pagina_audit(conn, args, per_pagina=AUDIT_PER_PAGINA):
+    """Una pagina di eventi (keyset su id decrescente): ritorna (righe, prima_di)
+    dove prima_di è l'id da passare per la pagina successiva (None se finita)."""
+    where, params = filtri_audit(args)
+    prima_di = (args.get("prima_di") or "").strip()
+    if prima_di.isdigit():
+        where += " AND id < ?"
+        params.append(int(prima_di))
+    rows = conn.execute(
+        "SELECT * FROM audit" + where + " ORDER BY id DESC LIMIT ?", params + [per_pagina + 1]
+    ).fetchall()
+    if len(rows) > per_pagina:
+        return rows[:per_pagina], rows[per_pagina - 1]["id"]
+    return rows, None
+
+
+def modifiche_audit(action, details):
+    """Ricostruisce [(campo, vecchio, nuovo), ...] dai dettagli di un evento
+    (differenze di registra_audit, inserimenti, PDF, eliminazioni)."""
+    try:
+        d = json.loads(details) if details else {}
+    except ValueError:
+        return []
+    if not isinstance(d, dict):
+        return []
+    if all(isinstance(v, dict) and set(v) <= {"old", "new"} for v in d.values()):
+        return [(campo, v.get("old"), v.get("new")) for campo, v in d.items()]
+    if isinstance(d.get("new"), dict):  # registra_audit senza riga precedente
+        return [(campo, None, v) for campo, v in d["new"].items()]
+    if action.startswith("pdf_"):
+        return [("filepdf", d.get("old") or None, d.get("new"))]
+    if action.startswith("delete"):
+        return [(campo, v, None) for campo, v in d.items()]
+    return [(campo, None, v) for campo, v in d.items()]
+
+
+def storia_atto(conn, norma_id, archivi=False):
+    """Eventi di audit di un atto, dal più recente, con le modifiche per campo.
+    Con archivi=True include anche gli eventi spostati negli archivi mensili."""
+    rows = conn.execute(
+        "SELECT id, ts, action, actor, ip, details FROM audit WHERE norma_id=? ORDER BY id DESC",
+        (norma_id,),
+    ).fetchall()
+    if archivi:
+        rows += eventi_archiviati(norma_id)
+    return [
+        {"id": r["id"], "ts": r["ts"], "action": r["action"], "actor": r["actor"],
+         "ip": r["ip"], "modifiche": modifiche_audit(r["action"], r["details"])}
+        for r in rows
+    ]
+
+
+def _render_audit_table(rows, filtri=None, azioni=(), prossima=None):
     # Fallback HTML se manca il template audit.html
-    html = ["<h2>Audit log (ultimi 300 eventi)</h2>",
+    filtri = filtri or {}
+    opzioni = "".join(
+        f"<option value='{escape(a)}'{' selected' if a == filtri.get('action') else ''}>{escape(a)}</option>"
+        for a in azioni
+    )
+    html = ["<h2>Audit log</h2>",
+            "<form method='get' style='margin-bottom:12px'>"
+            f"Azione <select name='action'><option value=''>tutte</option>{opzioni}</select> "
+            f"ID atto <input name='norma_id' size='6' value='{escape(filtri.get('norma_id', ''))}'> "
+            f"Utente <input name='actor' size='8' value='{escape(filtri.get('actor', ''))}'> "
+            f"IP <input name='ip' size='12' value='{escape(filtri.get('ip', ''))}'> "
+            f"Dal <input type='date' name='dal' value='{escape(filtri.get('dal', ''))}'> "
+            f"Al <input type='date' name='al' value='{escape(filtri.get('al', ''))}'> "
+            "<button type='submit'>Filtra</button></form>",
             "<table border='1' cellpadding='6' cellspacing='0'>",
-            "<tr><th>#</th><th>Quando</th><th>Azione</th><th>ID Atto</th>"
+            "<tr><th>#</th><th>Quando (UTC)</th><th>Azione</th><th>ID Atto</th>"
             "<th>Utente</th><th>IP</th><th>User-Agent</th><th>Dettagli</th></tr>"]
     for e in rows:
         html.append(
-            f"<tr><td>{e['id']}</td><td>{e['ts']}</td><td>{e['action']}</td>"
-            f"<td>{e['norma_id'] or ''}</td><td>{e['actor']}</td><td>{e['ip']}</td>"
-            f"<td style='font-size:12px;color:#666'>{(e['user_agent'] or '')}</td>"
-            f"<td><pre style='white-space:pre-wrap'>{e['details'] or ''}</pre></td></tr>"
+            f"<tr><td>{e['id']}</td><td>{escape(e['ts'] or '')}</td><td>{escape(e['action'] or '')}</td>"
+            f"<td>{e['norma_id'] or ''}</td><td>{escape(e['actor'] or '')}</td><td>{escape(e['ip'] or '')}</td>"
+            f"<td style='font-size:12px;color:#666'>{escape(e['user_agent'] or '')}</td>"
+            f"<td><pre style='white-space:pre-wrap'>{escape(e['details'] or '')}</pre></td></tr>"
         )
-    html.append("</table><p><a href='/admin_dashboard'>⬅︎ Torna alla dashboard</a></p>")
+    html.append("</table>")
+    if prossima:
+        html.append(f"<p><a href='{escape(prossima)}'>Eventi precedenti ➡︎</a></p>")
+    html.append("<p><a href='/admin_dashboard'>⬅︎ Torna alla dashboard</a></p>")
     return "\n".join(html)
 
 def audit_view_handler():
@@ -2107,14 +5603,41 @@ def audit_view_handler():
         flash("⚠️ Accesso non autorizzato.", "warning")
         return redirect(url_for("admin_login"))
 
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    rows = conn.execute("SELECT * FROM audit ORDER BY id DESC LIMIT 300").fetchall()
-    conn.close()
+    conn = get_db(readonly=True)
+    filtri = {k: request.args[k] for k in AUDIT_FILTRI if request.args.get(k)}
+    rows, prima_di = pagina_audit(conn, request.args)
+    azioni = [r[0] for r in conn.execute("SELECT DISTINCT action FROM audit ORDER BY action")]
+    prossima = url_for(request.endpoint, prima_di=prima_di, **filtri) if prima_di else None
+    try:
+        return render_template("audit.html", events=rows, filtri=filtri, azioni=azioni,
+                               prossima=prossima)
+    except TemplateNotFound:
+        return _render_audit_table(rows, filtri, azioni, prossima)
+
+
+@app.route("/dettaglio/<int:norma_id>/storia")
+def storia_dettaglio(norma_id):
+    if not session.get("admin"):
+        flash("⚠️ Accesso non autorizzato.", "warning")
+        return redirect(url_for("admin_login"))
+
+    storia = storia_atto(get_db(readonly=True), norma_id, archivi=True)
     try:
-        return render_template("audit.html", events=rows)
+        return render_template("storia_atto.html", norma_id=norma_id, storia=storia)
     except TemplateNotFound:
-        return _render_audit_table(rows)
+        html = [f"<h2>Storia dell'atto #{norma_id}</h2>"]
+        for e in storia:
+            html.append(f"<h4>{e['ts']} — {escape(e['action'])} ({escape(e['actor'] or '')}, {escape(e['ip'] or '')})</h4>")
+            if e["modifiche"]:
+                html.append("<table border='1' cellpadding='4' cellspacing='0'>"
+                            "<tr><th>Campo</th><th>Prima</th><th>Dopo</th></tr>")
+                for campo, vecchio, nuovo in e["modifiche"]:
+                    html.append(f"<tr><td>{escape(campo)}</td><td>{escape(vecchio if vecchio is not None else '')}</td>"
+                                f"<td>{escape(nuovo if nuovo is not None else '')}</td></tr>")
+                html.append("</table>")
+        html.append(f"<p><a href='{url_for('dettaglio', norma_id=norma_id)}'>⬅︎ Torna al dettaglio</a></p>")
+        return "\n".join(html)
+
 
 # Registra SEMPRE entrambi gli endpoint (se non esistono già).
 def _ensure_audit_routes():
@@ -2161,21 +5684,28 @@ def boot_ready_redirect_js():
 @app.post("/kill-python")
 def kill_python():
     import os
+    svuota_audit()  # os._exit salta gli handler atexit
+    svuota_specchio_excel()
     os._exit(0)
 
 if __name__ == "__main__":
-    print("🔎 Verifica rete…")
-
-    if is_online():
-        print("🌐 Sei ONLINE → provo a sincronizzare da rete.")
-        sync_from_network()
-    else:
-        print("📴 OFFLINE → uso solo database locale.")
-
+    multiprocessing.freeze_support()  # processi del pool PDF nell'eseguibile
     crea_database()
     ensure_audit_table()
 
+    # la sincronizzazione con la rete non blocca l'avvio: si serve subito
+    # la copia locale e il worker la aggiorna (e invia le modifiche) in background
+    print("🔎 Verifica rete e sincronizzazione in background…")
+    avvia_sonda_rete()
+    avvia_sync_in_background()
+    avvia_specchio_excel()
+    avvia_lavori()
+    avvia_riconciliazione_pdf()
+
     app.run(debug=True, port=5001, use_reloader=False)
 
-    # Alla chiusura prova a sincronizzare locale → rete (solo se online e con lock)
-    sync_to_network()
\ No newline at end of file
+    # Alla chiusura invia le modifiche locali ancora in sospeso (solo se online)
+    ferma_sync()
+    svuota_audit()
+    svuota_specchio_excel()
+    ciclo_sync()
@@ -0,0 +1,83 @@
+import importlib.util
+import os
+import shutil
+import sys
+import webbrowser
+
+import pytest
+
+RADICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def A(tmp_path_factory):
+    """CompendioAtti importato da una copia in una cartella temporanea:
+    data_local, .env, PDF e cache dei test non toccano il repository."""
+    cartella = tmp_path_factory.mktemp("compendio")
+    shutil.copy(os.path.join(RADICE, "CompendioAtti.py"), cartella)
+    # i template veri non sono nel repository: ricerca.html minimale
+    (cartella / "templates").mkdir()
+    (cartella / "templates" / "ricerca.html").write_text(
+        "<html><body>{% for n in norme %}<p class='atto'>{{ n['id'] }}</p>{% endfor %}</body></html>",
+        encoding="utf-8")
+    webbrowser.open = lambda *a, **k: False  # niente pagina di loading
+    os.environ.setdefault("COMPENDIO_PDF_PROCESSI", "1")
+    cwd = os.getcwd()
+    os.chdir(cartella)
+    try:
+        spec = importlib.util.spec_from_file_location("CompendioAtti", cartella / "CompendioAtti.py")
+        modulo = importlib.util.module_from_spec(spec)
+        sys.modules["CompendioAtti"] = modulo
+        spec.loader.exec_module(modulo)
+    finally:
+        os.chdir(cwd)
+    modulo.app.config["TESTING"] = True
+    return modulo
+
+
+@pytest.fixture
+def db(A, tmp_path):
+    """Database nuovo (crea_database + migrazioni) per ogni test."""
+    A.chiudi_connessioni()
+    A.DB_FILE = str(tmp_path / "compendio_norme.db")
+    A.crea_database()
+    yield A.get_db()
+    A.chiudi_connessioni()
+
+
+@pytest.fixture
+def client(A, db):
+    return A.app.test_client()
+
+
+@pytest.fixture
+def inserisci(db):
+    """inserisci([{"anno": ..., "numero": ..., ...}, ...]): campi mancanti a ''."""
+    campi = ["anno", "numero", "tipologia", "argomento", "oggetto", "fonte",
+             "filepdf", "descrizione", "stato", "note"]
+
+    def _inserisci(righe):
+        db.executemany(
+            f"INSERT INTO norme ({', '.join(campi)}) VALUES ({', '.join('?' * len(campi))})",
+            [[str(r.get(c, "")) for c in campi] for r in righe],
+        )
+        db.commit()
+    return _inserisci
+
+
+@pytest.fixture
+def ricarica(A):
+    """ricarica(dove="1=1"): ricaricamento completo (tabella ombra + scambio)
+    dalle righe attuali di `norme` che soddisfano la condizione SQL `dove`."""
+    def _ricarica(dove="1=1"):
+        db = A.get_db()
+        colonne = ", ".join(A.COLONNE_NORME)
+        db.execute("PRAGMA temp_store = FILE")
+        db.execute(f"CREATE TEMP TABLE import_norme ({colonne}, hash_riga)")
+        db.execute(f"INSERT INTO temp.import_norme SELECT {colonne}, hash_riga FROM norme WHERE {dove} ORDER BY id")
+        try:
+            A.costruisci_tabella_ombra(db)
+            A.scambia_tabella_ombra(db)
+        finally:
+            A.scarta_appoggio(db)
+    return _ricarica
@@ -0,0 +1,93 @@
+import sqlite3
+import time
+
+import pytest
+
+
+def _evento(azione):
+    return (azione, None, "anon", "127.0.0.1", "pytest", "", "2024-01-01 00:00:00")
+
+
+def _azioni(db):
+    return [r[0] for r in db.execute("SELECT action FROM audit ORDER BY id")]
+
+
+def test_lotto_riprova_dopo_errore_temporaneo(A, db, monkeypatch):
+    monkeypatch.setattr(A, "AUDIT_ATTESA_RIPROVA", 0)
+    originale, chiamate = A._scrivi_audit, []
+
+    def bloccato_una_volta(lotto):
+        chiamate.append(len(lotto))
+        if len(chiamate) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        originale(lotto)
+
+    monkeypatch.setattr(A, "_scrivi_audit", bloccato_una_volta)
+    assert A._scrivi_lotto_audit([_evento("a"), _evento("b")]) == []
+    assert chiamate == [2, 2]
+    assert _azioni(db) == ["a", "b"]
+
+
+def test_lotto_fallito_scrive_evento_per_evento(A, db, monkeypatch):
+    monkeypatch.setattr(A, "AUDIT_ATTESA_RIPROVA", 0)
+    originale = A._scrivi_audit
+
+    def rifiuta_cattivo(lotto):
+        if any(e[0] == "cattivo" for e in lotto):
+            raise sqlite3.IntegrityError("evento non valido")
+        originale(lotto)
+
+    monkeypatch.setattr(A, "_scrivi_audit", rifiuta_cattivo)
+    persi = A._scrivi_lotto_audit([_evento("a"), _evento("cattivo"), _evento("b")])
+    assert [e[0] for e in persi] == ["cattivo"]
+    assert _azioni(db) == ["a", "b"]
+
+
+def test_tabella_audit_escapa_i_campi(A, client, db):
+    db.execute("""INSERT INTO audit (action, actor, ip, user_agent, details)
+                  VALUES ('<b>azione</b>', '<i>x</i>', '<ip>', '<script>alert(1)</script>', '<img src=x>')""")
+    db.commit()
+    with client.session_transaction() as sessione:
+        sessione["admin"] = True
+    pagina = client.get("/admin/audit").get_data(as_text=True)
+    assert "<script>" not in pagina and "<img" not in pagina and "<b>azione" not in pagina
+    assert "&lt;script&gt;alert(1)&lt;/script&gt;" in pagina
+
+
+def test_archiviazione_senza_vacuum_completo(A, db, tmp_path, monkeypatch):
+    monkeypatch.setattr(A, "AUDIT_ARCHIVIO_DIR", str(tmp_path / "audit_archivio"))
+    assert db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2  # INCREMENTAL (migrazione 11)
+    db.executemany("INSERT INTO audit (action, norma_id, details, ts) VALUES (?, 7, ?, ?)",
+                   [("vecchio", "x" * 2000, "2020-01-15 10:00:00")] * 200
+                   + [("recente", "", "2999-01-01 00:00:00")])
+    db.commit()
+    eseguite = []
+    db.set_trace_callback(eseguite.append)
+    try:
+        assert A.archivia_audit() == 200
+    finally:
+        db.set_trace_callback(None)
+    assert not [sql for sql in eseguite if sql.strip().upper() == "VACUUM"]
+    assert db.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert _azioni(db) == ["recente"]
+    archiviati = A.eventi_archiviati(7)
+    assert len(archiviati) == 200 and archiviati[0]["details"] == "x" * 2000
+
+
+@pytest.fixture
+def ora_di_roma(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/Rome")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_filtro_date_locali_su_ts_utc(A, db, ora_di_roma):
+    # 23:30 UTC del 9/3 è già il 10/3 a Roma (UTC+1); 23:30 UTC del 10/3 è l'11/3
+    db.executemany("INSERT INTO audit (action, ts) VALUES (?, ?)",
+                   [("prima", "2024-03-09 22:30:00"), ("dentro", "2024-03-09 23:30:00"),
+                    ("dopo", "2024-03-10 23:30:00")])
+    db.commit()
+    righe, _ = A.pagina_audit(db, {"dal": "2024-03-10", "al": "2024-03-10"})
+    assert [r["action"] for r in righe] == ["dentro"]
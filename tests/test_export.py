@@ -0,0 +1,81 @@
+import csv
+import io
+import json
+import os
+import sqlite3
+
+import pytest
+from openpyxl import load_workbook
+
+CAMPI = ["Anno", "Numero", "Oggetto"]
+
+
+@pytest.fixture
+def cache(A, tmp_path, monkeypatch):
+    cartella = tmp_path / "export_cache"
+    monkeypatch.setattr(A, "EXPORT_CACHE_DIR", str(cartella))
+    A.invalida_cache_dati()
+    return cartella
+
+
+def _esporta(client, formato, **filtri):
+    dati = {"tipo": "risultati", "formato": formato, "campi": CAMPI, **filtri}
+    risposta = client.post("/esegui_export", data=dati)
+    assert risposta.status_code == 200
+    return risposta.get_data()
+
+
+def _atti(n):
+    return [{"anno": 2000 + i, "numero": i, "argomento": "a", "oggetto": f"atto {i}"} for i in range(n)]
+
+
+def test_export_csv_ndjson_excel(A, client, cache, inserisci):
+    inserisci(_atti(5))
+    attese = [[str(2004 - i), str(4 - i), f"atto {4 - i}"] for i in range(5)]  # anno decrescente
+
+    righe = list(csv.reader(io.StringIO(_esporta(client, "csv").decode("utf-8-sig")), delimiter=";"))
+    assert righe == [CAMPI] + attese
+
+    oggetti = [json.loads(linea) for linea in _esporta(client, "ndjson").decode("utf-8").splitlines()]
+    assert oggetti == [dict(zip(["anno", "numero", "oggetto"], riga)) for riga in attese]
+
+    foglio = load_workbook(io.BytesIO(_esporta(client, "excel")), read_only=True).worksheets[0]
+    valori = [[str(v) for v in riga if v is not None] for riga in foglio.iter_rows(values_only=True)]
+    assert [riga for riga in valori if riga and riga[0].isdigit()] == attese
+
+
+def test_export_csv_con_bom_per_excel(A, client, cache, inserisci):
+    inserisci([{"anno": 2020, "numero": 1, "oggetto": "Attività; perché"}])
+    dati = _esporta(client, "csv")
+    assert dati.startswith("\ufeff".encode("utf-8"))
+    assert dati.count("\ufeff".encode("utf-8")) == 1
+    righe = list(csv.reader(io.StringIO(dati.decode("utf-8-sig")), delimiter=";"))
+    assert righe == [CAMPI, ["2020", "1", "Attività; perché"]]
+
+
+def test_export_filtrato_e_conteggi_in_memoria(A, client, db, cache, inserisci):
+    inserisci(_atti(5))
+    righe = list(csv.reader(io.StringIO(_esporta(client, "csv", anno="2003").decode("utf-8-sig")), delimiter=";"))
+    assert righe[1:] == [["2003", "3", "atto 3"]]
+    assert A.conteggio_export(db, "risultati", {"anno": "2003"}) == 1
+    assert not [n for n in os.listdir(cache) if n.endswith(".conteggio")]
+
+
+def test_cache_export_non_sopravvive_alla_sostituzione_del_db(A, client, db, cache, inserisci, tmp_path):
+    inserisci(_atti(2))
+    A.incrementa_generazione(db)
+    db.commit()
+    prima = _esporta(client, "csv")
+    assert len(os.listdir(cache)) == 1
+
+    # DB "di rete" con dati diversi e la stessa generazione di quello locale
+    rete = str(tmp_path / "rete.db")
+    copia = sqlite3.connect(rete)
+    db.backup(copia)
+    copia.execute("UPDATE norme SET oggetto = 'modificato in rete'")
+    copia.commit()
+    copia.close()
+    A._sostituisci_db_locale(rete)
+
+    dopo = _esporta(A.app.test_client(), "csv")
+    assert dopo != prima and b"modificato in rete" in dopo
@@ -0,0 +1,68 @@
+import re
+
+import pytest
+
+CAMPI = ["Anno", "Numero", "Oggetto"]
+
+
+def _oggetti(dati):
+    """Oggetti del PDF letti tramite la tabella xref (verificandone gli offset)."""
+    inizio = int(dati[dati.rindex(b"startxref") + 9:].split()[0])
+    assert dati[inizio:inizio + 4] == b"xref"
+    voci = dati[inizio:].split(b"\n")
+    primo, totale = map(int, voci[1].split())
+    assert primo == 0
+    oggetti = {}
+    for n in range(1, totale):
+        posizione = int(voci[2 + n][:10])
+        assert dati.startswith(b"%d 0 obj" % n, posizione), n
+        oggetti[n] = dati[posizione:dati.index(b"endobj", posizione)]
+    trailer = dati[dati.index(b"trailer", inizio):]
+    assert int(re.search(rb"/Size (\d+)", trailer).group(1)) == totale
+    return oggetti, trailer
+
+
+def _testa(oggetto):
+    return oggetto.partition(b"stream\n")[0]
+
+
+def _esporta_pdf(A, db, percorso, n):
+    cursore = db.execute(A.SQL_ATTO + A.ORDINE_NORME)
+    A.scrivi_pdf_export(cursore, CAMPI, str(percorso), n)
+    return percorso.read_bytes()
+
+
+@pytest.fixture
+def parti_piccole(A, db, inserisci, monkeypatch):
+    monkeypatch.setattr(A, "EXPORT_PDF_RIGHE_PARTE", 40)
+    monkeypatch.setattr(A, "EXPORT_PDF_PROCESSI", 1)
+    inserisci([{"anno": 2000 + i % 9, "numero": i, "argomento": f"a{i}", "oggetto": f"atto {i}"}
+               for i in range(130)])
+
+
+def test_pdf_unito_da_piu_parti_e_valido(A, db, parti_piccole, tmp_path):
+    dati = _esporta_pdf(A, db, tmp_path / "export.pdf", 130)
+    oggetti, trailer = _oggetti(dati)
+    radice = int(re.search(rb"/Root (\d+) 0 R", trailer).group(1))
+    assert b"/Type /Catalog" in oggetti[radice]
+    pagine = int(re.search(rb"/Pages (\d+) 0 R", oggetti[radice]).group(1))
+    kids = [int(k) for k in re.findall(rb"(\d+) 0 R", re.search(rb"/Kids \[([^\]]*)\]", oggetti[pagine]).group(1))]
+    assert int(re.search(rb"/Count (\d+)", oggetti[pagine]).group(1)) == len(kids)
+    assert kids == [n for n, o in sorted(oggetti.items()) if re.search(rb"/Type /Page\b", _testa(o))]
+    assert len(kids) >= 4  # almeno una pagina per parte
+    for n in kids:
+        assert b"/Parent %d 0 R" % pagine in oggetti[n]
+    # ogni riferimento punta a un oggetto esistente
+    for oggetto in oggetti.values():
+        for ref in re.findall(rb"(\d+) 0 R", _testa(oggetto)):
+            assert int(ref) in oggetti
+
+
+def test_pdf_testata_una_volta_per_pagina(A, db, parti_piccole, tmp_path, monkeypatch):
+    from reportlab import rl_config
+    monkeypatch.setattr(rl_config, "pageCompression", 0)
+    dati = _esporta_pdf(A, db, tmp_path / "export.pdf", 130)
+    oggetti, _ = _oggetti(dati)
+    pagine = [o for o in oggetti.values() if re.search(rb"/Type /Page\b", _testa(o))]
+    assert dati.count(b"(Oggetto) Tj") == len(pagine)
+    assert all(dati.count(b"(atto %d) Tj" % i) == 1 for i in range(130))
@@ -0,0 +1,54 @@
+from openpyxl import Workbook
+
+COLONNE = ["anno", "numero", "tipologia", "fonte", "argomento", "oggetto"]
+
+
+def _scrivi_excel(percorso, righe):
+    wb = Workbook()
+    foglio = wb.active
+    foglio.append(COLONNE)
+    for riga in righe:
+        foglio.append([riga.get(col, "") for col in COLONNE])
+    wb.save(percorso)
+    return str(percorso)
+
+
+def _importa(A, db, percorso, anteprima=False):
+    presenti = A.carica_excel_in_appoggio(db, percorso)
+    if anteprima:
+        return A.confronta_excel(db, presenti)
+    return A.applica_excel(db, presenti)
+
+
+def test_hash_riga_stabile(A):
+    # valore fissato: non deve cambiare con versioni di Python o pandas
+    valori = ["2020", "12", "Legge", "", "Ambiente", "Oggetto", "GU", "a.pdf", "", "vigente", ""]
+    assert A.hash_riga(valori) == A.hash_riga(tuple(valori))
+    assert A.hash_riga(valori) == 5209721741168261175
+    assert A.hash_riga(["", None]) == A.hash_riga([float("nan"), ""])
+    assert A.hash_riga(["ab", "c"]) != A.hash_riga(["a", "bc"])
+
+
+def test_applica_excel_conta_inseriti_aggiornati_invariati(A, db, inserisci, tmp_path):
+    inserisci([
+        {"anno": "2020", "numero": "1", "argomento": "a", "oggetto": "uguale"},
+        {"anno": "2020", "numero": "2", "argomento": "a", "oggetto": "vecchio"},
+        {"anno": "2020", "numero": "3", "argomento": "a", "oggetto": "solo nel db", "stato": "vigente"},
+    ])
+    percorso = _scrivi_excel(tmp_path / "atti.xlsx", [
+        {"anno": "2020", "numero": "1", "argomento": "a", "oggetto": "uguale"},
+        {"anno": "2020", "numero": "2", "argomento": "a", "oggetto": "nuovo"},
+        {"anno": "2020", "numero": "4", "argomento": "a", "oggetto": "inserito"},
+    ])
+    diff = _importa(A, db, percorso, anteprima=True)
+    assert (diff["nuovi"], diff["modificati"], diff["invariati"], diff["mancanti"]) == (1, 1, 1, 1)
+
+    prima = A.generazione_dati(db)
+    assert _importa(A, db, percorso) == {"inseriti": 1, "aggiornati": 1, "invariati": 1, "mancanti": 1}
+    assert A.generazione_dati(db) == prima + 1
+    oggetti = dict(db.execute("SELECT numero, oggetto FROM norme"))
+    assert oggetti == {"1": "uguale", "2": "nuovo", "3": "solo nel db", "4": "inserito"}
+
+    # stesso file di nuovo: niente da scrivere, generazione invariata
+    assert _importa(A, db, percorso) == {"inseriti": 0, "aggiornati": 0, "invariati": 3, "mancanti": 1}
+    assert A.generazione_dati(db) == prima + 1
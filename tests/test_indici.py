@@ -0,0 +1,70 @@
+import re
+
+import pytest
+
+
+def _piano(db, sql, params):
+    return [r[3] for r in db.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+@pytest.fixture(params=[0, 1], ids=["originale", "ricaricato"])
+def con_dati(request, db, inserisci, ricarica):
+    """Dati di prova; nel secondo caso dopo un ricaricamento completo, che
+    alterna i nomi degli indici (idx_x → idx_x__r)."""
+    inserisci([{"anno": 1990 + i % 30, "numero": i, "tipologia": f"t{i % 5}", "fonte": f"f{i % 4}",
+                "argomento": f"a{i % 7}", "filepdf": f"{i}.pdf" if i % 2 else ""} for i in range(300)])
+    for _ in range(request.param):
+        ricarica()
+    db.execute("ANALYZE")
+    return db
+
+
+def test_query_principali_cercano_con_un_indice(A, con_dati):
+    parziali = {r[0] for r in con_dati.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '%WHERE%'")}
+    for nome, (sql, params) in A.QUERY_INDICIZZATE.items():
+        passi = [p for p in _piano(con_dati, sql, params) if p.startswith(("SCAN ", "SEARCH "))]
+        assert passi, nome
+        assert not [p for p in passi if p.startswith("SCAN norme")], (nome, passi)
+        for passo in passi:
+            if passo.startswith("SCAN "):
+                # ammessa solo la scansione di un indice parziale (es. PDF orfani)
+                assert passo.split(" INDEX ")[-1] in parziali, (nome, passo)
+            else:
+                assert " USING " in passo, (nome, passo)
+    assert A.query_senza_indice(con_dati) == []
+
+
+def test_indice_filepdf_senza_predicato(con_dati):
+    for sql in ("SELECT id FROM norme WHERE filepdf = ?",
+                "SELECT MIN(id) FROM norme WHERE filepdf = ? AND TRIM(filepdf) <> ''"):
+        assert any(re.search(r"USING (COVERING )?INDEX idx_norme_filepdf(__r)? ", p)
+                   for p in _piano(con_dati, sql, ("1.pdf",))), sql
+
+
+def test_scansione_completa_segnalata(A, con_dati):
+    A.QUERY_INDICIZZATE["prova"] = ("SELECT id FROM norme WHERE oggetto = ?", ("",))
+    try:
+        lente = A.query_senza_indice(con_dati)
+    finally:
+        del A.QUERY_INDICIZZATE["prova"]
+    assert len(lente) == 1 and lente[0].startswith("prova (SCAN norme")
+    assert not A.passo_indicizzato("SCAN norme USING COVERING INDEX idx_norme_fonte", set())
+
+
+def _indici_norme(db):
+    return sorted(r[0] for r in db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'norme' AND sql IS NOT NULL"))
+
+
+def test_migrazioni_dopo_un_ricaricamento(A, con_dati):
+    prima = _indici_norme(con_dati)
+    con_dati.execute("PRAGMA user_version = 0")
+    con_dati.commit()
+    assert A.migra_schema(con_dati) == A.SCHEMA_VERSIONE
+    dopo = _indici_norme(con_dati)
+    # nessun indice doppio (idx_x accanto a idx_x__r), nessuno ricomparso
+    assert len({A.nomi_indice(n)[0] for n in dopo}) == len(dopo)
+    assert {A.nomi_indice(n)[0] for n in dopo} == {A.nomi_indice(n)[0] for n in prima}
+    assert "idx_norme_chiave" not in {A.nomi_indice(n)[0] for n in dopo}
+    assert A.query_senza_indice(con_dati) == []
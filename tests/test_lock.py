@@ -0,0 +1,72 @@
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def rete(A, db, tmp_path, monkeypatch):
+    """Online, con LOCK_FILE in una cartella temporanea e modifiche da inviare."""
+    monkeypatch.setattr(A, "LOCK_FILE", str(tmp_path / "compendio.lock"))
+    monkeypatch.setattr(A, "HAS_WRITE_LOCK", False)
+    monkeypatch.setattr(A, "_lock_file_nostro", False)
+    monkeypatch.setattr(A, "_scritture_in_corso", 0)
+    monkeypatch.setattr(A, "_titolari_lock", set())
+    monkeypatch.setattr(A, "is_online", lambda: True)
+    monkeypatch.setattr(A, "verifica_rete", lambda: True)
+    monkeypatch.setattr(A, "modifiche_da_inviare", lambda: True)
+    return A
+
+
+def test_modifica_durante_sync_non_rilascia_il_lock_del_sync(rete, client, inserisci, monkeypatch):
+    A = rete
+    inserisci([{"anno": 2020, "numero": 1, "argomento": "a", "oggetto": "prima"}])
+    entrato, continua, visto = threading.Event(), threading.Event(), []
+
+    def invio_lento():
+        entrato.set()
+        continua.wait(10)
+        visto.append(os.path.exists(A.LOCK_FILE))
+        return True
+
+    monkeypatch.setattr(A, "sync_to_network", invio_lento)
+    sync = threading.Thread(target=A.ciclo_sync)
+    sync.start()
+    assert entrato.wait(10)
+
+    # l'utente salva (e rilascia il suo lock) mentre il sync invia
+    client.post("/modifica/1", data={"anno": "2020", "numero": "1", "argomento": "a", "oggetto": "dopo"})
+    assert A.get_db().execute("SELECT oggetto FROM norme WHERE id = 1").fetchone()[0] == "dopo"
+    assert os.path.exists(A.LOCK_FILE) and A.HAS_WRITE_LOCK
+
+    continua.set()
+    sync.join(10)
+    assert visto == [True]
+    assert not os.path.exists(A.LOCK_FILE) and not A.HAS_WRITE_LOCK
+
+
+def test_fine_sync_non_rilascia_il_lock_dell_utente(rete, monkeypatch):
+    A = rete
+    monkeypatch.setattr(A, "sync_to_network", lambda: True)
+
+    assert A.acquire_lock("utente")  # form di modifica aperto
+    assert A.ciclo_sync()
+    assert os.path.exists(A.LOCK_FILE) and A.HAS_WRITE_LOCK
+
+    def vista():
+        A.release_lock()   # come modifica dopo il salvataggio
+        A.ciclo_sync()     # il sync finisce mentre la richiesta scrive ancora
+        return os.path.exists(A.LOCK_FILE)
+
+    with A.app.test_request_context():
+        assert A.require_write_lock(vista)() is True
+    assert not os.path.exists(A.LOCK_FILE) and not A.HAS_WRITE_LOCK
+
+
+def test_lock_di_un_altra_istanza(rete):
+    A = rete
+    with open(A.LOCK_FILE, "w", encoding="utf-8") as f:
+        f.write("PC=altro")
+    assert not A.ciclo_sync()
+    A.release_lock("sync")
+    assert os.path.exists(A.LOCK_FILE)  # non è nostro: resta
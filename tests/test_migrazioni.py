@@ -0,0 +1,112 @@
+import os
+import sqlite3
+
+import pytest
+
+
+def _trigger(db):
+    return {r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+
+
+def test_schema_all_ultima_versione(A, db):
+    assert db.execute("PRAGMA user_version").fetchone()[0] == A.SCHEMA_VERSIONE
+
+
+def test_generazione_una_volta_per_scrittura(A, client, db, inserisci):
+    assert not {t for t in _trigger(db) if t.startswith("norme_gen_")}
+    inserisci([{"anno": 2020, "numero": i, "argomento": "x"} for i in range(50)])
+    prima = A.generazione_dati(db)
+    with client.session_transaction() as sessione:
+        sessione["admin"] = True
+    client.post("/rimuovi_atto", data={"atto_id": 1})
+    assert db.execute("SELECT COUNT(*) FROM norme").fetchone()[0] == 49
+    assert A.generazione_dati(db) == prima + 1
+
+
+@pytest.fixture
+def db_legacy(A, tmp_path, monkeypatch):
+    """DB con lo schema originale (user_version 0) e atti duplicati."""
+    A.chiudi_connessioni()
+    monkeypatch.setattr(A, "BACKUP_DIR", str(tmp_path / "backup"))
+    monkeypatch.setattr(A, "CONFLICTS_FILE", str(tmp_path / "pending_conflicts.json"))
+    A.DB_FILE = str(tmp_path / "compendio_norme.db")
+    conn = sqlite3.connect(A.DB_FILE)
+    conn.execute("""CREATE TABLE norme (id INTEGER PRIMARY KEY AUTOINCREMENT, anno TEXT, numero TEXT,
+                    tipologia TEXT, categoria TEXT, argomento TEXT, oggetto TEXT, fonte TEXT,
+                    filepdf TEXT, descrizione TEXT, stato TEXT, note TEXT)""")
+    conn.execute("""CREATE TABLE audit (id INTEGER PRIMARY KEY AUTOINCREMENT, ts TEXT DEFAULT CURRENT_TIMESTAMP,
+                    action TEXT NOT NULL, norma_id INTEGER, actor TEXT, ip TEXT, user_agent TEXT, details TEXT)""")
+    conn.executemany(
+        "INSERT INTO norme (id, anno, numero, tipologia, fonte, argomento, oggetto) VALUES (?, ?, ?, ?, ?, ?, ?)", [
+            (1, "2020", "1", "L", "GU", "a", "originale"),
+            (2, "2020", "1", "L", "GU", "a", "copia diversa"),
+            (3, "2020", "1", "L", "GU", "a", "originale"),
+            (4, "2020", "1", "L", "GU", "b", "altro argomento"),
+            (5, "2021", "2", "L", None, "a", "fonte nulla"),
+            (6, "2021", "2", "L", None, "a", "fonte nulla"),
+        ])
+    conn.execute("INSERT INTO audit (action, norma_id) VALUES ('modifica', 2)")
+    conn.commit()
+    conn.close()
+    A.crea_database()
+    yield A.get_db()
+    A.chiudi_connessioni()
+
+
+def test_migrazione_chiave_unica_non_cancella_i_doppioni(A, db_legacy, tmp_path):
+    db = db_legacy
+    assert db.execute("PRAGMA user_version").fetchone()[0] == A.SCHEMA_VERSIONE
+    assert [r[0] for r in db.execute("SELECT id FROM norme ORDER BY id")] == [1, 4, 5, 6]
+    assert [tuple(r) for r in db.execute("SELECT id, tenuta_id, oggetto FROM norme_doppioni ORDER BY id")] == [
+        (2, 1, "copia diversa"), (3, 1, "originale")]
+    # nessun dato riscritto: audit e chiavi NULL restano come erano
+    assert db.execute("SELECT norma_id FROM audit").fetchone()[0] == 2
+    assert db.execute("SELECT COUNT(*) FROM norme WHERE fonte IS NULL").fetchone()[0] == 2
+    assert not os.path.exists(A.CONFLICTS_FILE)
+    backup, = os.listdir(tmp_path / "backup")
+    copia = sqlite3.connect(tmp_path / "backup" / backup)
+    assert copia.execute("SELECT COUNT(*) FROM norme").fetchone()[0] == 6
+    assert copia.execute("PRAGMA user_version").fetchone()[0] == 0
+    copia.close()
+
+
+def test_doppioni_risolti_da_admin(A, db_legacy):
+    client = A.app.test_client()
+    with client.session_transaction() as sessione:
+        sessione["admin"] = True
+    pagina = client.get("/admin/conflitti").get_data(as_text=True)
+    assert "copia diversa" in pagina
+    client.post("/admin/conflitti/doppione/2", data={"azione": "usa_doppione"})
+    client.post("/admin/conflitti/doppione/3", data={"azione": "scarta"})
+    db = db_legacy
+    assert db.execute("SELECT oggetto FROM norme WHERE id = 1").fetchone()[0] == "copia diversa"
+    assert db.execute("SELECT COUNT(*) FROM norme_doppioni").fetchone()[0] == 0
+
+
+def test_conflitto_usa_la_chiave_completa(A, client, db, inserisci, monkeypatch, tmp_path):
+    monkeypatch.setattr(A, "CONFLICTS_FILE", str(tmp_path / "pending_conflicts.json"))
+    inserisci([{"anno": 2020, "numero": 1, "argomento": arg, "oggetto": "locale"} for arg in ("a", "b")])
+    riga = dict(A.atto_pubblico(db.execute(A.SQL_ATTO + " WHERE argomento = 'b'").fetchone()))
+    A.add_conflict(A.chiave_conflitto(riga), riga, dict(riga, oggetto="rete"))
+    with client.session_transaction() as sessione:
+        sessione["admin"] = True
+    client.post("/admin/conflitti/risolvi/0", data={"azione": "mantieni_rete"})
+    assert dict(db.execute("SELECT argomento, oggetto FROM norme").fetchall()) == {"a": "locale", "b": "rete"}
+    assert A.load_conflicts() == []
+
+
+def test_doppioni_dopo_un_ricaricamento(A, db_legacy, ricarica):
+    db = db_legacy
+    ricarica()
+    doppioni = {d["id"]: d for d in A.doppioni_in_sospeso(db)}
+    assert doppioni[2]["tenuta"]["id"] == 1 and doppioni[2]["tenuta"]["oggetto"] == "originale"
+
+    # l'atto tenuto non è più nel file: il doppione si può ripristinare
+    ricarica("id <> 1")
+    assert all(d["tenuta"] is None for d in A.doppioni_in_sospeso(db))
+    client = A.app.test_client()
+    with client.session_transaction() as sessione:
+        sessione["admin"] = True
+    client.post("/admin/conflitti/doppione/2", data={"azione": "usa_doppione"})
+    assert db.execute("SELECT oggetto FROM norme WHERE id = 2").fetchone()[0] == "copia diversa"
+    assert [d["tenuta"]["id"] for d in A.doppioni_in_sospeso(db)] == [2]
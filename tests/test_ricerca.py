@@ -0,0 +1,137 @@
+import re
+
+import pytest
+
+
+def _atti(n):
+    # anni ripetuti e numeri con suffisso: l'ordinamento ha più chiavi a pari merito
+    return [{"anno": 2000 + i % 7, "numero": f"{i % 5}{'/bis' if i % 3 == 0 else ''}",
+             "tipologia": "Legge", "fonte": "F", "argomento": f"a{i}"} for i in range(n)]
+
+
+def _ordine_atteso(A, db):
+    return [r[0] for r in db.execute("SELECT id FROM norme" + A.ORDINE_NORME)]
+
+
+def test_pagine_keyset_coprono_tutto_senza_duplicati(A, db, inserisci):
+    inserisci(_atti(53))
+    visti, cursore = [], None
+    while True:
+        righe, cursore = A.pagina_ricerca(db, {"cursore": cursore}, 10)
+        visti += [r["id"] for r in righe]
+        if cursore is None:
+            break
+    assert visti == _ordine_atteso(A, db)
+
+
+def test_cursore_non_valido_riparte_dalla_prima_pagina(A, db, inserisci):
+    inserisci(_atti(5))
+    prima, _ = A.pagina_ricerca(db, {}, 3)
+    righe, _ = A.pagina_ricerca(db, {"cursore": "non-base64!"}, 3)
+    assert [r["id"] for r in righe] == [r["id"] for r in prima]
+
+
+def test_endpoint_json_segue_pagina_successiva(A, client, db, inserisci):
+    inserisci(_atti(25))
+    url, visti = "/ricerca/pagina?per_pagina=10", []
+    while url:
+        dati = client.get(url).get_json()
+        visti += [n["id"] for n in dati["norme"]]
+        url = dati["pagina_successiva"]
+    assert visti == _ordine_atteso(A, db)
+
+
+def test_ricerca_senza_filtri_paginata_per_default(A, client, db, inserisci):
+    inserisci(_atti(A.RICERCA_PER_PAGINA + 5))
+    pagina = client.get("/ricerca").get_data(as_text=True)
+    assert pagina.count("class='atto'") == A.RICERCA_PER_PAGINA
+    link = re.search(r'href="([^"]*cursore=[^"]*)"', pagina).group(1).replace("&amp;", "&")
+    seconda = client.get(link).get_data(as_text=True)
+    assert seconda.count("class='atto'") == 5
+    assert "pagina-successiva" not in seconda
+
+
+def test_ricerca_con_filtri_o_tutti_mostra_elenco_completo(A, client, db, inserisci):
+    inserisci(_atti(A.RICERCA_PER_PAGINA + 5))
+    tutti = client.get("/ricerca?tutti=1").get_data(as_text=True)
+    assert tutti.count("class='atto'") == A.RICERCA_PER_PAGINA + 5
+    filtrati = client.get("/ricerca?anno=2001").get_data(as_text=True)
+    attesi = db.execute("SELECT COUNT(*) FROM norme WHERE anno = '2001'").fetchone()[0]
+    assert filtrati.count("class='atto'") == attesi
+
+
+def test_json_senza_colonne_di_servizio(A, client, db, inserisci):
+    inserisci(_atti(3))
+    A.aggiorna_hash_mancanti(db)
+    for norma in client.get("/ricerca/pagina").get_json()["norme"]:
+        assert set(norma) == set(A.COLONNE_ATTO)
+    assert "anno_n" not in dict(db.execute(A.SQL_ATTO).fetchone())
+
+
+def _trovati(A, db, testo):
+    righe, _ = A.pagina_ricerca(db, {"testo": testo}, 100)
+    return [r["id"] for r in righe]
+
+
+def _esportati(A, db, testo):
+    where, params = A.filtri_export("risultati", {"testo": testo})
+    return {r[0] for r in db.execute("SELECT id FROM norme" + where, params)}
+
+
+def _id(db, oggetto):
+    return db.execute("SELECT id FROM norme WHERE oggetto = ?", (oggetto,)).fetchone()[0]
+
+
+def _atti_testo():
+    return [{"anno": 2001, "numero": 1, "oggetto": "Statuto del comune", "descrizione": "organi"},
+            {"anno": 2002, "numero": 2, "oggetto": "Regolamento edilizio", "descrizione": "statali"},
+            {"anno": 2003, "numero": 3, "oggetto": "Bilancio", "note": "vedi statuto"}]
+
+
+def test_fts_prefisso_ed_esclusione(A, db, inserisci):
+    assert A.FTS_ATTIVO
+    inserisci(_atti_testo())
+    statuto, regolamento, bilancio = (_id(db, o) for o in ("Statuto del comune", "Regolamento edilizio", "Bilancio"))
+    assert set(_trovati(A, db, "stat")) == {statuto, regolamento, bilancio}
+    assert set(_trovati(A, db, "stat -bilancio")) == {statuto, regolamento}
+    assert set(_trovati(A, db, "-statuto")) == {regolamento}
+    assert _trovati(A, db, "inesistente") == []
+
+
+def test_fts_ordina_per_rilevanza_bm25(A, db, inserisci):
+    inserisci(_atti_testo())
+    # "statuto" è nell'oggetto del 2001 e solo nelle note del 2003: l'anno
+    # decrescente metterebbe prima il 2003, il peso dell'oggetto no
+    assert _trovati(A, db, "statuto") == [_id(db, "Statuto del comune"), _id(db, "Bilancio")]
+
+
+def test_fts_trigger_seguono_insert_update_delete(A, db, inserisci):
+    inserisci([{"anno": 2001, "numero": 1, "oggetto": "Piano regolatore"}])
+    atto = _id(db, "Piano regolatore")
+    assert _trovati(A, db, "regolatore") == [atto]
+
+    db.execute("UPDATE norme SET oggetto = 'Piano del traffico' WHERE id = ?", (atto,))
+    db.commit()
+    assert _trovati(A, db, "regolatore") == []
+    assert _trovati(A, db, "traffico") == [atto]
+
+    db.execute("DELETE FROM norme WHERE id = ?", (atto,))
+    db.commit()
+    assert _trovati(A, db, "traffico") == []
+
+
+def test_ricerca_testo_con_like_senza_fts(A, db, inserisci, monkeypatch):
+    inserisci(_atti_testo())
+    monkeypatch.setattr(A, "FTS_ATTIVO", False)
+    statuto, regolamento = _id(db, "Statuto del comune"), _id(db, "Regolamento edilizio")
+    # LIKE trova anche dentro le parole ("tali" in "statali")
+    assert _trovati(A, db, "tali") == [regolamento]
+    assert set(_trovati(A, db, "stat -bilancio")) == {statuto, regolamento}
+
+
+@pytest.mark.parametrize("fts", [True, False])
+def test_export_filtra_il_testo_come_la_ricerca(A, db, inserisci, monkeypatch, fts):
+    inserisci(_atti_testo())
+    monkeypatch.setattr(A, "FTS_ATTIVO", fts)
+    for testo in ("stat", "statuto", "stat -bilancio", "-statuto", "edil organi"):
+        assert _esportati(A, db, testo) == set(_trovati(A, db, testo)), testo
@@ -0,0 +1,43 @@
+import os
+import zipfile
+
+
+def _zip(percorso, nomi):
+    with zipfile.ZipFile(percorso, "w") as z:
+        for nome in nomi:
+            z.writestr(nome, b"%PDF-1.4 " + nome.encode())
+    return str(percorso)
+
+
+def test_estrai_zip_al_primo_livello_della_cartella(A, tmp_path):
+    cartella, fuori = tmp_path / "pdf", tmp_path / "fuori"
+    cartella.mkdir()
+    fuori.mkdir()
+    os.symlink(fuori, cartella / "link")
+    zip_path = _zip(tmp_path / "atti.zip", [
+        "a.pdf", "sub/b.pdf", "../evaso.pdf", "/assoluto.pdf", "sub/../../evaso2.pdf",
+        "link/c.pdf", "win\\d.pdf", "altra/a.pdf", "sub/..",
+    ])
+
+    falliti = A.estrai_zip_parallelo(zip_path, str(cartella))
+
+    assert sorted(n for n, _ in falliti) == ["altra/a.pdf", "sub/.."]
+    assert sorted(os.listdir(cartella)) == sorted(
+        ["a.pdf", "b.pdf", "evaso.pdf", "assoluto.pdf", "evaso2.pdf", "c.pdf", "d.pdf", "link"])
+    assert (cartella / "a.pdf").read_bytes() == b"%PDF-1.4 a.pdf"
+    assert os.listdir(fuori) == [] and not (tmp_path / "evaso.pdf").exists()
+
+
+def test_import_zip_con_sottocartelle_archivia_tutti_i_pdf(A, db, tmp_path, monkeypatch):
+    monkeypatch.setattr(A, "PDF_FOLDER", str(tmp_path / "pdf"))
+    monkeypatch.setattr(A, "PDF_ARCHIVIO_DIR", str(tmp_path / "pdf_archivio"))
+    os.makedirs(A.PDF_FOLDER)
+    os.makedirs(A.PDF_ARCHIVIO_DIR)
+    zip_path = _zip(tmp_path / "atti.zip", ["radice.pdf", "2024/gennaio/delibera.pdf", "2024/nota.pdf"])
+
+    esito = A.lavoro_import_pdf({"zip": zip_path}, lambda *a: None)
+
+    assert esito["messaggio"].startswith("✅ 3 PDF")
+    nomi = {r[0] for r in db.execute("SELECT nome FROM pdf_files")}
+    assert nomi == {"radice.pdf", "delibera.pdf", "nota.pdf"}
+    assert not os.path.exists(zip_path)